@@ -1,10 +1,12 @@
 import torch
 import torch.nn as nn
+import torchvision
 from lib.models.common import Conv, SPP, Bottleneck, BottleneckCSP, Focus, Concat, Detect, SharpenConv
 from torch.nn import Upsample
 from lib.utils import check_anchor_order
 from lib.utils import initialize_weights
 import argparse
+import inspect
 import onnx
 import onnxruntime as ort
 import onnxsim
@@ -143,10 +145,68 @@ class MCnet(nn.Module):
             mi.bias = torch.nn.Parameter(b.view(-1), requires_grad=True)
 
 
+# the TorchScript exporter, which honours the symbolic of ORT_NMS; newer torch defaults to the dynamo one
+ONNX_EXPORT_KWARGS = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+
+class ORT_NMS(torch.autograd.Function):
+    """
+    ONNX NonMaxSuppression
+
+    Exported as the ONNX operator; run eagerly (and while tracing) it computes the same selection
+    with torchvision, one NMS per image and class.
+    """
+    @staticmethod
+    def forward(ctx, boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold):
+        # boxes (bs,n,4) xyxy, scores (bs,nc,n) -> selected (k,3) [batch_index, class_index, box_index]
+        selected = [torch.zeros((0, 3), dtype=torch.int64, device=boxes.device)]
+        for b in range(scores.shape[0]):
+            for c in range(scores.shape[1]):
+                idx = (scores[b, c] > score_threshold).nonzero(as_tuple=False).view(-1)
+                keep = idx[torchvision.ops.nms(boxes[b, idx], scores[b, c, idx], float(iou_threshold))]
+                keep = keep[:int(max_output_boxes_per_class)]
+                selected.append(torch.stack((torch.full_like(keep, b), torch.full_like(keep, c), keep), 1))
+        return torch.cat(selected, 0)
+
+    @staticmethod
+    def symbolic(g, boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold):
+        return g.op("NonMaxSuppression", boxes, scores, max_output_boxes_per_class, iou_threshold, score_threshold)
+
+
+class End2End(nn.Module):
+    """
+    MCnet with box decode, confidence filtering, NMS and the segmentation argmax in the graph
+
+    For the batch of one the export uses, outputs
+    det_out (n,6) [x1, y1, x2, y2, conf, cls] as returned by non_max_suppression,
+    drive_area_seg and lane_line_seg (1,h,w) uint8 masks (0|1).
+    """
+    def __init__(self, model, conf_thres=0.25, iou_thres=0.45, max_det=300):
+        super(End2End, self).__init__()
+        self.model = model
+        self.register_buffer('max_det', torch.tensor([max_det], dtype=torch.int64))
+        self.register_buffer('iou_thres', torch.tensor([iou_thres], dtype=torch.float32))
+        self.register_buffer('conf_thres', torch.tensor([conf_thres], dtype=torch.float32))
+
+    def forward(self, x):
+        det_out, da_seg_out, ll_seg_out = self.model(x)  # det_out (bs,n,5+nc) decoded xywh, obj_conf, cls_conf
+        xy, wh = det_out[..., 0:2], det_out[..., 2:4]
+        boxes = torch.cat((xy - wh / 2, xy + wh / 2), 2)  # xywh to xyxy
+        scores = det_out[..., 5:] * det_out[..., 4:5]  # conf = obj_conf * cls_conf
+        selected = ORT_NMS.apply(boxes, scores.transpose(1, 2), self.max_det, self.iou_thres, self.conf_thres)
+        b, c, i = selected[:, 0], selected[:, 1], selected[:, 2]
+        det = torch.cat((boxes[b, i], scores[b, i, c].unsqueeze(1), c.unsqueeze(1).float()), 1)
+        return det, da_seg_out.argmax(1).to(torch.uint8), ll_seg_out.argmax(1).to(torch.uint8)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--height', type=int, default=640)  # height
     parser.add_argument('--width', type=int, default=640)  # width
+    parser.add_argument('--end2end', action='store_true', help='include decode, NMS and seg argmax in the graph')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='object confidence threshold (--end2end)')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='IOU threshold for NMS (--end2end)')
+    parser.add_argument('--max-det', type=int, default=300, help='maximum detections per class (--end2end)')
     args = parser.parse_args()
 
     do_simplify = True
@@ -161,12 +221,16 @@ if __name__ == "__main__":
     width = args.width
     print("Load ./weights/End-to-end.pth done!")
     onnx_path = f'./weights/yolop-{height}-{width}.onnx'
+    if args.end2end:
+        model = End2End(model, args.conf_thres, args.iou_thres, args.max_det).eval()
+        onnx_path = f'./weights/yolop-{height}-{width}-end2end.onnx'
     inputs = torch.randn(1, 3, height, width)
 
     print(f"Converting to {onnx_path}")
     torch.onnx.export(model, inputs, onnx_path,
                       verbose=False, opset_version=12, input_names=['images'],
-                      output_names=['det_out', 'drive_area_seg', 'lane_line_seg'])
+                      output_names=['det_out', 'drive_area_seg', 'lane_line_seg'],
+                      dynamic_axes={'det_out': {0: 'num_det'}} if args.end2end else None, **ONNX_EXPORT_KWARGS)
     print('convert', onnx_path, 'to onnx finish!!!')
     # Checks
     model_onnx = onnx.load(onnx_path)  # load onnx model
@@ -197,4 +261,5 @@ if __name__ == "__main__":
     PYTHONPATH=. python3 ./export_onnx.py --height 640 --width 640
     PYTHONPATH=. python3 ./export_onnx.py --height 1280 --width 1280
     PYTHONPATH=. python3 ./export_onnx.py --height 320 --width 320
+    PYTHONPATH=. python3 ./export_onnx.py --height 640 --width 640 --end2end
     """
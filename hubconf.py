@@ -7,17 +7,18 @@ from lib.models import get_net
 from pathlib import Path
 import os
 
-def yolop(pretrained=True, device="cpu"):
+def yolop(pretrained=True, device="cpu", tasks=None):
     """Creates YOLOP model
     Arguments:
         pretrained (bool): load pretrained weights into the model
         wieghts (int): the url of pretrained weights
         device (str): cuda device i.e. 0 or 0,1,2,3 or cpu
+        tasks (tuple): heads to run among 'det', 'da' and 'll', None for all; skipped heads return None
     Returns:
         YOLOP pytorch model
     """
     device = select_device(device = device)
-    model = get_net(cfg)
+    model = get_net(cfg, tasks=tasks)
     if pretrained:
         path = os.path.join(Path(__file__).resolve().parent, "weights/End-to-end.pth")
         checkpoint = torch.load(path, map_location= device)
@@ -1,4 +1,7 @@
 import torch 
+from torch.cuda import amp
+
+from lib.core.Attacks.gradients import frozen_parameters
 
 # FGSM helper functions         
 def fgsm_attack(image, epsilon, data_grad):
@@ -43,22 +46,77 @@ def fgsm_attack_with_noise(image, epsilon, data_grad):
     perturbed_image = fgsm_attack(perturbed_image, epsilon, data_grad)
     return perturbed_image
 
-def iterative_fgsm_attack(image, epsilon, data_grad, alpha, num_iter, model, criterion, target, shapes):
+def iterative_fgsm_attack(image, epsilon, data_grad, alpha, num_iter, model, criterion, target, shapes, loss_threshold=None, use_amp=True):
+    """
+    Iterative FGSM / PGD: repeated signed-gradient steps projected onto the L-infinity ball around the clean image.
+
+    Model parameters are frozen for the duration of the attack so backward only computes the input gradient,
+    and the forward passes run under autocast on CUDA.
+
+    Args:
+    image (torch.Tensor): The original input images [N, C, H, W].
+    epsilon (float): Radius of the L-infinity ball the perturbation is projected onto.
+    data_grad (torch.Tensor): Unused, kept for call compatibility with the single-step attacks.
+    alpha (float): Step size of each iteration.
+    num_iter (int): Maximum number of iterations.
+    model (torch.nn.Module): The attacked model.
+    criterion (function): Loss function, called as criterion(outputs, target, shapes, model).
+    target (list): Targets of the batch [det, drivable area, lane line].
+    shapes (list): Letterbox shapes of the batch.
+    loss_threshold (float, optional): Stop updating a sample once its own loss reaches this value, and
+        stop altogether when every sample has. Requires one loss evaluation per sample and iteration;
+        finished samples are dropped from the following forward and backward passes.
+    use_amp (bool): Run the forward passes under autocast when on CUDA.
+
+    Returns:
+    torch.Tensor: The perturbed images, within epsilon of image and clipped to [0, 1].
+    """
     print(f"\nRunning iterative FGSM\n")
 
-    perturbed_image = image.clone()
-    for _ in range(num_iter):
-        perturbed_image.requires_grad = True
-        
-        det_out, da_seg_out, ll_seg_out = model(perturbed_image)
-        inf_out, train_out = det_out 
-
-        total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
-        model.zero_grad()
-        
-        total_loss.backward()
-        
-        perturbed_image = perturbed_image + alpha * perturbed_image.grad.sign()
-        perturbed_image = torch.clamp(perturbed_image, 0, 1)
-    return perturbed_image
+    clean = image.detach()
+    perturbed_image = clean.clone()
+    if loss_threshold is None:
+        rows = None  # every sample runs all iterations
+    else:
+        rows = torch.arange(clean.shape[0], device=clean.device)  # samples still below the threshold
+
+    with frozen_parameters(model):
+        for _ in range(num_iter):
+            x = (perturbed_image if rows is None else perturbed_image[rows]).requires_grad_(True)
+            with amp.autocast(enabled=use_amp and x.is_cuda):
+                det_out, da_seg_out, ll_seg_out = model(x)
+            inf_out, train_out = det_out
+            outputs = ([o.float() for o in train_out], da_seg_out.float(), ll_seg_out.float())
+
+            if rows is None:
+                total_loss, head_losses = criterion(outputs, target, shapes, model)
+            else:
+                # per-sample losses, each sample's gradient only depends on its own loss
+                sample_losses = torch.stack([criterion(*_sample(outputs, target, shapes, j, i), model)[0].reshape(())
+                                             for j, i in enumerate(rows.tolist())])
+                total_loss = sample_losses.sum()
+            grad, = torch.autograd.grad(total_loss, x)
+
+            x = x.detach()
+            if rows is not None:
+                keep = sample_losses.detach() < loss_threshold
+                rows, x, grad = rows[keep], x[keep], grad[keep]
+                if not rows.numel():
+                    break
+            x_clean = clean if rows is None else clean[rows]
+            x = x + alpha * grad.sign()
+            # project onto the epsilon ball around the clean image and the valid pixel range
+            x = torch.clamp(torch.min(torch.max(x, x_clean - epsilon), x_clean + epsilon), 0, 1)
+            if rows is None:
+                perturbed_image = x
+            else:
+                perturbed_image[rows] = x
+    return perturbed_image.detach()
 
+def _sample(outputs, target, shapes, j, i):
+    # Slice row j of the outputs and the targets of image i out of a batch, with det targets re-indexed to image 0
+    train_out, da_seg_out, ll_seg_out = outputs
+    det = target[0][target[0][:, 0] == i].clone()
+    det[:, 0] = 0
+    return ([x[j:j + 1] for x in train_out], da_seg_out[j:j + 1], ll_seg_out[j:j + 1]), \
+        [det, target[1][i:i + 1], target[2][i:i + 1]], shapes[i:i + 1]
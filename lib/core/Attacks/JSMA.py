@@ -2,11 +2,60 @@ import torch
 import numpy as np
 from tqdm import tqdm  
 
+from lib.core.Attacks.gradients import input_gradient
+
 
 # JSMA Helper Functions 
-def calculate_saliency(model, valid_loader, device, config, criterion):
+def saliency_from_gradient(data_grad, reduce=None, half=False):
     """
-    Calculates the saliency maps for images from a validation data loader using a given model.
+    Saliency maps of a batch from its input gradient.
+
+    Args:
+        data_grad (torch.Tensor): d(loss)/d(input) [N, C, H, W].
+        reduce (str, optional): Reduce the channels of each map with 'max' or 'sum' into [N, 1, H, W].
+        half (bool): Store the maps as float16.
+
+    Returns:
+        torch.Tensor: The saliency maps, on the device of data_grad.
+    """
+    saliency_maps = data_grad.abs()
+    if reduce == 'max':
+        saliency_maps = saliency_maps.amax(1, keepdim=True)
+    elif reduce == 'sum':
+        saliency_maps = saliency_maps.sum(1, keepdim=True)
+    if half:
+        saliency_maps = saliency_maps.half()
+    return saliency_maps
+
+
+def jsma_perturbation(num_pixels_to_perturb, perturbation_value, perturbation_type='add', reduce=None, half=False):
+    """
+    Per-batch JSMA perturbation for validate(), which already holds the batch and its input gradient.
+
+    Args:
+        num_pixels_to_perturb (int): Number of top pixels to perturb in each map.
+        perturbation_value (float): The value applied to the top pixels.
+        perturbation_type (str): Type of perturbation ('add', 'set', 'noise').
+        reduce (str, optional): Channel reduction of the saliency maps, see saliency_from_gradient.
+        half (bool): Store the maps as float16.
+
+    Returns:
+        function: perturb(img, data_grad) returning the perturbed batch, on the device of img.
+    """
+    def perturb(img, data_grad):
+        saliency_maps = saliency_from_gradient(data_grad, reduce, half)
+        return find_and_perturb_highest_scoring_pixels(img.detach(), saliency_maps, num_pixels_to_perturb, perturbation_value,
+                                                       perturbation_type=perturbation_type, device=img.device)[0]
+    return perturb
+
+
+def iter_saliency(model, valid_loader, device, config, criterion, reduce=None, half=False):
+    """
+    Streams saliency maps for every batch of a validation data loader.
+
+    Each batch is moved to the device, its input gradient is computed and the batch is yielded
+    together with its saliency map, which stays on the device; only one batch of maps is alive
+    at a time, so the whole validation split can be processed with bounded memory.
 
     Args:
         model (torch.nn.Module): The model used for computing the outputs.
@@ -14,99 +63,103 @@ def calculate_saliency(model, valid_loader, device, config, criterion):
         device (torch.device): The device (GPU/CPU) on which to perform computations.
         config (object): Configuration object containing runtime settings such as DEBUG mode.
         criterion (function): Loss function used to compute the error between predictions and targets.
+        reduce (str, optional): Reduce the channels of each map with 'max' or 'sum' into [N, 1, H, W].
+        half (bool): Store the maps as float16.
 
-    Returns:
-        numpy.ndarray: An array of saliency maps for the first batch of images from the valid_loader.
+    Yields:
+        tuple: (batch_i, img, target, paths, shapes, saliency_maps) with img detached on the device.
     """
-    
     model.eval()
-    saliency_maps = []
-    import time
-    start_t = time.time()
-    for batch_i, (img, target, paths, shapes) in tqdm(enumerate(valid_loader), total=len(valid_loader)):
+    for batch_i, (img, target, paths, shapes) in enumerate(valid_loader):
         
         if not config.DEBUG:
             img = img.to(device, non_blocking=True)
-            assign_target = []
-            for tgt in target:
-                assign_target.append(tgt.to(device))
-            target = assign_target
-            nb, _, height, width = img.shape  # batch size, channel, height, width
+            target = [tgt.to(device) for tgt in target]
             
-        # Enable gradient computation for the input image
-        img.requires_grad = True
-        
-        # Forward pass
-        det_out, da_seg_out, ll_seg_out = model(img)
-        inf_out, train_out = det_out 
-        
-        # Calculate loss
-        total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
-        total_loss.backward()
+        # Gradient of the loss w.r.t. the input image only
+        total_loss, head_losses, data_grad = input_gradient(model, criterion, img, target, shapes)
         
         # Compute saliency map for each image in the batch
-        saliency_maps_batch = img.grad.abs().detach().numpy()
-        saliency_maps.append(saliency_maps_batch)
-        
-        if batch_i == 0:
-            break
-        
+        saliency_maps = saliency_from_gradient(data_grad, reduce, half)
+
+        yield batch_i, img.detach(), target, paths, shapes, saliency_maps
+
+
+def calculate_saliency(model, valid_loader, device, config, criterion, reduce=None, half=False):
+    """
+    Calculates the saliency maps for images from a validation data loader using a given model.
+
+    Args:
+        model (torch.nn.Module): The model used for computing the outputs.
+        valid_loader (DataLoader): DataLoader containing the validation dataset.
+        device (torch.device): The device (GPU/CPU) on which to perform computations.
+        config (object): Configuration object containing runtime settings such as DEBUG mode.
+        criterion (function): Loss function used to compute the error between predictions and targets.
+        reduce (str, optional): Channel reduction, see iter_saliency.
+        half (bool): Store the maps as float16.
+
+    Returns:
+        torch.Tensor: The saliency maps of the whole valid_loader, on the device. Prefer iter_saliency
+        to keep only one batch of maps in memory.
+    """
+    import time
+    start_t = time.time()
+    saliency_maps = [batch[-1] for batch in tqdm(iter_saliency(model, valid_loader, device, config, criterion, reduce, half), total=len(valid_loader))]
     end_t = time.time()
     
     print("total time in calculating saliency maps {}s".format(end_t - start_t))
-    saliency_maps = np.concatenate(saliency_maps, axis=0)
-    
-    # Plot and save the saliency maps and original images
-    img = img.detach().cpu().numpy()  # Move the original images back to CPU and convert to numpy
-  
-    return saliency_maps
+    return torch.cat(saliency_maps, 0)
 
-def find_and_perturb_highest_scoring_pixels(images, saliency_maps, num_pixels_to_perturb, perturbation_value, perturbation_type='add'):
+def find_and_perturb_highest_scoring_pixels(images, saliency_maps, num_pixels_to_perturb, perturbation_value, perturbation_type='add', device=None):
     """
     Perturbs the highest scoring pixels in images based on their saliency maps to investigate the effect on model predictions.
 
+    The whole batch is handled at once: topk on the flattened saliency maps picks the pixels and a
+    single scatter applies the perturbation, on the device of the saliency maps unless one is given.
+
     Args:
-        images (list of numpy.ndarray): The original images.
-        saliency_maps (list of numpy.ndarray): The saliency maps of the images.
+        images (torch.Tensor or list of numpy.ndarray): The original images, [N, C, H, W].
+        saliency_maps (torch.Tensor or numpy.ndarray): The saliency maps of the images, [N, C, H, W], or
+            channel-reduced [N, 1, H, W] in which case every channel of a selected pixel is perturbed.
         num_pixels_to_perturb (int): Number of top pixels to perturb in each map.
         perturbation_value (float): The value to add to the top pixels in the images.
         perturbation_type (str): Type of perturbation ('add', 'set', 'noise').
+        device (torch.device, optional): Device to perturb on, defaults to the device of the saliency maps.
 
     Returns:
-        tuple: Contains the perturbed images tensor and the coordinates of the perturbed pixels.
+        tuple: Contains the perturbed images tensor and, per image, the (channel, y, x) coordinates of the perturbed pixels.
     """
-    perturbed_images = []
-    all_top_coords = []
-    
+    if isinstance(images, (list, tuple)):
+        images = np.stack(images)
+    images, saliency_maps = torch.as_tensor(images), torch.as_tensor(saliency_maps)
+    device = device if device is not None else saliency_maps.device
+    n = min(len(images), len(saliency_maps))
+    shape = images.shape[1:]
 
-    for image, saliency_map in zip(images, saliency_maps):
-        # Flatten the saliency map to get the indices of the top pixels
-        flat_indices = np.argsort(saliency_map.flatten())[::-1]
-        top_indices = flat_indices[:num_pixels_to_perturb]
+    perturbed_images = images[:n].to(device, torch.float32).reshape(n, -1).clone()
+    saliency = saliency_maps[:n].to(device).float().reshape(n, -1)
 
-        # Convert the flat indices back to 2D coordinates (y, x)
-        top_coords = np.unravel_index(top_indices, saliency_map.shape)
-        y_coords, x_coords = top_coords[1], top_coords[2]
+    # Indices of the top pixels of every map, highest saliency first
+    k = min(int(num_pixels_to_perturb), saliency.shape[1])
+    top_indices = saliency.topk(k, dim=1).indices
+    if saliency_maps.shape[1] == 1 and shape[0] > 1:
+        # channel-reduced maps select (y, x) locations, perturb them in every channel
+        plane = shape[-2] * shape[-1]
+        top_indices = torch.cat([top_indices + c * plane for c in range(shape[0])], 1)
 
-        # Create a copy of the image to perturb
-        perturbed_image = image.copy()
-        
-        # Apply perturbation to the top pixels
-        for coord in zip(*top_coords):
-            if perturbation_type == 'add':
-                perturbed_image[coord] += perturbation_value
-            elif perturbation_type == 'set':
-                perturbed_image[coord] = perturbation_value
-            elif perturbation_type == 'noise':
-                perturbed_image[coord] += np.random.normal(perturbation_value)
-
-        # Ensure pixel values are within valid range if necessary
-        perturbed_image = np.clip(perturbed_image, 0, 1)
-
-        # Convert the perturbed image to a tensor and add a batch dimension
-        perturbed_image_tensor = torch.tensor(perturbed_image, dtype=torch.float32).unsqueeze(0)
-        perturbed_images.append(perturbed_image_tensor)
-
-        all_top_coords.append(top_coords)
-        
-    return torch.cat(perturbed_images, dim=0), all_top_coords
\ No newline at end of file
+    # Apply perturbation to the top pixels
+    if perturbation_type == 'add':
+        perturbed_images.scatter_add_(1, top_indices, torch.full(top_indices.shape, float(perturbation_value), device=device))
+    elif perturbation_type == 'set':
+        perturbed_images.scatter_(1, top_indices, float(perturbation_value))
+    elif perturbation_type == 'noise':
+        perturbed_images.scatter_add_(1, top_indices, torch.randn(top_indices.shape, device=device) + perturbation_value)
+
+    # Ensure pixel values are within valid range if necessary
+    perturbed_images = perturbed_images.clamp_(0, 1).view(n, *shape)
+
+    # Convert the flat indices back to (channel, y, x) coordinates
+    height, width = shape[-2:]
+    all_top_coords = [(idx // (height * width), idx // width % height, idx % width) for idx in top_indices]
+
+    return perturbed_images, all_top_coords
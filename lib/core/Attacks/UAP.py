@@ -1,11 +1,38 @@
+import os
+
 import torch
 from tqdm import tqdm
 from torch.optim.lr_scheduler import StepLR
 
-def uap_sgd_yolop(model, valid_loader, device, nb_epoch, eps, criterion, step_decay, beta=12, y_target=None, loss_fn=None, layer_name=None, uap_init=None):
+from lib.core.Attacks.gradients import frozen_parameters
+
+
+def save_uap_checkpoint(path, state):
+    """
+    Write a UAP training checkpoint atomically, an interrupted save never clobbers the previous one
+
+    Args:
+        path (str): Checkpoint file.
+        state (dict): uap, optimizer and scheduler state dicts, position in the loader and losses.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def uap_sgd_yolop(model, valid_loader, device, nb_epoch, eps, criterion, step_decay, beta=12, y_target=None, loss_fn=None, layer_name=None, uap_init=None,
+                  accum_steps=1, checkpoint_path=None, checkpoint_every=100, resume=True):
     """
     Universal Adversarial Perturbation (UAP) via Stochastic Gradient Descent (SGD) for YOLOP
 
+    The perturbation is shaped after the letterboxed inputs of the loader and trained over every
+    batch of every epoch. Gradients of the loss w.r.t. the perturbation are accumulated over
+    `accum_steps` batches before each ascent step, so the effective batch is independent of what
+    fits in memory. With `checkpoint_path`, the perturbation, optimizer and scheduler state are
+    saved every `checkpoint_every` steps and at the end of each epoch, and a run that finds the
+    checkpoint picks up from the batch after the last save.
+
     Args:
         model (torch.nn.Module): The YOLOP model.
         valid_loader (DataLoader): DataLoader for the validation dataset.
@@ -18,64 +45,132 @@ def uap_sgd_yolop(model, valid_loader, device, nb_epoch, eps, criterion, step_de
         loss_fn (callable, optional): Custom loss function (default is CrossEntropyLoss).
         layer_name (str, optional): Target layer name for layer maximization attack. Default is None.
         uap_init (torch.Tensor, optional): Custom perturbation to start from (default is random vector with pixel values {-eps, eps}).
+        accum_steps (int, optional): Number of batches whose gradients are summed per update. Default is 1.
+        checkpoint_path (str, optional): File to checkpoint to and resume from. Default is None (no checkpointing).
+        checkpoint_every (int, optional): Number of updates between checkpoints. Default is 100.
+        resume (bool, optional): Resume from `checkpoint_path` when it exists. Default is True.
 
     Returns:
         torch.Tensor: Adversarial perturbation.
         list: Losses per iteration.
+
+    Raises:
+        ValueError: If the checkpoint was written with another eps or step_decay, or its perturbation
+            does not match the shape of the loader's letterboxed inputs.
     """
-    
-    if uap_init is None:
-        uap = torch.rand((1, 3, 384, 640), device=device) * 2 * eps - eps  # Initialize UAP within [-eps, eps]
-    else:
-        uap = uap_init.to(device)
-        
-    uap.requires_grad = True
-    optimizer = torch.optim.SGD([uap], lr=eps * step_decay)
-    scheduler = StepLR(optimizer, step_size=1, gamma=step_decay)
-    
-    losses = []
-    
-    model.eval()  # Set model to evaluation mode
+    state = None
+    if checkpoint_path is not None and resume and os.path.exists(checkpoint_path):
+        state = torch.load(checkpoint_path, map_location=device)
+        for name, value in (('eps', eps), ('step_decay', step_decay)):
+            if state.get(name) != value:
+                raise ValueError(f"UAP checkpoint {checkpoint_path} was written with {name}={state.get(name)}, not {value}; "
+                                 f"remove it or pass resume=False")
+        print(f"Resuming UAP from {checkpoint_path} at epoch {state['epoch']}, batch {state['batch_i']}")
+
+    uap, optimizer, scheduler = None, None, None
+
+    def init(shape):
+        nonlocal uap, optimizer, scheduler
+        if state is not None:
+            uap = state['uap'].to(device)
+        elif uap_init is None:
+            uap = torch.rand((1, *shape), device=device) * 2 * eps - eps  # Initialize UAP within [-eps, eps]
+        else:
+            uap = uap_init.to(device).reshape(1, *shape)
+        uap.requires_grad = True
+        optimizer = torch.optim.SGD([uap], lr=eps * step_decay)
+        scheduler = StepLR(optimizer, step_size=1, gamma=step_decay)
+        if state is not None:
+            optimizer.load_state_dict(state['optimizer'])
+            scheduler.load_state_dict(state['scheduler'])
+
+    if state is not None:
+        init(state['uap'].shape[1:])
 
+    losses = list(state['losses']) if state is not None else []
+    start_epoch = state['epoch'] if state is not None else 0
+    start_batch = state['batch_i'] if state is not None else 0
+    epoch_loss = state['epoch_loss'] if state is not None else 0.0
+    n_batches = state['n_batches'] if state is not None else 0
+    n_steps = 0
+
+    def checkpoint(epoch, batch_i):
+        if checkpoint_path is None:
+            return
+        save_uap_checkpoint(checkpoint_path, {
+            'uap': uap.detach().cpu(),
+            'optimizer': optimizer.state_dict(),
+            'scheduler': scheduler.state_dict(),
+            'epoch': epoch,
+            'batch_i': batch_i,
+            'epoch_loss': epoch_loss,
+            'n_batches': n_batches,
+            'losses': losses,
+            'eps': eps,
+            'step_decay': step_decay
+        })
+
+    def step():
+        nonlocal n_steps
+        optimizer.step()
+        optimizer.zero_grad()
+        # Clip perturbation to be within [-eps, eps]
+        with torch.no_grad():
+            uap.clamp_(-eps, eps)
+        n_steps += 1
+
+    model.eval()  # Set model to evaluation mode
     print(f"The nb epochs is {nb_epoch}")
-    
-    for epoch in range(nb_epoch):
-        epoch_loss = 0.0
-        for batch_i, (img, target, paths, shapes) in tqdm(enumerate(valid_loader), total=len(valid_loader)):
-            
-            img = img.to(device, non_blocking=True)
-            target = [tgt.to(device) for tgt in target]
-            
-            # Apply perturbation                  
-            perturbed_img = img + uap
-            perturbed_img = torch.clamp(perturbed_img, 0, 1)
-            
-            # Forward pass
-            det_out, da_seg_out, ll_seg_out = model(perturbed_img)
-            inf_out, train_out = det_out 
-            
-            total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
-                    
-            epoch_loss += total_loss.item()
-            
-            model.zero_grad()
-            
-            total_loss.backward()
-                                    
-            # Update perturbation
-            optimizer.step()
-            optimizer.zero_grad()
-            
-            # Clip perturbation to be within [-eps, eps]
-            uap.data = torch.clamp(uap.data, -eps, eps)
-            
-            if batch_i == 0:
-                break
-        
-        scheduler.step()
-        losses.append(epoch_loss / len(valid_loader))
-        
-        if epoch == 2:
-            break
 
+    # only the perturbation is optimized, keep autograd from computing weight gradients
+    with frozen_parameters(model):
+        for epoch in range(start_epoch, nb_epoch):
+            pending = 0
+            for batch_i, (img, target, paths, shapes) in tqdm(enumerate(valid_loader), total=len(valid_loader)):
+                if epoch == start_epoch and batch_i < start_batch:
+                    continue  # already consumed before the checkpoint
+
+                img = img.to(device, non_blocking=True)
+                target = [tgt.to(device) for tgt in target]
+                if uap is None:
+                    init(img.shape[1:])
+                elif uap.shape[1:] != img.shape[1:]:
+                    raise ValueError(f"UAP of shape {tuple(uap.shape[1:])} does not match the loader's inputs of shape "
+                                     f"{tuple(img.shape[1:])}" + (f", remove {checkpoint_path} or pass resume=False" if state is not None else ''))
+
+                # Apply perturbation
+                perturbed_img = img + uap
+                perturbed_img = torch.clamp(perturbed_img, 0, 1)
+
+                # Forward pass
+                det_out, da_seg_out, ll_seg_out = model(perturbed_img)
+                inf_out, train_out = det_out
+
+                total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
+
+                epoch_loss += total_loss.item()
+                n_batches += 1
+
+                # gradient ascent on the loss, averaged over the accumulated batches
+                grad, = torch.autograd.grad(-total_loss / accum_steps, uap)
+                uap.grad = grad if uap.grad is None else uap.grad + grad
+                pending += 1
+
+                if pending == accum_steps:
+                    step()
+                    pending = 0
+                    if n_steps % checkpoint_every == 0:
+                        checkpoint(epoch, batch_i + 1)
+
+            if uap is None:
+                break  # empty loader
+            if pending:
+                step()
+
+            scheduler.step()
+            losses.append(epoch_loss / max(n_batches, 1))
+            epoch_loss, n_batches = 0.0, 0
+            checkpoint(epoch + 1, 0)
+
+    assert uap is not None, 'UAP training needs a non-empty loader'
     return uap.detach(), losses
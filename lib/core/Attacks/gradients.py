@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+
+import torch
+
+
+@contextmanager
+def frozen_parameters(model):
+    """
+    Disable gradients of every model parameter for the duration of an attack
+
+    Attacks only need the gradient w.r.t. the input, with the weights frozen autograd neither
+    keeps the activations needed for weight gradients nor computes them. The original
+    requires_grad flags are restored on exit, also when the attack raises.
+
+    Args:
+        model (torch.nn.Module): The attacked model.
+    """
+    requires_grad = [p.requires_grad for p in model.parameters()]
+    for p in model.parameters():
+        p.requires_grad_(False)
+    try:
+        yield model
+    finally:
+        for p, flag in zip(model.parameters(), requires_grad):
+            p.requires_grad_(flag)
+
+
+def input_gradient(model, criterion, img, target, shapes):
+    """
+    Loss of a batch and its gradient w.r.t. the input only
+
+    Args:
+        model (torch.nn.Module): The attacked model.
+        criterion (function): Loss function, called as criterion(outputs, target, shapes, model).
+        img (torch.Tensor): Input images [N, C, H, W].
+        target (list): Targets of the batch [det, drivable area, lane line].
+        shapes (list): Letterbox shapes of the batch.
+
+    Returns:
+        torch.Tensor: The detached total loss.
+        tuple: The head losses returned by the criterion.
+        torch.Tensor: d(total loss)/d(img), same shape as img.
+    """
+    img = img.detach().requires_grad_(True)
+    with frozen_parameters(model):
+        det_out, da_seg_out, ll_seg_out = model(img)
+        inf_out, train_out = det_out
+        total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
+        data_grad, = torch.autograd.grad(total_loss, img)
+    return total_loss.detach(), head_losses, data_grad
@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Batched pre-processing defenses
+#
+# Every defense takes a batch of images [N, 3, H, W] in [0, 1] on any device and returns a batch of
+# the same shape, dtype and device, so defenses can be chained and applied in-line in validate().
+
+BORDER_TYPES = ('default', 'constant', 'reflect', 'replicate')
+
+_jpeg_pools = {}
+
+
+def image_resizer(images, width, height):
+    """
+    Resize the batch to WIDTHxHEIGHT and back, discarding detail above the reduced resolution
+
+    Args:
+        images (torch.Tensor): Images [N, 3, H, W] in [0, 1].
+        width (int): Intermediate width.
+        height (int): Intermediate height.
+
+    Returns:
+        torch.Tensor: The resized images at the original resolution.
+    """
+    h, w = images.shape[-2:]
+    resized = F.interpolate(images, size=(height, width), mode='bilinear', align_corners=False, antialias=True)
+    return F.interpolate(resized, size=(h, w), mode='bilinear', align_corners=False).clamp_(0, 1)
+
+
+def compress_jpg(images, quality, num_workers=4):
+    """
+    JPEG encode and decode every image of the batch with OpenCV on a thread pool
+
+    Args:
+        images (torch.Tensor): RGB images [N, 3, H, W] in [0, 1].
+        quality (int): JPEG quality, 0 - 100.
+        num_workers (int): Number of encoder threads, shared by all calls.
+
+    Returns:
+        torch.Tensor: The decoded images.
+    """
+    pool = _jpeg_pools.get(num_workers)
+    if pool is None:
+        pool = _jpeg_pools[num_workers] = ThreadPoolExecutor(max_workers=num_workers)
+
+    host = (images.detach() * 255).round_().to('cpu', torch.uint8).permute(0, 2, 3, 1).numpy()
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+
+    def round_trip(img):
+        # OpenCV expects BGR, the YCrCb conversion and chroma subsampling weight R and B differently
+        ok, buf = cv2.imencode('.jpg', np.ascontiguousarray(img[..., ::-1]), params)
+        assert ok, 'JPEG encoding failed'
+        return cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)[..., ::-1]
+
+    decoded = np.stack(list(pool.map(round_trip, host)))
+    out = torch.from_numpy(decoded).permute(0, 3, 1, 2).to(images.device, non_blocking=True)
+    return out.to(images.dtype) / 255
+
+
+def _border_index(n, pad, border_type):
+    # source index of every padded position along one axis, following the OpenCV border modes
+    idx = torch.arange(-pad, n + pad)
+    if border_type == 'replicate':
+        return idx.clamp(0, n - 1)
+    if border_type == 'reflect':  # cv2.BORDER_REFLECT: fedcba|abcdefgh|hgfedcb
+        idx = torch.where(idx < 0, -idx - 1, idx)
+        return torch.where(idx >= n, 2 * n - 1 - idx, idx).clamp(0, n - 1)
+    # cv2.BORDER_DEFAULT (BORDER_REFLECT_101): gfedcb|abcdefgh|gfedcba
+    idx = idx.abs()
+    return (n - 1 - (n - 1 - idx).abs()).clamp(0, n - 1)
+
+
+def _gaussian_kernel(ksize, sigma):
+    # the exact kernel cv2.GaussianBlur uses, including its fixed small-size kernels and default sigma
+    return torch.from_numpy(cv2.getGaussianKernel(ksize, sigma, cv2.CV_64F).reshape(-1))
+
+
+def gaussian_blur(images, ksize, sigma=0, border_type='default'):
+    """
+    Separable Gaussian blur, one horizontal and one vertical depthwise convolution
+
+    Args:
+        images (torch.Tensor): Images [N, C, H, W] in [0, 1].
+        ksize (tuple): Odd kernel (width, height).
+        sigma (float): Standard deviation, 0 derives it from the kernel size like cv2.GaussianBlur.
+        border_type (str): One of BORDER_TYPES, with OpenCV semantics.
+
+    Returns:
+        torch.Tensor: The blurred images.
+    """
+    assert border_type in BORDER_TYPES, f'unsupported border type {border_type}'
+    kw, kh = ksize
+    assert kw % 2 == 1 and kh % 2 == 1, 'Gaussian kernel sizes must be odd'
+    c, h, w = images.shape[-3:]
+    out = images
+    for k, axis, n in ((kw, 3, w), (kh, 2, h)):
+        if k == 1:
+            continue
+        pad = k // 2
+        if border_type == 'constant':
+            out = F.pad(out, (pad, pad, 0, 0) if axis == 3 else (0, 0, pad, pad))
+        else:
+            out = out.index_select(axis, _border_index(n, pad, border_type).to(out.device))
+        kernel = _gaussian_kernel(k, sigma).to(out.device, out.dtype)
+        weight = kernel.view(1, 1, 1, k) if axis == 3 else kernel.view(1, 1, k, 1)
+        out = F.conv2d(out, weight.expand(c, 1, *weight.shape[2:]), groups=c)
+    return out
+
+
+def noise(images, sigma):
+    """
+    Add Gaussian noise
+
+    Args:
+        images (torch.Tensor): Images [N, 3, H, W] in [0, 1].
+        sigma (float): Standard deviation of the noise in 8-bit intensity units (0 - 255).
+
+    Returns:
+        torch.Tensor: The noisy images, clipped to [0, 1].
+    """
+    return (images + torch.randn_like(images) * (sigma / 255)).clamp_(0, 1)
+
+
+def bit_depth(images, bits):
+    """
+    Quantize every channel to 2 ** bits levels
+
+    Args:
+        images (torch.Tensor): Images [N, 3, H, W] in [0, 1].
+        bits (int): Bits per channel, 1 - 8.
+
+    Returns:
+        torch.Tensor: The quantized images.
+    """
+    assert 1 <= bits <= 8, 'bit depth must be between 1 and 8'
+    levels = 2 ** bits - 1
+    return torch.round(images.clamp(0, 1) * levels) / levels
+
+
+def _parse_size(size):
+    width, height = (int(v) for v in size.lower().split('x'))
+    return width, height
+
+
+def build_defenses(resizer=None, quality=None, gauss=None, border_type='default', noise_sigma=None, bits=None):
+    """
+    Chain the requested defenses, in the order resize, JPEG, blur, noise, bit depth
+
+    Args:
+        resizer (str, optional): WIDTHxHEIGHT for image_resizer.
+        quality (int, optional): JPEG quality for compress_jpg.
+        gauss (str, optional): Kernel WIDTHxHEIGHT for gaussian_blur.
+        border_type (str): Border type of the Gaussian blur.
+        noise_sigma (float, optional): Sigma for noise.
+        bits (int, optional): Bits per channel for bit_depth.
+
+    Returns:
+        list: (name, params, defense) tuples, defense maps a batch to a batch. Empty when nothing is requested.
+    """
+    defenses = []
+    if resizer:
+        width, height = _parse_size(resizer)
+        defenses.append(('resize', {'width': width, 'height': height}, partial(image_resizer, width=width, height=height)))
+    if quality is not None:
+        defenses.append(('jpeg', {'quality': quality}, partial(compress_jpg, quality=quality)))
+    if gauss:
+        ksize = _parse_size(gauss)
+        defenses.append(('gaussian_blur', {'ksize': gauss, 'border_type': border_type or 'default'},
+                         partial(gaussian_blur, ksize=ksize, border_type=border_type or 'default')))
+    if noise_sigma is not None:
+        defenses.append(('noise', {'sigma': noise_sigma}, partial(noise, sigma=noise_sigma)))
+    if bits is not None:
+        defenses.append(('bit_depth', {'bits': bits}, partial(bit_depth, bits=bits)))
+    return defenses
+
+
+def apply_defenses(images, defenses):
+    """
+    Run a batch through a chain built by build_defenses, without tracking gradients
+
+    Returns:
+        torch.Tensor: The defended images.
+    """
+    with torch.no_grad():
+        for _, _, defense in defenses or ():
+            images = defense(images)
+    return images
+
+
+def describe_defenses(defenses):
+    """
+    Returns:
+        dict: {name: params} of the chain, json-serialisable for metadata records.
+    """
+    return {name: params for name, params, _ in defenses or ()}
@@ -0,0 +1,215 @@
+import errno
+import json
+import os
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from lib.utils.writer import METADATA_JSONL
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff')
+
+# os.link errors that mean "this file system cannot hardlink here", anything else is a real failure
+_NO_LINK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EMLINK}
+
+
+def param_str(params):
+    """
+    Directory name of an attack/defense parameter set, as used in the organized dataset tree
+
+    Args:
+        params (dict or str): Parameters from a defended image metadata file.
+
+    Returns:
+        str: 'k1_v1_k2_v2' for a dict, the string itself otherwise.
+    """
+    if isinstance(params, dict):
+        return '_'.join([f"{k}_{v}" for k, v in params.items()])
+    return params
+
+
+def _scan(defended_image_dir):
+    # one scandir pass: (directory, image file names, metadata file names) for every sub directory,
+    # metadata being per-image *_metadata.json files and/or one per-directory metadata.jsonl
+    listing = []
+    stack = [defended_image_dir]
+    while stack:
+        top = stack.pop()
+        images, metadata = [], set()
+        with os.scandir(top) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('_metadata.json') or entry.name == METADATA_JSONL:
+                    metadata.add(entry.name)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    images.append(entry.name)
+        if top != defended_image_dir:
+            listing.append((top, sorted(images), metadata))
+    return sorted(listing)
+
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _read_jsonl(path):
+    # image stem -> metadata, from the per-batch records of lib.utils.writer.AsyncImageWriter
+    records = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # torn write from an interrupted run
+            metadata = {k: v for k, v in rec.items() if k != 'images'}
+            for name in rec.get('images', []):
+                records[name] = metadata
+    return records
+
+
+def build_manifest(defended_image_dir, num_workers=16):
+    """
+    Table of every defended image that has a metadata file
+
+    The tree is listed once and all metadata files are read on a thread pool, so later stages
+    never touch the file system to look anything up. Metadata comes from a per-image
+    <name>_metadata.json or, failing that, from the metadata.jsonl of the image's directory.
+
+    Args:
+        defended_image_dir (str): Path to the directory containing defended images.
+        num_workers (int): Threads reading metadata files.
+
+    Returns:
+        list: One dict per image, in directory then file name order, with the keys
+            src, dir, file_name, base_name, dir_attack_type (prefix of the directory name),
+            attack_type (from the metadata), attack_param_str, defense_param_str and metadata (the raw record).
+    """
+    listing = _scan(defended_image_dir)
+    jsonl_dirs = [d for d, _, names in listing if METADATA_JSONL in names]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        jsonl_records = dict(zip(jsonl_dirs, pool.map(_read_jsonl, [os.path.join(d, METADATA_JSONL) for d in jsonl_dirs])))
+
+        candidates, json_paths = [], []
+        for defended_dir, images, names in listing:
+            records = jsonl_records.get(defended_dir, {})
+            for file_name in images:
+                base_name = os.path.splitext(file_name)[0]
+                if f"{base_name}_metadata.json" in names:
+                    json_paths.append(os.path.join(defended_dir, f"{base_name}_metadata.json"))
+                    candidates.append((defended_dir, file_name, base_name, None))
+                elif base_name in records:
+                    candidates.append((defended_dir, file_name, base_name, records[base_name]))
+
+        per_image = iter(tqdm(pool.map(_read_json, json_paths), total=len(json_paths), desc="Reading metadata", unit="file"))
+        metadata = [next(per_image) if meta is None else meta for *_, meta in candidates]
+
+    manifest = []
+    for (defended_dir, file_name, base_name, _), meta in zip(candidates, metadata):
+        manifest.append({
+            'src': os.path.join(defended_dir, file_name),
+            'dir': defended_dir,
+            'file_name': file_name,
+            'base_name': base_name,
+            'dir_attack_type': os.path.basename(defended_dir).split('_')[0],
+            'attack_type': meta.get('attack_type', 'unknown_attack'),
+            'attack_param_str': param_str(meta.get('attack_params', {})),
+            'defense_param_str': param_str(meta.get('defense_params', {})),
+            'metadata': meta
+        })
+    return manifest
+
+
+def _tmp_name(dst):
+    # unique per call, so concurrent calls never share (and write through) a temporary file
+    return os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{uuid.uuid4().hex}.tmp")
+
+
+def _replace(tmp, dst):
+    try:
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst, copying when the file system cannot link (e.g. across devices); an existing dst is replaced
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return  # already linked by a previous run
+    tmp = _tmp_name(dst)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        if e.errno not in _NO_LINK_ERRNOS:
+            raise
+        # copy into a fresh file created for this call only, never into an existing link
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix=f".{os.path.basename(dst)}.", suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    _replace(tmp, dst)
+
+
+def symlink(src, dst):
+    """
+    Symlink dst to src, an existing dst is replaced
+    """
+    tmp = _tmp_name(dst)
+    os.symlink(src, tmp)
+    _replace(tmp, dst)
+
+
+def dedupe_plan(plan):
+    """
+    Drop repeated destinations from a (src, dst) plan, the last pair for a destination wins
+
+    Concurrent operations on one destination race, and which source ends up there would depend
+    on thread timing. Conflicting sources for the same destination are reported.
+
+    Returns:
+        list: The plan with one pair per destination, in first-seen destination order.
+    """
+    by_dst = {}
+    conflicts = 0
+    for src, dst in plan:
+        if dst in by_dst and by_dst[dst] != src:
+            conflicts += 1
+        by_dst[dst] = src
+    if conflicts:
+        print(f"Warning: {conflicts} plan entries reuse a destination with another source, keeping the last one")
+    return [(src, dst) for dst, src in by_dst.items()]
+
+
+def execute_plan(plan, operation, num_workers=16, desc="Linking"):
+    """
+    Create every destination directory once, then run operation(src, dst) for the whole plan on a thread pool
+
+    Repeated destinations are removed first (see dedupe_plan), so no two threads touch one destination.
+
+    Args:
+        plan (list): (src, dst) pairs.
+        operation (callable): link_or_copy, symlink or any function of (src, dst).
+        num_workers (int): Worker threads.
+        desc (str): Progress bar label.
+    """
+    plan = dedupe_plan(plan)
+    new_dirs = sorted({os.path.dirname(dst) for _, dst in plan} - {''})
+    for new_dir in new_dirs:
+        os.makedirs(new_dir, exist_ok=True)
+    print(f"Prepared {len(new_dirs)} directories")
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for _ in tqdm(pool.map(lambda pair: operation(*pair), plan), total=len(plan), desc=desc, unit="file"):
+            pass
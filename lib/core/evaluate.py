@@ -105,6 +105,40 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+def match_detections(detections, labels, iouv):
+    """
+    Mark detections as true positives at every IoU threshold.
+    Both sets of boxes are expected to be in (x1, y1, x2, y2) format, detections sorted by decreasing confidence.
+    Each detection is paired with its best-IoU label of the same class; a label is claimed by the most
+    confident detection whose best IoU exceeds iouv[0], and that pair is then scored against every threshold.
+    Arguments:
+        detections (Array[N, 6]), x1, y1, x2, y2, conf, class
+        labels (Array[M, 5]), class, x1, y1, x2, y2
+        iouv (Array[T]), IoU thresholds in increasing order
+    Returns:
+        correct (Array[N, T]) bool, stays on the device of the inputs
+    """
+    n, m = detections.shape[0], labels.shape[0]
+    if not n or not m:
+        return torch.zeros(n, iouv.numel(), dtype=torch.bool, device=iouv.device)
+
+    iou = general.box_iou(detections[:, :4], labels[:, 1:5])  # n*m, computed once per image
+    iou[detections[:, 5:6] != labels[:, 0]] = -1  # only same-class pairs can match
+    ious, ti = iou.max(1)  # best label for every detection
+
+    # greedy assignment in confidence order: within each label keep the first eligible detection
+    order = torch.arange(n, device=iou.device)
+    valid = ious > iouv[0]
+    key = torch.where(valid, ti * n + order, m * n + order)
+    key, perm = key.sort()
+    first = torch.ones_like(valid)
+    first[1:] = key[1:] // n != key[:-1] // n
+    matched = torch.zeros_like(valid)
+    matched[perm] = first & (key < m * n)
+
+    return matched[:, None] & (ious[:, None] > iouv)
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -184,74 +218,90 @@ class SegmentationMetric(object):
     imgLabel [batch_size, height(144), width(256)]
     confusionMatrix [[0(TN),1(FP)],
                      [2(FN),3(TP)]]
+
+    The confusion matrix is an int64 tensor that lives on the device of the batches fed to
+    addBatch, and every metric is returned as a 0-dim tensor on that device, so nothing is
+    copied to the host until the caller converts the result (e.g. with float()).
     '''
-    def __init__(self, numClass):
+    def __init__(self, numClass, device=None):
         self.numClass = numClass
-        self.confusionMatrix = np.zeros((self.numClass,)*2)
+        self.device = device
+        self.reset()
 
     def pixelAccuracy(self):
         # return all class overall pixel accuracy
         # acc = (TP + TN) / (TP + TN + FP + TN)
-        acc = np.diag(self.confusionMatrix).sum() /  self.confusionMatrix.sum()
+        cm = self.confusionMatrix.double()
+        acc = cm.diag().sum() / cm.sum()
         return acc
         
     def lineAccuracy(self):
-        Acc = np.diag(self.confusionMatrix) / (self.confusionMatrix.sum(axis=1) + 1e-12)
+        cm = self.confusionMatrix.double()
+        Acc = cm.diag() / (cm.sum(1) + 1e-12)
         return Acc[1]
 
     def classPixelAccuracy(self):
         # return each category pixel accuracy(A more accurate way to call it precision)
         # acc = (TP) / TP + FP
-        classAcc = np.diag(self.confusionMatrix) / (self.confusionMatrix.sum(axis=0) + 1e-12)
+        cm = self.confusionMatrix.double()
+        classAcc = cm.diag() / (cm.sum(0) + 1e-12)
         return classAcc
 
     def meanPixelAccuracy(self):
         classAcc = self.classPixelAccuracy()
-        meanAcc = np.nanmean(classAcc)
+        meanAcc = torch.nanmean(classAcc)
         return meanAcc
 
-    def meanIntersectionOverUnion(self):
+    def _classIoU(self):
         # Intersection = TP Union = TP + FP + FN
-        # IoU = TP / (TP + FP + FN)
-        intersection = np.diag(self.confusionMatrix)
-        union = np.sum(self.confusionMatrix, axis=1) + np.sum(self.confusionMatrix, axis=0) - np.diag(self.confusionMatrix)
+        # IoU = TP / (TP + FP + FN), 0 for classes absent from both prediction and label
+        cm = self.confusionMatrix.double()
+        intersection = cm.diag()
+        union = cm.sum(1) + cm.sum(0) - intersection
         IoU = intersection / union
-        IoU[np.isnan(IoU)] = 0
-        mIoU = np.nanmean(IoU)
+        return torch.nan_to_num(IoU, nan=0.0)
+
+    def meanIntersectionOverUnion(self):
+        mIoU = self._classIoU().mean()
         return mIoU
     
     def IntersectionOverUnion(self):
-        intersection = np.diag(self.confusionMatrix)
-        union = np.sum(self.confusionMatrix, axis=1) + np.sum(self.confusionMatrix, axis=0) - np.diag(self.confusionMatrix)
-        IoU = intersection / union
-        IoU[np.isnan(IoU)] = 0
-        return IoU[1]
+        return self._classIoU()[1]
 
     def genConfusionMatrix(self, imgPredict, imgLabel):
         # remove classes from unlabeled pixels in gt image and predict
-        # print(imgLabel.shape)
-        mask = (imgLabel >= 0) & (imgLabel < self.numClass)
-        label = self.numClass * imgLabel[mask] + imgPredict[mask]
-        count = np.bincount(label, minlength=self.numClass**2)
-        confusionMatrix = count.reshape(self.numClass, self.numClass)
+        # out-of-range pixels are routed to an overflow bin instead of being masked out, and the
+        # counts are scattered into a fixed-size buffer: torch.bincount and boolean indexing both
+        # need the output size on the host, which would stall the device on every batch
+        n = self.numClass
+        imgLabel = imgLabel.long()
+        imgPredict = imgPredict.long()
+        mask = (imgLabel >= 0) & (imgLabel < n)
+        label = torch.where(mask, n * imgLabel + imgPredict, torch.full_like(imgLabel, n * n)).flatten()
+        count = torch.zeros(n * n + 1, dtype=torch.int64, device=label.device)
+        count.scatter_add_(0, label, torch.ones_like(label))
+        confusionMatrix = count[:-1].view(n, n)
         return confusionMatrix
 
     def Frequency_Weighted_Intersection_over_Union(self):
         # FWIOU =     [(TP+FN)/(TP+FP+TN+FN)] *[TP / (TP + FP + FN)]
-        freq = np.sum(self.confusionMatrix, axis=1) / np.sum(self.confusionMatrix)
-        iu = np.diag(self.confusionMatrix) / (
-                np.sum(self.confusionMatrix, axis=1) + np.sum(self.confusionMatrix, axis=0) -
-                np.diag(self.confusionMatrix))
+        cm = self.confusionMatrix.double()
+        freq = cm.sum(1) / cm.sum()
+        iu = cm.diag() / (cm.sum(1) + cm.sum(0) - cm.diag())
         FWIoU = (freq[freq > 0] * iu[freq > 0]).sum()
         return FWIoU
 
 
     def addBatch(self, imgPredict, imgLabel):
         assert imgPredict.shape == imgLabel.shape
-        self.confusionMatrix += self.genConfusionMatrix(imgPredict, imgLabel)
+        imgPredict, imgLabel = torch.as_tensor(imgPredict), torch.as_tensor(imgLabel)
+        if self.confusionMatrix.device != imgPredict.device:
+            self.confusionMatrix = self.confusionMatrix.to(imgPredict.device)
+        self.confusionMatrix += self.genConfusionMatrix(imgPredict, imgLabel.to(imgPredict.device))
 
     def reset(self):
-        self.confusionMatrix = np.zeros((self.numClass, self.numClass))
+        device = self.confusionMatrix.device if hasattr(self, 'confusionMatrix') else self.device
+        self.confusionMatrix = torch.zeros((self.numClass, self.numClass), dtype=torch.int64, device=device)
 
 
 
@@ -1,8 +1,9 @@
 import time
-from lib.core.evaluate import ConfusionMatrix,SegmentationMetric
-from lib.core.general import non_max_suppression,check_img_size,scale_coords,xyxy2xywh,xywh2xyxy,box_iou,coco80_to_coco91_class,plot_images,ap_per_class,output_to_target
+from lib.core.evaluate import ConfusionMatrix,SegmentationMetric,match_detections
+from lib.core.general import expand_seg_target,non_max_suppression,check_img_size,scale_coords,xyxy2xywh,xywh2xyxy,box_iou,coco80_to_coco91_class,plot_images,ap_per_class,output_to_target
 from lib.utils.utils import time_synchronized
-from lib.utils import plot_one_box,show_seg_result
+from lib.utils import plot_one_box,show_seg_result,AsyncImageWriter
+from lib.dataset.adversarial_archive import AdversarialArchiveWriter
 import torch
 import numpy as np
 import pandas as pd
@@ -22,8 +23,12 @@ from lib.core.Attacks.FGSM import fgsm_attack, fgsm_attack_with_noise, iterative
 from lib.core.Attacks.JSMA import calculate_saliency, find_and_perturb_highest_scoring_pixels
 from lib.core.Attacks.UAP import uap_sgd_yolop
 from lib.core.Attacks.CCP import color_channel_perturbation
+from lib.core.Attacks.gradients import input_gradient
 
-from lib.core.Defenses.PreProcessing import image_resizer, compress_jpg, gaussian_blur, noise, bit_depth
+from lib.core.Defenses.PreProcessing import apply_defenses, describe_defenses
+
+# number of batches validate() evaluates by default; sweeps pass the same value to stay comparable
+VALIDATE_MAX_BATCHES = 3
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -136,7 +141,7 @@ def train(cfg, train_loader, model, criterion, optimizer, scaler, epoch, num_bat
                 # writer.add_scalar('train_acc', acc.val, global_steps)
                 writer_dict['train_global_steps'] = global_steps + 1
 
-def validate(epoch, config, val_loader, val_dataset, model, criterion, output_dir, tb_log_dir, perturbed_images=None, experiment_number=0, writer_dict=None, logger=None, device='cpu', rank=-1, epsilon=None, attack_type=None, channel=None, step_decay = None, num_pixels = None):
+def validate(epoch, config, val_loader, val_dataset, model, criterion, output_dir, tb_log_dir, perturbed_images=None, experiment_number=0, writer_dict=None, logger=None, device='cpu', rank=-1, epsilon=None, attack_type=None, channel=None, step_decay = None, num_pixels = None, archive_dtype=None, archive_dir=None, defenses=None, max_batches=VALIDATE_MAX_BATCHES, alpha=0.01, num_iter=10, loss_threshold=None):
     # Log the configuration
     # logger.info(config)
     
@@ -144,7 +149,7 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
 
     if attack_type is not None:
         # Constructing the save directory path with additional details based on the attack type
-        if attack_type == 'FGSM':
+        if attack_type in ('FGSM', 'FGSM_WITH_NOISE', 'ITERATIVE_FGSM'):
             save_dir = os.path.join(output_dir, f'visualization_exp_{experiment_number}_epsilon_{epsilon}')
             perturbed_save_dir = os.path.join(output_dir, f'{attack_type}_perturbed_image_eps_{epsilon}_{time.strftime("%Y%m%d-%H%M%S")}_ExpNum{experiment_number}')
 
@@ -161,6 +166,7 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
             perturbed_save_dir = os.path.join(output_dir, f'{attack_type}_perturbed_image_eps_{epsilon}_num_pixels_{num_pixels}_channel_{channel}_{time.strftime("%Y%m%d-%H%M%S")}_ExpNum{experiment_number}')
         else:
             save_dir = output_dir
+            perturbed_save_dir = os.path.join(output_dir, f'{attack_type}_perturbed_image_{time.strftime("%Y%m%d-%H%M%S")}_ExpNum{experiment_number}')
 
     else:
         save_dir = os.path.join(output_dir, f'visualization_NoAttack')
@@ -169,6 +175,13 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
     # Create the directories if they do not exist
     os.makedirs(save_dir, exist_ok=True)
     os.makedirs(perturbed_save_dir, exist_ok=True)
+    # perturbed batches are written to disk off the critical path
+    image_writer = AsyncImageWriter(perturbed_save_dir) if attack_type is not None else None
+    # lossless copy of the exact perturbed model inputs, read back by lib.dataset.AdversarialDataset;
+    # runs sharing archive_dir append to one index and are told apart by their attack params
+    if archive_dir is None:
+        archive_dir = os.path.join(perturbed_save_dir, 'archive')
+    archive_writer = AdversarialArchiveWriter(archive_dir, dtype=archive_dtype) if attack_type is not None and archive_dtype else None
         
     max_stride = 32
     weights = None
@@ -194,8 +207,8 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
 
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=model.nc)
-    da_metric = SegmentationMetric(config.num_seg_class)
-    ll_metric = SegmentationMetric(2)
+    da_metric = SegmentationMetric(config.num_seg_class, device=device)
+    ll_metric = SegmentationMetric(2, device=device)
     names = {k: v for k, v in enumerate(model.names if hasattr(model, 'names') else model.module.names)}
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in names]
     coco91class = coco80_to_coco91_class()
@@ -214,300 +227,292 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
     model.eval()
     jdict, stats, ap, ap_class, wandb_images = [], [], [], [], []
     
-    for batch_i, (img, target, paths, shapes) in tqdm(enumerate(val_loader), total=len(val_loader)):
-        if not config.DEBUG:
-            img = img.to(device, non_blocking=True)
-            assign_target = [tgt.to(device) for tgt in target]
-            target = assign_target
-            nb, _, height, width = img.shape
-
-        if attack_type != None:
-            img.requires_grad = True
-            det_out, da_seg_out, ll_seg_out = model(img)
-            inf_out, train_out = det_out
-            total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
-            losses.update(total_loss.item(), img.size(0))
-            total_loss.backward()
-            data_grad = img.grad
+    try:
+        for batch_i, (img, target, paths, shapes) in tqdm(enumerate(val_loader), total=len(val_loader)):
+            if not config.DEBUG:
+                img = img.to(device, non_blocking=True)
+                assign_target = [tgt.to(device) for tgt in target]
+                target = assign_target
+                target[1] = expand_seg_target(target[1], config.num_seg_class)
+                target[2] = expand_seg_target(target[2], 2)
+                nb, _, height, width = img.shape
+
+            if attack_type != None:
+                # UAP batches and fixed JSMA batches arrive perturbed, iterative FGSM takes its own gradients:
+                # none of them needs the clean input gradient
+                needs_grad = not (attack_type in ('UAP', 'ITERATIVE_FGSM') or (attack_type == 'JSMA' and not callable(perturbed_images)))
+                if needs_grad:
+                    total_loss, head_losses, data_grad = input_gradient(model, criterion, img, target, shapes)
+                    losses.update(total_loss.item(), img.size(0))
             
-            # Save metadata
-            metadata = {
-                'attack_type': attack_type,
-                'epsilon': epsilon
-            }
-
-            if attack_type == 'FGSM':
-                perturbed_data = fgsm_attack(img, epsilon, data_grad)
-            elif attack_type == 'FGSM_WITH_NOISE':
-                perturbed_data = fgsm_attack_with_noise(img, epsilon, data_grad)
-            elif attack_type == 'ITERATIVE_FGSM':
-                perturbed_data = iterative_fgsm_attack(img, epsilon, data_grad, alpha=0.01, num_iter=10, model=model, criterion=criterion, target=target, shapes=shapes)
-            elif attack_type == 'CCP':
-                perturbed_data = color_channel_perturbation(img, epsilon, data_grad, channel)
-                metadata = {
-                'attack_type': attack_type,
-                'epsilon': epsilon,
-                'channel': channel
-            }
-            elif attack_type == 'UAP':
-                perturbed_data = perturbed_images.to(device, non_blocking=True)
-                metadata = {
-                'attack_type': attack_type,
-                'epsilon': epsilon,
-                'step_decay': step_decay
-            }
-            elif attack_type == 'JSMA':
-                perturbed_data = perturbed_images
+                # Save metadata
                 metadata = {
-                'attack_type': attack_type,
-                'epsilon': epsilon,
-                'num_pixels': num_pixels
-            }
-            else:
-                perturbed_data = img
-
-            img = perturbed_data
+                    'attack_type': attack_type,
+                    'epsilon': epsilon
+                }
+
+                if attack_type == 'FGSM':
+                    perturbed_data = fgsm_attack(img, epsilon, data_grad)
+                elif attack_type == 'FGSM_WITH_NOISE':
+                    perturbed_data = fgsm_attack_with_noise(img, epsilon, data_grad)
+                elif attack_type == 'ITERATIVE_FGSM':
+                    perturbed_data = iterative_fgsm_attack(img, epsilon, None, alpha=alpha, num_iter=num_iter, model=model, criterion=criterion, target=target, shapes=shapes, loss_threshold=loss_threshold)
+                    metadata = {
+                    'attack_type': attack_type,
+                    'epsilon': epsilon,
+                    'alpha': alpha,
+                    'num_iter': num_iter,
+                    'loss_threshold': loss_threshold
+                }
+                elif attack_type == 'CCP':
+                    perturbed_data = color_channel_perturbation(img, epsilon, data_grad, channel)
+                    metadata = {
+                    'attack_type': attack_type,
+                    'epsilon': epsilon,
+                    'channel': channel
+                }
+                elif attack_type == 'UAP':
+                    # batches from lib.dataset.UAPDataset already carry the perturbation
+                    perturbed_data = img.detach() if perturbed_images is None else perturbed_images.to(device, non_blocking=True)
+                    metadata = {
+                    'attack_type': attack_type,
+                    'epsilon': epsilon,
+                    'step_decay': step_decay
+                }
+                elif attack_type == 'JSMA':
+                    # perturbed from this batch's own gradient (see lib.core.Attacks.JSMA.jsma_perturbation) or one fixed batch
+                    perturbed_data = perturbed_images(img, data_grad) if callable(perturbed_images) else perturbed_images
+                    metadata = {
+                    'attack_type': attack_type,
+                    'epsilon': epsilon,
+                    'num_pixels': num_pixels
+                }
+                else:
+                    perturbed_data = img
+
+                img = perturbed_data
                 
-            # Save perturbed images
-            for j in range(img.size(0)):
-                img_np = img[j].cpu().detach().numpy().transpose(1, 2, 0) * 255
-                img_np = img_np.astype(np.uint8)
-                                
-                img_filename = os.path.splitext(os.path.basename(paths[j]))[0]
-                
-                img_path = os.path.join(perturbed_save_dir, f'{img_filename}.jpg')
-                metadata_path = os.path.join(perturbed_save_dir, f'{img_filename}_metadata.json')
-
-                cv2.imwrite(img_path, img_np)
-
-                with open(metadata_path, 'w') as f:
-                    json.dump(metadata, f, indent=4)
+                # Save perturbed images
+                image_writer.submit(img, paths, metadata)
+                if archive_writer is not None:
+                    archive_writer.add(img, paths, metadata)
+
+            if defenses:
+                # pre-processing defenses (lib.core.Defenses.PreProcessing.build_defenses) run on the batch in-line
+                img = apply_defenses(img, defenses)
         
-        with torch.no_grad():
-            pad_w, pad_h = shapes[0][1][1]
-            pad_w = int(pad_w)
-            pad_h = int(pad_h)
-            ratio = shapes[0][1][0][0]
-
-            t = time_synchronized()
-            det_out, da_seg_out, ll_seg_out= model(img)
-            t_inf = time_synchronized() - t
-            if batch_i > 0:
-                T_inf.update(t_inf/img.size(0),img.size(0))
-
-            inf_out,train_out = det_out
-
-            #driving area segment evaluation
-            _,da_predict=torch.max(da_seg_out, 1)
-            _,da_gt=torch.max(target[1], 1)
-            da_predict = da_predict[:, pad_h:height-pad_h, pad_w:width-pad_w]
-            da_gt = da_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
-
-            da_metric.reset()
-            da_metric.addBatch(da_predict.cpu(), da_gt.cpu())
-            da_acc = da_metric.pixelAccuracy()
-            da_IoU = da_metric.IntersectionOverUnion()
-            da_mIoU = da_metric.meanIntersectionOverUnion()
-
-            da_acc_seg.update(da_acc,img.size(0))
-            da_IoU_seg.update(da_IoU,img.size(0))
-            da_mIoU_seg.update(da_mIoU,img.size(0))
-
-            #lane line segment evaluation
-            _,ll_predict=torch.max(ll_seg_out, 1)
-            _,ll_gt=torch.max(target[2], 1)
-            ll_predict = ll_predict[:, pad_h:height-pad_h, pad_w:width-pad_w]
-            ll_gt = ll_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
-
-            ll_metric.reset()
-            ll_metric.addBatch(ll_predict.cpu(), ll_gt.cpu())
-            ll_acc = ll_metric.lineAccuracy()
-            ll_IoU = ll_metric.IntersectionOverUnion()
-            ll_mIoU = ll_metric.meanIntersectionOverUnion()
-
-            ll_acc_seg.update(ll_acc,img.size(0))
-            ll_IoU_seg.update(ll_IoU,img.size(0))
-            ll_mIoU_seg.update(ll_mIoU,img.size(0))
+            with torch.no_grad():
+                pad_w, pad_h = shapes[0][1][1]
+                pad_w = int(pad_w)
+                pad_h = int(pad_h)
+                ratio = shapes[0][1][0][0]
+
+                t = time_synchronized()
+                det_out, da_seg_out, ll_seg_out= model(img)
+                t_inf = time_synchronized() - t
+                if batch_i > 0:
+                    T_inf.update(t_inf/img.size(0),img.size(0))
+
+                inf_out,train_out = det_out
+
+                #driving area segment evaluation
+                _,da_predict=torch.max(da_seg_out, 1)
+                _,da_gt=torch.max(target[1], 1)
+                da_predict = da_predict[:, pad_h:height-pad_h, pad_w:width-pad_w]
+                da_gt = da_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
+
+                da_metric.reset()
+                da_metric.addBatch(da_predict, da_gt)
+                da_acc = da_metric.pixelAccuracy()
+                da_IoU = da_metric.IntersectionOverUnion()
+                da_mIoU = da_metric.meanIntersectionOverUnion()
+
+                # the metrics stay on the device; the meters are read back once after the loop
+                da_acc_seg.update(da_acc,img.size(0))
+                da_IoU_seg.update(da_IoU,img.size(0))
+                da_mIoU_seg.update(da_mIoU,img.size(0))
+
+                #lane line segment evaluation
+                _,ll_predict=torch.max(ll_seg_out, 1)
+                _,ll_gt=torch.max(target[2], 1)
+                ll_predict = ll_predict[:, pad_h:height-pad_h, pad_w:width-pad_w]
+                ll_gt = ll_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
+
+                ll_metric.reset()
+                ll_metric.addBatch(ll_predict, ll_gt)
+                ll_acc = ll_metric.lineAccuracy()
+                ll_IoU = ll_metric.IntersectionOverUnion()
+                ll_mIoU = ll_metric.meanIntersectionOverUnion()
+
+                ll_acc_seg.update(ll_acc,img.size(0))
+                ll_IoU_seg.update(ll_IoU,img.size(0))
+                ll_mIoU_seg.update(ll_mIoU,img.size(0))
             
-            total_loss, head_losses = criterion((train_out,da_seg_out, ll_seg_out), target, shapes,model)   
-            losses.update(total_loss.item(), img.size(0))
+                total_loss, head_losses = criterion((train_out,da_seg_out, ll_seg_out), target, shapes,model)   
+                losses.update(total_loss.item(), img.size(0))
             
 
-            #NMS
-            t = time_synchronized()
-            target[0][:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
-            lb = [target[0][target[0][:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
-            output = non_max_suppression(inf_out, conf_thres= config.TEST.NMS_CONF_THRESHOLD, iou_thres=config.TEST.NMS_IOU_THRESHOLD, labels=lb)
-            #output = non_max_suppression(inf_out, conf_thres=0.001, iou_thres=0.6)
-            #output = non_max_suppression(inf_out, conf_thres=config.TEST.NMS_CONF_THRES, iou_thres=config.TEST.NMS_IOU_THRES)
-            t_nms = time_synchronized() - t
-            if batch_i > 0:
-                T_nms.update(t_nms/img.size(0),img.size(0))
-
-            # Visualizations
-            if config.TEST.PLOTS:
-                if batch_i == 0:
-                    for i in range(test_batch_size):
-                        img_filename = os.path.splitext(os.path.basename(paths[i]))[0] + '.jpg'
-                        img_path = os.path.join('lib/dataset/images/bdd100k/val', img_filename) #Path to the original image 
-
-                        # img_test = cv2.imread(paths[i])
-                        img_test = cv2.imread(img_path)
+                #NMS
+                t = time_synchronized()
+                target[0][:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
+                lb = [target[0][target[0][:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
+                output = non_max_suppression(inf_out, conf_thres= config.TEST.NMS_CONF_THRESHOLD, iou_thres=config.TEST.NMS_IOU_THRESHOLD, labels=lb, batched=True)
+                #output = non_max_suppression(inf_out, conf_thres=0.001, iou_thres=0.6)
+                #output = non_max_suppression(inf_out, conf_thres=config.TEST.NMS_CONF_THRES, iou_thres=config.TEST.NMS_IOU_THRES)
+                t_nms = time_synchronized() - t
+                if batch_i > 0:
+                    T_nms.update(t_nms/img.size(0),img.size(0))
+
+                # Visualizations
+                if config.TEST.PLOTS:
+                    if batch_i == 0:
+                        for i in range(test_batch_size):
+                            img_filename = os.path.splitext(os.path.basename(paths[i]))[0] + '.jpg'
+                            img_path = os.path.join('lib/dataset/images/bdd100k/val', img_filename) #Path to the original image 
+
+                            # img_test = cv2.imread(paths[i])
+                            img_test = cv2.imread(img_path)
                         
-                        # print(f"img test : {img_test.shape} \n")
-                        da_seg_mask = da_seg_out[i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
-                        da_seg_mask = torch.nn.functional.interpolate(da_seg_mask, scale_factor=int(1/ratio), mode='bilinear')
-                        _, da_seg_mask = torch.max(da_seg_mask, 1)
-
-                        da_gt_mask = target[1][i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
-                        da_gt_mask = torch.nn.functional.interpolate(da_gt_mask, scale_factor=int(1/ratio), mode='bilinear')
-                        _, da_gt_mask = torch.max(da_gt_mask, 1)
-
-                        da_seg_mask = da_seg_mask.int().squeeze().cpu().numpy()
-                        da_gt_mask = da_gt_mask.int().squeeze().cpu().numpy()
-                        # seg_mask = seg_mask > 0.5
-                        # plot_img_and_mask(img_test, seg_mask, i,epoch,save_dir)
-                        img_test1 = img_test.copy()
-
-                        _ = show_seg_result(img_test, da_seg_mask, i, epoch,save_dir)
-                        _ = show_seg_result(img_test1, da_gt_mask, i, epoch, save_dir, is_gt=True)
-
-                        # img_ll = cv2.imread(paths[i])
-                        img_ll = cv2.imread(img_path)
-                        ll_seg_mask = ll_seg_out[i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
-                        ll_seg_mask = torch.nn.functional.interpolate(ll_seg_mask, scale_factor=int(1/ratio), mode='bilinear')
-                        _, ll_seg_mask = torch.max(ll_seg_mask, 1)
-
-                        ll_gt_mask = target[2][i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
-                        ll_gt_mask = torch.nn.functional.interpolate(ll_gt_mask, scale_factor=int(1/ratio), mode='bilinear')
-                        _, ll_gt_mask = torch.max(ll_gt_mask, 1)
-
-                        ll_seg_mask = ll_seg_mask.int().squeeze().cpu().numpy()
-                        ll_gt_mask = ll_gt_mask.int().squeeze().cpu().numpy()
-                        # seg_mask = seg_mask > 0.5
-                        # plot_img_and_mask(img_test, seg_mask, i,epoch,save_dir)
-                        img_ll1 = img_ll.copy()
-                        _ = show_seg_result(img_ll, ll_seg_mask, i,epoch,save_dir, is_ll=True)
-                        _ = show_seg_result(img_ll1, ll_gt_mask, i, epoch, save_dir, is_ll=True, is_gt=True)
-
-                        img_det = cv2.imread(img_path) 
-                        img_gt = img_det.copy()
-                        det = output[i].clone()
+                            # print(f"img test : {img_test.shape} \n")
+                            da_seg_mask = da_seg_out[i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
+                            da_seg_mask = torch.nn.functional.interpolate(da_seg_mask, scale_factor=int(1/ratio), mode='bilinear')
+                            _, da_seg_mask = torch.max(da_seg_mask, 1)
+
+                            da_gt_mask = target[1][i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
+                            da_gt_mask = torch.nn.functional.interpolate(da_gt_mask, scale_factor=int(1/ratio), mode='bilinear')
+                            _, da_gt_mask = torch.max(da_gt_mask, 1)
+
+                            da_seg_mask = da_seg_mask.int().squeeze().cpu().numpy()
+                            da_gt_mask = da_gt_mask.int().squeeze().cpu().numpy()
+                            # seg_mask = seg_mask > 0.5
+                            # plot_img_and_mask(img_test, seg_mask, i,epoch,save_dir)
+                            img_test1 = img_test.copy()
+
+                            _ = show_seg_result(img_test, da_seg_mask, i, epoch,save_dir)
+                            _ = show_seg_result(img_test1, da_gt_mask, i, epoch, save_dir, is_gt=True)
+
+                            # img_ll = cv2.imread(paths[i])
+                            img_ll = cv2.imread(img_path)
+                            ll_seg_mask = ll_seg_out[i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
+                            ll_seg_mask = torch.nn.functional.interpolate(ll_seg_mask, scale_factor=int(1/ratio), mode='bilinear')
+                            _, ll_seg_mask = torch.max(ll_seg_mask, 1)
+
+                            ll_gt_mask = target[2][i][:, pad_h:height-pad_h, pad_w:width-pad_w].unsqueeze(0)
+                            ll_gt_mask = torch.nn.functional.interpolate(ll_gt_mask, scale_factor=int(1/ratio), mode='bilinear')
+                            _, ll_gt_mask = torch.max(ll_gt_mask, 1)
+
+                            ll_seg_mask = ll_seg_mask.int().squeeze().cpu().numpy()
+                            ll_gt_mask = ll_gt_mask.int().squeeze().cpu().numpy()
+                            # seg_mask = seg_mask > 0.5
+                            # plot_img_and_mask(img_test, seg_mask, i,epoch,save_dir)
+                            img_ll1 = img_ll.copy()
+                            _ = show_seg_result(img_ll, ll_seg_mask, i,epoch,save_dir, is_ll=True)
+                            _ = show_seg_result(img_ll1, ll_gt_mask, i, epoch, save_dir, is_ll=True, is_gt=True)
+
+                            img_det = cv2.imread(img_path) 
+                            img_gt = img_det.copy()
+                            det = output[i].clone()
                         
-                        if len(det):
-                            det[:,:4] = scale_coords(img[i].shape[1:],det[:,:4],img_det.shape).round()
-                        for *xyxy,conf,cls in reversed(det):
-                            #print(cls)
-                            label_det_pred = f'{names[int(cls)]} {conf:.2f}'
-                            plot_one_box(xyxy, img_det , label=label_det_pred, color=colors[int(cls)], line_thickness=3)
-                        cv2.imwrite(save_dir+"/batch_{}_{}_det_pred.png".format(epoch,i),img_det)
-
-                        labels = target[0][target[0][:, 0] == i, 1:]
-                        # print(labels)
-                        labels[:,1:5]=xywh2xyxy(labels[:,1:5])
-                        if len(labels):
-                            labels[:,1:5]=scale_coords(img[i].shape[1:],labels[:,1:5],img_gt.shape).round()
-                        for cls,x1,y1,x2,y2 in labels:
-                            #print(names)
-                            #print(cls)
-                            label_det_gt = f'{names[int(cls)]}'
-                            xyxy = (x1,y1,x2,y2)
-                            plot_one_box(xyxy, img_gt , label=label_det_gt, color=colors[int(cls)], line_thickness=3)
-                        cv2.imwrite(save_dir+"/batch_{}_{}_det_gt.png".format(epoch,i),img_gt)
+                            if len(det):
+                                det[:,:4] = scale_coords(img[i].shape[1:],det[:,:4],img_det.shape).round()
+                            for *xyxy,conf,cls in reversed(det):
+                                #print(cls)
+                                label_det_pred = f'{names[int(cls)]} {conf:.2f}'
+                                plot_one_box(xyxy, img_det , label=label_det_pred, color=colors[int(cls)], line_thickness=3)
+                            cv2.imwrite(save_dir+"/batch_{}_{}_det_pred.png".format(epoch,i),img_det)
+
+                            labels = target[0][target[0][:, 0] == i, 1:]
+                            # print(labels)
+                            labels[:,1:5]=xywh2xyxy(labels[:,1:5])
+                            if len(labels):
+                                labels[:,1:5]=scale_coords(img[i].shape[1:],labels[:,1:5],img_gt.shape).round()
+                            for cls,x1,y1,x2,y2 in labels:
+                                #print(names)
+                                #print(cls)
+                                label_det_gt = f'{names[int(cls)]}'
+                                xyxy = (x1,y1,x2,y2)
+                                plot_one_box(xyxy, img_gt , label=label_det_gt, color=colors[int(cls)], line_thickness=3)
+                            cv2.imwrite(save_dir+"/batch_{}_{}_det_gt.png".format(epoch,i),img_gt)
         
-        for si, pred in enumerate(output):
-            labels = target[0][target[0][:, 0] == si, 1:]     # all object in one image 
-            nl = len(labels)    # num of object
-            tcls = labels[:, 0].tolist() if nl else []  # target class
-            path = Path(paths[si])
-            seen += 1
-
-            if len(pred) == 0:
+            for si, pred in enumerate(output):
+                labels = target[0][target[0][:, 0] == si, 1:]     # all object in one image 
+                nl = len(labels)    # num of object
+                tcls = labels[:, 0].tolist() if nl else []  # target class
+                path = Path(paths[si])
+                seen += 1
+
+                if len(pred) == 0:
+                    if nl:
+                        stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
+                    continue
+
+                # Predictions
+                predn = pred.clone()
+                scale_coords(img[si].shape[1:], predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
+
+                # Append to text file
+                if config.TEST.SAVE_TXT:
+                    gn = torch.tensor(shapes[si][0])[[1, 0, 1, 0]]  # normalization gain whwh
+                    for *xyxy, conf, cls in predn.tolist():
+                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                        with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
+                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+                # W&B logging
+                if config.TEST.PLOTS and len(wandb_images) < log_imgs:
+                    box_data = [{"position": {"minX": xyxy[0], "minY": xyxy[1], "maxX": xyxy[2], "maxY": xyxy[3]},
+                                 "class_id": int(cls),
+                                 "box_caption": "%s %.3f" % (names[cls], conf),
+                                 "scores": {"class_score": conf},
+                                 "domain": "pixel"} for *xyxy, conf, cls in pred.tolist()]
+                    boxes = {"predictions": {"box_data": box_data, "class_labels": names}}  # inference-space
+                    wandb_images.append(wandb.Image(img[si], boxes=boxes, caption=path.name))
+
+                # Append to pycocotools JSON dictionary
+                if config.TEST.SAVE_JSON:
+                    # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
+                    image_id = int(path.stem) if path.stem.isnumeric() else path.stem
+                    box = xyxy2xywh(predn[:, :4])  # xywh
+                    box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
+                    for p, b in zip(pred.tolist(), box.tolist()):
+                        jdict.append({'image_id': image_id,
+                                      'category_id': coco91class[int(p[5])] if is_coco else int(p[5]),
+                                      'bbox': [round(x, 3) for x in b],
+                                      'score': round(p[4], 5)})
+
+
+                # Assign all predictions as incorrect
+                correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
                 if nl:
-                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
-                continue
-
-            # Predictions
-            predn = pred.clone()
-            scale_coords(img[si].shape[1:], predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
-
-            # Append to text file
-            if config.TEST.SAVE_TXT:
-                gn = torch.tensor(shapes[si][0])[[1, 0, 1, 0]]  # normalization gain whwh
-                for *xyxy, conf, cls in predn.tolist():
-                    xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                    line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                    with open(save_dir / 'labels' / (path.stem + '.txt'), 'a') as f:
-                        f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-            # W&B logging
-            if config.TEST.PLOTS and len(wandb_images) < log_imgs:
-                box_data = [{"position": {"minX": xyxy[0], "minY": xyxy[1], "maxX": xyxy[2], "maxY": xyxy[3]},
-                             "class_id": int(cls),
-                             "box_caption": "%s %.3f" % (names[cls], conf),
-                             "scores": {"class_score": conf},
-                             "domain": "pixel"} for *xyxy, conf, cls in pred.tolist()]
-                boxes = {"predictions": {"box_data": box_data, "class_labels": names}}  # inference-space
-                wandb_images.append(wandb.Image(img[si], boxes=boxes, caption=path.name))
-
-            # Append to pycocotools JSON dictionary
-            if config.TEST.SAVE_JSON:
-                # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
-                image_id = int(path.stem) if path.stem.isnumeric() else path.stem
-                box = xyxy2xywh(predn[:, :4])  # xywh
-                box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
-                for p, b in zip(pred.tolist(), box.tolist()):
-                    jdict.append({'image_id': image_id,
-                                  'category_id': coco91class[int(p[5])] if is_coco else int(p[5]),
-                                  'bbox': [round(x, 3) for x in b],
-                                  'score': round(p[4], 5)})
-
-
-            # Assign all predictions as incorrect
-            correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
-            if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
-                # target boxes
-                tbox = xywh2xyxy(labels[:, 1:5])
-                scale_coords(img[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
-                if config.TEST.PLOTS:
-                    confusion_matrix.process_batch(pred, torch.cat((labels[:, 0:1], tbox), 1))
-
-                # Per target class
-                for cls in torch.unique(tcls_tensor):                    
-                    ti = (cls == tcls_tensor).nonzero(as_tuple=False).view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero(as_tuple=False).view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        # n*m  n:pred  m:label
-                        ious, i = box_iou(predn[pi, :4], tbox[ti]).max(1)  # best ious, indices
-                        # Append detections
-                        detected_set = set()
-                        for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                            d = ti[i[j]]  # detected target
-                            if d.item() not in detected_set:
-                                detected_set.add(d.item())
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
-
-            # Append statistics (correct, conf, pcls, tcls)
-            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
-
-        if config.TEST.PLOTS and batch_i < 3:
-            f = save_dir +'/'+ f'test_batch{batch_i}_labels.jpg'  # labels
-            #Thread(target=plot_images, args=(img, target[0], paths, f, names), daemon=True).start()
-            f = save_dir +'/'+ f'test_batch{batch_i}_pred.jpg'  # predictions
-            #Thread(target=plot_images, args=(img, output_to_target(output), paths, f, names), daemon=True).start()
-
-
-        if batch_i == 2:
-            break        
+                    # target boxes
+                    tbox = xywh2xyxy(labels[:, 1:5])
+                    scale_coords(img[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
+                    if config.TEST.PLOTS:
+                        confusion_matrix.process_batch(pred, torch.cat((labels[:, 0:1], tbox), 1))
+
+                    # IoU matrix and greedy confidence-ordered matching for all thresholds in tensor ops
+                    correct = match_detections(predn, torch.cat((labels[:, 0:1], tbox), 1), iouv)
+
+                # Append statistics (correct, conf, pcls, tcls)
+                stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+
+            if config.TEST.PLOTS and batch_i < 3:
+                f = save_dir +'/'+ f'test_batch{batch_i}_labels.jpg'  # labels
+                #Thread(target=plot_images, args=(img, target[0], paths, f, names), daemon=True).start()
+                f = save_dir +'/'+ f'test_batch{batch_i}_pred.jpg'  # predictions
+                #Thread(target=plot_images, args=(img, output_to_target(output), paths, f, names), daemon=True).start()
+
+
+            if max_batches is not None and batch_i + 1 >= max_batches:
+                break        
+    finally:
+        # flush the queued batches even when the loop raises
+        if image_writer is not None:
+            image_writer.close()
+        if archive_writer is not None:
+            archive_writer.close()
+
     # Compute statistics
     # stats : [[all_img_correct]...[all_img_tcls]]
     stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy  zip(*) :unzip
@@ -579,6 +584,9 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
     for i, c in enumerate(ap_class):
         maps[c] = ap[i]
 
+    # single device->host sync for the segmentation meters accumulated during the loop
+    for meter in (da_acc_seg, da_IoU_seg, da_mIoU_seg, ll_acc_seg, ll_IoU_seg, ll_mIoU_seg):
+        meter.avg = float(meter.avg)
     da_segment_result = (da_acc_seg.avg,da_IoU_seg.avg,da_mIoU_seg.avg)
     ll_segment_result = (ll_acc_seg.avg,ll_IoU_seg.avg,ll_mIoU_seg.avg)
     
@@ -617,6 +625,197 @@ def validate(epoch, config, val_loader, val_dataset, model, criterion, output_di
     
     return da_segment_result, ll_segment_result, detect_result, losses.avg, maps, t
 
+def validate_sweep(epoch, config, val_loader, val_dataset, model, criterion, output_dir, sweep, attack_type='FGSM', experiment_number=0, logger=None, device='cpu', max_batches=None, defenses=None):
+    """
+    Evaluate several attack (and defense) settings from one gradient computation per batch
+
+    The sign of the input gradient does not depend on epsilon, so data_grad is computed once per
+    batch and every sweep point is perturbed from it and evaluated in the same pass. Points may
+    also carry their own attack type and defense chain, so a whole attack x defense matrix is
+    streamed batch by batch (load -> attack -> defense -> evaluate) without writing any image:
+    every attacked batch is built once and shared by the points that only differ in defense.
+
+    Inputs:
+    -sweep: (list) of dicts with the attack settings of each point, 'epsilon' and, for CCP, 'channel'.
+            Optional keys: 'attack_type' (overrides attack_type, see SWEEP_ATTACKS), 'num_pixels',
+            'perturb_value' and 'perturb_type' for JSMA, 'uap' ([1, 3, h, w] tensor) for UAP,
+            'defenses' (chain from build_defenses, overrides defenses)
+    -attack_type: default attack of the points, one of SWEEP_ATTACKS
+    -max_batches: stop after this many batches (None evaluates the whole loader)
+    -defenses: (list) pre-processing chain from lib.core.Defenses.PreProcessing.build_defenses applied to every perturbed batch
+
+    Returns:
+    -results: (list) per sweep point, the same tuple validate() returns
+              (da_segment_result, ll_segment_result, detect_result, loss, maps, t)
+    """
+    attack_types = [params.get('attack_type', attack_type) for params in sweep]
+    for point_attack in attack_types:
+        assert point_attack in SWEEP_ATTACKS, f'{point_attack} cannot be swept from a cached gradient'
+    point_defenses = [params.get('defenses', defenses) for params in sweep]
+    # only gradient-based points use the input gradient (and, as in validate(), average its loss)
+    point_grads = [point_attack in SWEEP_GRADIENT_ATTACKS for point_attack in attack_types]
+    nc = 1
+    iouv = torch.linspace(0.5, 0.95, 10).to(device)
+    niou = iouv.numel()
+    names = {k: v for k, v in enumerate(model.names if hasattr(model, 'names') else model.module.names)}
+    da_metric = SegmentationMetric(config.num_seg_class, device=device)
+    ll_metric = SegmentationMetric(2, device=device)
+    points = [{
+        'losses': AverageMeter(),
+        'seg': [AverageMeter() for _ in range(6)],  # da acc, IoU, mIoU, ll acc, IoU, mIoU
+        'T_inf': AverageMeter(),
+        'T_nms': AverageMeter(),
+        'stats': []
+    } for _ in sweep]
+
+    model.eval()
+    for batch_i, (img, target, paths, shapes) in tqdm(enumerate(val_loader), total=len(val_loader)):
+        if max_batches is not None and batch_i >= max_batches:
+            break
+        img = img.to(device, non_blocking=True)
+        target = [tgt.to(device) for tgt in target]
+        target[1] = expand_seg_target(target[1], config.num_seg_class)
+        target[2] = expand_seg_target(target[2], 2)
+        nb, _, height, width = img.shape
+        pad_w, pad_h = shapes[0][1][1]
+        pad_w = int(pad_w)
+        pad_h = int(pad_h)
+
+        # one forward/backward pass for the whole sweep, none when no point is gradient-based
+        if any(point_grads):
+            clean_loss, _, data_grad = input_gradient(model, criterion, img, target, shapes)
+            clean_loss = clean_loss.item()
+        else:
+            clean_loss, data_grad = None, None
+
+        with torch.no_grad():
+            _,da_gt=torch.max(target[1], 1)
+            da_gt = da_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
+            _,ll_gt=torch.max(target[2], 1)
+            ll_gt = ll_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
+            det_target = target[0].clone()
+            det_target[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
+
+            attacked = {}  # attacked batches shared by points that only differ in defense
+            for point, params, point_attack, point_defense, point_grad in zip(points, sweep, attack_types, point_defenses, point_grads):
+                key = _sweep_attack_key(point_attack, params)
+                if key not in attacked:
+                    attacked[key] = _sweep_attack(img, data_grad, point_attack, params)
+                perturbed = apply_defenses(attacked[key], point_defense)
+                if point_grad:
+                    # validate() also averages the loss of the clean gradient pass into its loss meter
+                    point['losses'].update(clean_loss, nb)
+
+                t = time_synchronized()
+                det_out, da_seg_out, ll_seg_out = model(perturbed)
+                t_inf = time_synchronized() - t
+                if batch_i > 0:
+                    point['T_inf'].update(t_inf/nb, nb)
+                inf_out, train_out = det_out
+
+                #segment evaluation, the metrics stay on the device until the end
+                _,da_predict=torch.max(da_seg_out, 1)
+                da_metric.reset()
+                da_metric.addBatch(da_predict[:, pad_h:height-pad_h, pad_w:width-pad_w], da_gt)
+                _,ll_predict=torch.max(ll_seg_out, 1)
+                ll_metric.reset()
+                ll_metric.addBatch(ll_predict[:, pad_h:height-pad_h, pad_w:width-pad_w], ll_gt)
+                values = (da_metric.pixelAccuracy(), da_metric.IntersectionOverUnion(), da_metric.meanIntersectionOverUnion(),
+                          ll_metric.lineAccuracy(), ll_metric.IntersectionOverUnion(), ll_metric.meanIntersectionOverUnion())
+                for meter, value in zip(point['seg'], values):
+                    meter.update(value, nb)
+
+                total_loss, head_losses = criterion((train_out, da_seg_out, ll_seg_out), target, shapes, model)
+                point['losses'].update(total_loss.item(), nb)
+
+                #NMS
+                t = time_synchronized()
+                output = non_max_suppression(inf_out, conf_thres= config.TEST.NMS_CONF_THRESHOLD, iou_thres=config.TEST.NMS_IOU_THRESHOLD, batched=True)
+                t_nms = time_synchronized() - t
+                if batch_i > 0:
+                    point['T_nms'].update(t_nms/nb, nb)
+
+                for si, pred in enumerate(output):
+                    labels = det_target[det_target[:, 0] == si, 1:]
+                    nl = len(labels)
+                    tcls = labels[:, 0].tolist() if nl else []
+                    if len(pred) == 0:
+                        if nl:
+                            point['stats'].append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
+                        continue
+                    predn = pred.clone()
+                    scale_coords(img[si].shape[1:], predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
+                    correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
+                    if nl:
+                        tbox = xywh2xyxy(labels[:, 1:5])
+                        scale_coords(img[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
+                        correct = match_detections(predn, torch.cat((labels[:, 0:1], tbox), 1), iouv)
+                    point['stats'].append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+
+    results, rows = [], []
+    for point, params, point_attack, point_defense in zip(points, sweep, attack_types, point_defenses):
+        stats = [np.concatenate(x, 0) for x in zip(*point['stats'])]
+        mp, mr, map50, map = 0., 0., 0., 0.
+        maps = np.zeros(nc)
+        if len(stats) and stats[0].any():
+            p, r, ap, f1, ap_class = ap_per_class(*stats, plot=False, names=names)
+            ap50, ap = ap[:, 0], ap.mean(1)
+            mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+            maps += map
+            for i, c in enumerate(ap_class):
+                maps[c] = ap[i]
+        seg = [float(meter.avg) for meter in point['seg']]
+        t = [point['T_inf'].avg, point['T_nms'].avg]
+        results.append((tuple(seg[:3]), tuple(seg[3:]), np.asarray([mp, mr, map50, map]), point['losses'].avg, maps, t))
+        rows.append({
+            'attack_type': point_attack,
+            'epsilon': params.get('epsilon'),
+            'channel': params.get('channel'),
+            'num_pixels': params.get('num_pixels'),
+            'defense_type': describe_defenses(point_defense) or 'none',
+            'total_loss': point['losses'].avg,
+            'da_seg_acc': seg[0],
+            'da_seg_iou': seg[1],
+            'da_seg_miou': seg[2],
+            'll_seg_acc': seg[3],
+            'll_seg_iou': seg[4],
+            'll_seg_miou': seg[5],
+            'p': mp,
+            'r': mr,
+            'map50': map50,
+            'map': map,
+            't_inf': t[0],
+            't_nms': t[1]
+        })
+
+    # every sweep point side by side in one table
+    save_results_to_csv(rows, f'{attack_type}_sweep_results_{time.strftime("%Y%m%d-%H%M%S")}_ExpNum{experiment_number}.csv', output_dir)
+    return results
+
+SWEEP_ATTACKS = ('FGSM', 'CCP', 'JSMA', 'UAP', 'None')
+SWEEP_GRADIENT_ATTACKS = ('FGSM', 'CCP', 'JSMA')
+
+
+def _sweep_attack_key(attack_type, params):
+    uap = params.get('uap')
+    return (attack_type, params.get('epsilon'), params.get('channel'), params.get('num_pixels'),
+            params.get('perturb_value'), params.get('perturb_type'), id(uap) if uap is not None else None)
+
+
+def _sweep_attack(img, data_grad, attack_type, params):
+    # perturb a batch for one sweep point from the shared input gradient
+    if attack_type == 'FGSM':
+        return fgsm_attack(img, params['epsilon'], data_grad)
+    if attack_type == 'CCP':
+        return color_channel_perturbation(img, params['epsilon'], data_grad, params['channel'])
+    if attack_type == 'JSMA':
+        # the saliency map is the magnitude of the same input gradient
+        return find_and_perturb_highest_scoring_pixels(img, data_grad.abs(), params['num_pixels'], params['perturb_value'],
+                                                       perturbation_type=params.get('perturb_type', 'add'), device=img.device)[0]
+    if attack_type == 'UAP':
+        return torch.clamp(img + params['uap'].to(img.device), 0, 1)
+    return img
+
 def save_results_to_csv(results, file_name, directory='.'):
     if not os.path.exists(directory):
         os.makedirs(directory)
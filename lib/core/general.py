@@ -95,12 +95,16 @@ def box_iou(box1, box2):
     inter = (torch.min(box1[:, None, 2:], box2[:, 2:]) - torch.max(box1[:, None, :2], box2[:, :2])).clamp(0).prod(2)
     return inter / (area1[:, None] + area2 - inter)  # iou = inter / (area1 + area2 - inter)
 
-def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, labels=()):
+def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, labels=(), batched=False):
     """Performs Non-Maximum Suppression (NMS) on inference results
 
+    batched=True runs a single NMS over the candidates of every image (see batched_non_max_suppression)
+
     Returns:
          detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
     """
+    if batched:
+        return batched_non_max_suppression(prediction, conf_thres, iou_thres, classes, agnostic, labels)
 
     nc = prediction.shape[2] - 5  # number of classes
     xc = prediction[..., 4] > conf_thres  # candidates
@@ -185,6 +189,88 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def batched_non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, labels=()):
+    """Performs Non-Maximum Suppression (NMS) on inference results for the whole batch at once
+
+    Candidates of all images are filtered together and suppressed by one torchvision batched_nms call
+    whose groups are (image, class) pairs, so boxes never suppress boxes of another image.
+
+    Returns:
+         list with one tensor per image, detections with shape: nx6 (x1, y1, x2, y2, conf, cls)
+    """
+
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - 5  # number of classes
+
+    # Settings
+    max_det = 300  # maximum number of detections per image
+    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms() per image
+    multi_label = nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    xi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image index, anchor index of candidates
+    x = prediction[xi, ai]
+
+    # Cat apriori labels if autolabelling
+    if labels:
+        vs, vi = [x], [xi]
+        for li, l in enumerate(labels):
+            if len(l):
+                v = torch.zeros((len(l), nc + 5), device=x.device)
+                v[:, :4] = l[:, 1:5]  # box
+                v[:, 4] = 1.0  # conf
+                v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+                vs.append(v)
+                vi.append(torch.full((len(l),), li, dtype=xi.dtype, device=x.device))
+        x, xi = torch.cat(vs, 0), torch.cat(vi, 0)
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, xi = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), xi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x, xi = torch.cat((box, conf, j.float()), 1)[keep], xi[keep]
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, xi = x[keep], xi[keep]
+
+    # Check shape
+    n = x.shape[0]  # number of boxes
+    if not n:  # no boxes
+        return [torch.zeros((0, 6), device=prediction.device)] * bs
+    elif n > max_nms * bs:  # excess boxes
+        keep = x[:, 4].argsort(descending=True)[:max_nms * bs]  # sort by confidence
+        x, xi = x[keep], xi[keep]
+
+    # Batched NMS, one group per (image, class)
+    groups = xi if agnostic else xi * nc + x[:, 5].long()
+    i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], groups, iou_thres)  # sorted by decreasing score
+
+    # Regroup by image keeping the score order, and limit detections per image
+    i = i[torch.sort(xi[i], stable=True)[1]]
+    counts = torch.bincount(xi[i], minlength=bs)
+    rank = torch.arange(len(i), device=i.device) - (counts.cumsum(0) - counts)[xi[i]]
+    i = i[rank < max_det]
+    return list(x[i].split(counts.clamp(max=max_det).tolist()))
+
+
+def expand_seg_target(target, nc):
+    # Expand bit-packed uint8 segmentation targets [b, h, w] into float one-hot channels [b, nc, h, w]
+    if target.dim() == 4:  # already expanded
+        return target
+    bits = torch.arange(nc, device=target.device, dtype=torch.uint8).view(1, -1, 1, 1)
+    return ((target.unsqueeze(1) >> bits) & 1).float()
+
+
 def xywh2xyxy(x):
     # Convert nx4 boxes from [x, y, w, h] to [x1, y1, x2, y2] where xy1=top-left, xy2=bottom-right
     y = torch.zeros_like(x) if isinstance(x, torch.Tensor) else np.zeros_like(x)
@@ -1,29 +1,31 @@
 import torch.nn as nn
 import torch
-from .general import bbox_iou
+from .general import bbox_iou, expand_seg_target
 from .postprocess import build_targets
-from lib.core.evaluate import SegmentationMetric
 
 class MultiHeadLoss(nn.Module):
     """
     collect all the loss we need
     """
-    def __init__(self, losses, cfg, lambdas=None):
+    def __init__(self, losses, cfg, lambdas=None, ll_iou='hard'):
         """
         Inputs:
         - losses: (list)[nn.Module, nn.Module, ...]
         - cfg: config object
         - lambdas: (list) + IoU loss, weight for each loss
+        - ll_iou: (str) lane line IoU term, 'hard' (argmax IoU, no gradient) or 'soft' (differentiable)
         """
         super().__init__()
         # lambdas: [cls, obj, iou, la_seg, ll_seg, ll_iou]
         if not lambdas:
             lambdas = [1.0 for _ in range(len(losses) + 3)]
         assert all(lam >= 0.0 for lam in lambdas)
+        assert ll_iou in ('hard', 'soft'), f'unknown lane line IoU type {ll_iou}'
 
         self.losses = nn.ModuleList(losses)
         self.lambdas = lambdas
         self.cfg = cfg
+        self.ll_iou = ll_iou
 
     def forward(self, head_fields, head_targets, shapes, model):
         """
@@ -34,7 +36,8 @@ class MultiHeadLoss(nn.Module):
 
         Returns:
         - total_loss: sum of all the loss
-        - head_losses: (tuple) contain all loss[loss1, loss2, ...]
+        - head_losses: (tuple) contain all loss[loss1, loss2, ...] as detached 0-dim tensors on the device,
+          convert them (e.g. float()) only where they are logged
 
         """
         # head_losses = [ll
@@ -62,11 +65,13 @@ class MultiHeadLoss(nn.Module):
 
         Returns:
             total_loss: sum of all the loss
-            head_losses: list containing losses
+            head_losses: detached (lbox, lobj, lcls, lseg_da, lseg_ll, liou_ll, loss), no host sync
 
         """
         cfg = self.cfg
         device = targets[0].device
+        # compact uint8 segmentation targets are expanded to one-hot channels on the device here
+        targets = [targets[0], expand_seg_target(targets[1], predictions[1].shape[1]), expand_seg_target(targets[2], predictions[2].shape[1])]
         lcls, lbox, lobj = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
         
         
@@ -119,20 +124,28 @@ class MultiHeadLoss(nn.Module):
         lane_line_seg_targets = targets[2].view(-1)
         lseg_ll = BCEseg(lane_line_seg_predicts, lane_line_seg_targets)
 
-        metric = SegmentationMetric(2)
         nb, _, height, width = targets[1].shape
                 
         pad_w, pad_h = shapes[0][1][1]
         pad_w = int(pad_w)
         pad_h = int(pad_h)
-        _,lane_line_pred=torch.max(predictions[2], 1)
-        _,lane_line_gt=torch.max(targets[2], 1)
-        lane_line_pred = lane_line_pred[:, pad_h:height-pad_h, pad_w:width-pad_w]
-        lane_line_gt = lane_line_gt[:, pad_h:height-pad_h, pad_w:width-pad_w]
-        metric.reset()
-        metric.addBatch(lane_line_pred.cpu(), lane_line_gt.cpu())
-        IoU = metric.IntersectionOverUnion()
-        liou_ll = 1 - IoU
+        # lane line IoU is computed on the device so the loss never waits on a host copy
+        lane_line_out = predictions[2][:, :, pad_h:height-pad_h, pad_w:width-pad_w]
+        lane_line_tgt = targets[2][:, :, pad_h:height-pad_h, pad_w:width-pad_w]
+        if self.ll_iou == 'soft':
+            lane_line_pred = lane_line_out[:, 1]
+            lane_line_gt = lane_line_tgt[:, 1]
+            intersection = (lane_line_pred * lane_line_gt).sum()
+            union = (lane_line_pred + lane_line_gt - lane_line_pred * lane_line_gt).sum()
+            IoU = intersection / (union + 1e-12)
+        else:
+            with torch.no_grad():
+                lane_line_pred = lane_line_out.argmax(1) == 1
+                lane_line_gt = lane_line_tgt.argmax(1) == 1
+                intersection = (lane_line_pred & lane_line_gt).sum()
+                union = (lane_line_pred | lane_line_gt).sum()
+                IoU = torch.where(union > 0, intersection / union.clamp(min=1), torch.zeros_like(union, dtype=torch.float))
+        liou_ll = 1 - IoU.view(1)
 
         s = 3 / no  # output count scaling
         lcls *= cfg.LOSS.CLS_GAIN * s * self.lambdas[0]
@@ -170,10 +183,10 @@ class MultiHeadLoss(nn.Module):
         loss = lbox + lobj + lcls + lseg_da + lseg_ll + liou_ll
         # loss = lseg
         # return loss * bs, torch.cat((lbox, lobj, lcls, loss)).detach()
-        return loss, (lbox.item(), lobj.item(), lcls.item(), lseg_da.item(), lseg_ll.item(), liou_ll.item(), loss.item())
+        return loss, tuple(l.detach().reshape(()) for l in (lbox, lobj, lcls, lseg_da, lseg_ll, liou_ll, loss))
 
 
-def get_loss(cfg, device):
+def get_loss(cfg, device, ll_iou='hard'):
     """
     get MultiHeadLoss
 
@@ -181,6 +194,7 @@ def get_loss(cfg, device):
     -cfg: configuration use the loss_name part or 
           function part(like regression classification)
     -device: cpu or gpu device
+    -ll_iou: lane line IoU term, 'hard' or 'soft' (see MultiHeadLoss)
 
     Returns:
     -loss: (MultiHeadLoss)
@@ -198,7 +212,7 @@ def get_loss(cfg, device):
         BCEcls, BCEobj = FocalLoss(BCEcls, gamma), FocalLoss(BCEobj, gamma)
 
     loss_list = [BCEcls, BCEobj, BCEseg]
-    loss = MultiHeadLoss(loss_list, cfg=cfg, lambdas=cfg.LOSS.MULTI_HEAD_LAMBDA)
+    loss = MultiHeadLoss(loss_list, cfg=cfg, lambdas=cfg.LOSS.MULTI_HEAD_LAMBDA, ll_iou=ll_iou)
     
     return loss
 
@@ -1,63 +1,25 @@
-import json
-import os
-import shutil
-from tqdm import tqdm
+import os, sys
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(BASE_DIR)
+from lib.core.defended_manifest import build_manifest, execute_plan, link_or_copy
 
-def organize_and_move_images(defended_image_dir, target_dir):
+def organize_and_move_images(defended_image_dir, target_dir, num_workers=16):
     """
     Organize and move defended images into structured directories based on attack and defense parameters.
 
+    All metadata is read once into a manifest, the target directories are created in bulk and the
+    images are hardlinked (copied when linking is not possible) on a thread pool.
+
     Args:
         defended_image_dir (str): Path to the directory containing defended images.
         target_dir (str): Target directory where the organized images will be moved.
+        num_workers (int): Threads reading metadata and linking images.
     """
-    # Get all directories to process
-    all_dirs = []
-    for root, dirs, files in os.walk(defended_image_dir):
-        for dir_name in dirs:
-            all_dirs.append(os.path.join(root, dir_name))
-
-    with tqdm(total=len(all_dirs), desc="Processing directories", unit="dir") as pbar_dirs:
-        for defended_dir in all_dirs:
-            parts = os.path.basename(defended_dir).split('_')
-            attack_type = parts[0]
-            defense_type = parts[-1]
-
-            files = [f for f in os.listdir(defended_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff'))]
-            
-            with tqdm(total=len(files), desc=f"Processing files in {os.path.basename(defended_dir)}", unit="file") as pbar_files:
-                for file_name in files:
-                    src_file = os.path.join(defended_dir, file_name)
-                    
-                    # Load the metadata file
-                    metadata_file = os.path.join(defended_dir, f"{os.path.splitext(file_name)[0]}_metadata.json")
-                    
-                    if os.path.exists(metadata_file):
-                        with open(metadata_file, 'r') as f:
-                            metadata = json.load(f)
-
-                        attack_params = metadata.get('attack_params', {})
-                        defense_params = metadata.get('defense_params', {})
-
-                        # Handle the case where defense_params is a string
-                        if isinstance(defense_params, str):
-                            defense_param_str = defense_params
-                        else:
-                            defense_param_str = '_'.join([f"{k}_{v}" for k, v in defense_params.items()])
-
-                        attack_param_str = '_'.join([f"{k}_{v}" for k, v in attack_params.items()])
-                        new_image_dir = os.path.join(target_dir, attack_type, attack_param_str, defense_param_str)
-                        
-                        if not os.path.exists(new_image_dir):
-                            os.makedirs(new_image_dir)
-                            print(f"Created directory {new_image_dir}")
+    manifest = build_manifest(defended_image_dir, num_workers)
 
-                        dest_file = os.path.join(new_image_dir, file_name)
-                        shutil.copyfile(src_file, dest_file)
-                        # print(f"Copied {src_file} to {dest_file}")
-                    
-                    pbar_files.update(1)
-            pbar_dirs.update(1)
+    plan = [(rec['src'], os.path.join(target_dir, rec['dir_attack_type'], rec['attack_param_str'], rec['defense_param_str'], rec['file_name']))
+            for rec in manifest]
+    execute_plan(plan, link_or_copy, num_workers, desc="Organizing images")
             
 def main():
     """
@@ -9,13 +9,14 @@ from pathlib import Path
 from PIL import Image
 from torch.utils.data import Dataset
 from ..utils import letterbox, augment_hsv, random_perspective, xyxy2xywh, cutout
+from .sample_cache import SampleCache
 
 
 class AutoDriveDataset(Dataset):
     """
     A general Dataset for some common function
     """
-    def __init__(self, cfg, is_train, inputsize=640, transform=None):
+    def __init__(self, cfg, is_train, inputsize=640, transform=None, cache_dir=None, compact_targets=False):
         """
         initial all the characteristic
 
@@ -23,11 +24,15 @@ class AutoDriveDataset(Dataset):
         -cfg: configurations
         -is_train(bool): whether train set or not
         -transform: ToTensor and Normalize
+        -cache_dir: optional directory for the decoded-sample cache (validation only)
+        -compact_targets(bool): return segmentation targets as bit-packed uint8 maps [H, W]
+         instead of float one-hot channels [C, H, W] (see lib.core.general.expand_seg_target)
         
         Returns:
         None
         """
         self.is_train = is_train
+        self.compact_targets = compact_targets
         self.cfg = cfg
         self.transform = transform
         self.inputsize = inputsize
@@ -61,6 +66,9 @@ class AutoDriveDataset(Dataset):
 
         # self.target_type = cfg.MODEL.TARGET_TYPE
         self.shapes = np.array(cfg.DATASET.ORG_IMG_SIZE)
+
+        # eval-mode samples are deterministic, so their decoded form can be reused across validate() calls
+        self.sample_cache = SampleCache(cache_dir) if cache_dir and not is_train else None
     
     def _get_db(self):
         """
@@ -99,46 +107,28 @@ class AutoDriveDataset(Dataset):
         cv2.warpAffine
         """
         data = self.db[idx]
-        
-        img = cv2.imread(data["image"], cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        # seg_label = cv2.imread(data["mask"], 0)
-        if self.cfg.num_seg_class == 3:
-            seg_label = cv2.imread(data["mask"])
-        else:
-            seg_label = cv2.imread(data["mask"], 0)
-        lane_label = cv2.imread(data["lane"], 0)
-        #print(lane_label.shape)
-        # print(seg_label.shape)
-        # print(lane_label.shape)
-        # print(seg_label.shape)
         resized_shape = self.inputsize
         if isinstance(resized_shape, list):
             resized_shape = max(resized_shape)
-        h0, w0 = img.shape[:2]  # orig hw
-        r = resized_shape / max(h0, w0)  # resize image to img_size
-        if r != 1:  # always resize down, only resize up if training with augmentation
-            interp = cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR
-            img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
-            seg_label = cv2.resize(seg_label, (int(w0 * r), int(h0 * r)), interpolation=interp)
-            lane_label = cv2.resize(lane_label, (int(w0 * r), int(h0 * r)), interpolation=interp)
-        h, w = img.shape[:2]
-        
-        (img, seg_label, lane_label), ratio, pad = letterbox((img, seg_label, lane_label), resized_shape, auto=True, scaleup=self.is_train)
+
+        cached = None
+        if self.sample_cache is not None:
+            cache_key = SampleCache.key(data["image"], resized_shape)
+            cache_stamp = SampleCache.stamp(data["image"], data["mask"], data["lane"])
+            cached = self.sample_cache.get(cache_key, stamp=cache_stamp)
+
+        if cached is not None:
+            img, seg_fg, lane_fg, meta = cached
+            h0, w0 = meta['h0'], meta['w0']
+            h, w = meta['h'], meta['w']
+            ratio, pad = tuple(meta['ratio']), tuple(meta['pad'])
+        else:
+            img, seg_label, lane_label, (h0, w0), (h, w), ratio, pad = self.load_letterboxed(data, resized_shape)
         shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
         # ratio = (w / w0, h / h0)
         # print(resized_shape)
         
-        det_label = data["label"]
-        labels=[]
-        
-        if det_label.size > 0:
-            # Normalized xywh to pixel xyxy format
-            labels = det_label.copy()
-            labels[:, 1] = ratio[0] * w * (det_label[:, 1] - det_label[:, 3] / 2) + pad[0]  # pad width
-            labels[:, 2] = ratio[1] * h * (det_label[:, 2] - det_label[:, 4] / 2) + pad[1]  # pad height
-            labels[:, 3] = ratio[0] * w * (det_label[:, 1] + det_label[:, 3] / 2) + pad[0]
-            labels[:, 4] = ratio[1] * h * (det_label[:, 2] + det_label[:, 4] / 2) + pad[1]
+        labels = self.letterbox_labels(data["label"], (h, w), ratio, pad)
             
         if self.is_train:
             combination = (img, seg_label, lane_label)
@@ -182,17 +172,8 @@ class AutoDriveDataset(Dataset):
                     labels[:, 2] = 1 - labels[:, 2]
         
         else:
-            if len(labels):
-                # convert xyxy to xywh
-                labels[:, 1:5] = xyxy2xywh(labels[:, 1:5])
-
-                # Normalize coordinates 0 - 1
-                labels[:, [2, 4]] /= img.shape[0]  # height
-                labels[:, [1, 3]] /= img.shape[1]  # width
+            labels = self.normalize_labels(labels, img.shape[:2])
 
-        labels_out = torch.zeros((len(labels), 6))
-        if len(labels):
-            labels_out[:, 1:] = torch.from_numpy(labels)
         # Convert
         # img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         # img = img.transpose(2, 0, 1)
@@ -201,46 +182,176 @@ class AutoDriveDataset(Dataset):
         # if idx == 0:
         #     print(seg_label[:,:,0])
 
-        if self.cfg.num_seg_class == 3:
-            _,seg0 = cv2.threshold(seg_label[:,:,0],128,255,cv2.THRESH_BINARY)
-            _,seg1 = cv2.threshold(seg_label[:,:,1],1,255,cv2.THRESH_BINARY)
-            _,seg2 = cv2.threshold(seg_label[:,:,2],1,255,cv2.THRESH_BINARY)
-        else:
-            _,seg1 = cv2.threshold(seg_label,1,255,cv2.THRESH_BINARY)
-            _,seg2 = cv2.threshold(seg_label,1,255,cv2.THRESH_BINARY_INV)
-        _,lane1 = cv2.threshold(lane_label,1,255,cv2.THRESH_BINARY)
-        _,lane2 = cv2.threshold(lane_label,1,255,cv2.THRESH_BINARY_INV)
-#        _,seg2 = cv2.threshold(seg_label[:,:,2],1,255,cv2.THRESH_BINARY)
-        # # seg1[cutout_mask] = 0
-        # # seg2[cutout_mask] = 0
-        
-        # seg_label /= 255
-        # seg0 = self.Tensor(seg0)
-        if self.cfg.num_seg_class == 3:
-            seg0 = self.Tensor(seg0)
-        seg1 = self.Tensor(seg1)
-        seg2 = self.Tensor(seg2)
-        # seg1 = self.Tensor(seg1)
-        # seg2 = self.Tensor(seg2)
-        lane1 = self.Tensor(lane1)
-        lane2 = self.Tensor(lane2)
-
-        # seg_label = torch.stack((seg2[0], seg1[0]),0)
-        if self.cfg.num_seg_class == 3:
-            seg_label = torch.stack((seg0[0],seg1[0],seg2[0]),0)
-        else:
-            seg_label = torch.stack((seg2[0], seg1[0]),0)
-            
-        lane_label = torch.stack((lane2[0], lane1[0]),0)
+        if cached is None:
+            seg_fg, lane_fg = self.threshold_labels(seg_label, lane_label)
+            if self.sample_cache is not None:
+                meta = {'h0': h0, 'w0': w0, 'h': h, 'w': w, 'ratio': [float(x) for x in ratio], 'pad': [float(x) for x in pad]}
+                self.sample_cache.put(cache_key, img, seg_fg, lane_fg, meta, stamp=cache_stamp)
+
         # _, gt_mask = torch.max(seg_label, 0)
         # _ = show_seg_result(img, gt_mask, idx, 0, save_dir='debug', is_gt=True)
         
 
-        target = [labels_out, seg_label, lane_label]
+        target = self.build_target(labels, seg_fg, lane_fg)
         img = self.transform(img)
 
         return img, target, data["image"], shapes
 
+    def load_target(self, idx):
+        """
+        Ground truth of a validation sample without decoding its image
+
+        Used when the model input comes from elsewhere (e.g. lib.dataset.AdversarialDataset). The
+        masks come from the decoded-sample cache when it holds the sample, otherwise only the two
+        segmentation labels are decoded; they share the image size, so the letterbox geometry and
+        the det labels are identical to __getitem__.
+
+        Inputs:
+        -idx: the index of image in self.db
+
+        Returns:
+        -target, path, shapes: as returned by __getitem__
+        """
+        assert not self.is_train, 'load_target only serves deterministic validation samples'
+        data = self.db[idx]
+        resized_shape = self.inputsize
+        if isinstance(resized_shape, list):
+            resized_shape = max(resized_shape)
+
+        cached = None
+        if self.sample_cache is not None:
+            cached = self.sample_cache.get(SampleCache.key(data["image"], resized_shape), with_image=False,
+                                           stamp=SampleCache.stamp(data["image"], data["mask"], data["lane"]))
+
+        if cached is not None:
+            _, seg_fg, lane_fg, meta = cached
+            h0, w0 = meta['h0'], meta['w0']
+            h, w = meta['h'], meta['w']
+            ratio, pad = tuple(meta['ratio']), tuple(meta['pad'])
+        else:
+            _, seg_label, lane_label, (h0, w0), (h, w), ratio, pad = self.load_letterboxed(data, resized_shape, with_image=False)
+            seg_fg, lane_fg = self.threshold_labels(seg_label, lane_label)
+        shapes = (h0, w0), ((h / h0, w / w0), pad)
+
+        labels = self.normalize_labels(self.letterbox_labels(data["label"], (h, w), ratio, pad), lane_fg.shape[1:])
+        return self.build_target(labels, seg_fg, lane_fg), data["image"], shapes
+
+    def load_letterboxed(self, data, resized_shape, with_image=True):
+        """
+        Decode the image and both segmentation labels, resize and letterbox them
+
+        Inputs:
+        -with_image(bool): False skips the image, the geometry is then taken from the lane label
+
+        Returns:
+        -img, seg_label, lane_label: letterboxed uint8 arrays, img is None without with_image
+        -(h0, w0): original size, (h, w): resized size before padding
+        -ratio, pad: letterbox scale and padding
+        """
+        img = None
+        if with_image:
+            img = cv2.imread(data["image"], cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # seg_label = cv2.imread(data["mask"], 0)
+        if self.cfg.num_seg_class == 3:
+            seg_label = cv2.imread(data["mask"])
+        else:
+            seg_label = cv2.imread(data["mask"], 0)
+        lane_label = cv2.imread(data["lane"], 0)
+        h0, w0 = (img if with_image else lane_label).shape[:2]  # orig hw
+        r = resized_shape / max(h0, w0)  # resize image to img_size
+        if r != 1:  # always resize down, only resize up if training with augmentation
+            interp = cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR
+            if with_image:
+                img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+            seg_label = cv2.resize(seg_label, (int(w0 * r), int(h0 * r)), interpolation=interp)
+            lane_label = cv2.resize(lane_label, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        h, w = (img if with_image else lane_label).shape[:2]
+        
+        (img, seg_label, lane_label), ratio, pad = letterbox((img, seg_label, lane_label), resized_shape, auto=True, scaleup=self.is_train)
+        return img, seg_label, lane_label, (h0, w0), (h, w), ratio, pad
+
+    @staticmethod
+    def letterbox_labels(det_label, resized_hw, ratio, pad):
+        """
+        Normalized xywh det labels to pixel xyxy in the letterboxed image
+
+        Returns:
+        -labels: [n, 5] (cls, x1, y1, x2, y2), or [] without labels
+        """
+        h, w = resized_hw
+        labels = []
+        if det_label.size > 0:
+            labels = det_label.copy()
+            labels[:, 1] = ratio[0] * w * (det_label[:, 1] - det_label[:, 3] / 2) + pad[0]  # pad width
+            labels[:, 2] = ratio[1] * h * (det_label[:, 2] - det_label[:, 4] / 2) + pad[1]  # pad height
+            labels[:, 3] = ratio[0] * w * (det_label[:, 1] + det_label[:, 3] / 2) + pad[0]
+            labels[:, 4] = ratio[1] * h * (det_label[:, 2] + det_label[:, 4] / 2) + pad[1]
+        return labels
+
+    @staticmethod
+    def normalize_labels(labels, img_hw):
+        """
+        Pixel xyxy labels to xywh normalized by the letterboxed image size
+        """
+        if len(labels):
+            # convert xyxy to xywh
+            labels[:, 1:5] = xyxy2xywh(labels[:, 1:5])
+
+            # Normalize coordinates 0 - 1
+            labels[:, [2, 4]] /= img_hw[0]  # height
+            labels[:, [1, 3]] /= img_hw[1]  # width
+        return labels
+
+    def build_target(self, labels, seg_fg, lane_fg):
+        """
+        Returns:
+        -target: [det labels [n, 6], seg_label, lane_label], the segmentation targets as float one-hot
+         channels or bit-packed uint8 maps with compact_targets
+        """
+        labels_out = torch.zeros((len(labels), 6))
+        if len(labels):
+            labels_out[:, 1:] = torch.from_numpy(labels)
+
+        if self.cfg.num_seg_class == 3:
+            seg_channels = seg_fg
+        else:
+            seg_channels = (~seg_fg[0], seg_fg[0])
+        lane_channels = (~lane_fg[0], lane_fg[0])
+
+        if self.compact_targets:
+            seg_label = torch.from_numpy(self.pack_channels(seg_channels))
+            lane_label = torch.from_numpy(self.pack_channels(lane_channels))
+        else:
+            seg_label = torch.from_numpy(np.ascontiguousarray(np.stack(seg_channels, 0))).float()
+            lane_label = torch.from_numpy(np.ascontiguousarray(np.stack(lane_channels, 0))).float()
+        return [labels_out, seg_label, lane_label]
+
+    def threshold_labels(self, seg_label, lane_label):
+        """
+        Binarize the segmentation labels into foreground masks
+
+        Returns:
+        -seg_fg: bool [3, H, W] when num_seg_class == 3, else [1, H, W]
+        -lane_fg: bool [1, H, W]
+        """
+        if self.cfg.num_seg_class == 3:
+            seg_fg = np.stack((seg_label[:, :, 0] > 128, seg_label[:, :, 1] > 1, seg_label[:, :, 2] > 1), 0)
+        else:
+            seg_fg = (seg_label > 1)[None]
+        lane_fg = (lane_label > 1)[None]
+        return seg_fg, lane_fg
+
+    @staticmethod
+    def pack_channels(channels):
+        """
+        Pack per-class bool masks into one uint8 map where bit c is set iff channel c is 1
+        """
+        packed = np.zeros(channels[0].shape, dtype=np.uint8)
+        for c, mask in enumerate(channels):
+            packed |= mask.astype(np.uint8) << c
+        return np.ascontiguousarray(packed)
+
     def select_data(self, db):
         """
         You can use this function to filter useless images in the dataset
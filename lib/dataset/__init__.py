@@ -1,5 +1,7 @@
 from .bdd import BddDataset
 from .AutoDriveDataset import AutoDriveDataset
+from .adversarial_archive import AdversarialArchiveWriter, AdversarialDataset, archive_params
+from .uap_store import UAPStore, UAPDataset
 from .DemoDataset import LoadImages, LoadStreams
 
 #Adding Carla's stuff here:
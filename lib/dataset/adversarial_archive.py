@@ -0,0 +1,158 @@
+import json
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+ARCHIVE_DTYPES = ('float16', 'float32')
+
+
+class AdversarialArchiveWriter(object):
+    """
+    Chunked archive of perturbed input tensors
+
+    Images are stored exactly as they were fed to the model (letterboxed, normalized, [3, h, w])
+    in float32, or float16 to halve the size, so small-epsilon perturbations survive the round
+    trip that an 8-bit JPEG would destroy. Every chunk is a plain .npy file that readers
+    memory-map; index.jsonl maps each image id to its chunk, row, source path and attack params.
+    Index records are only written once their chunk is on disk, so an interrupted run leaves
+    a readable archive. Several runs can share one archive directory: chunk names carry a
+    per-writer run id and the records of every run are appended to the same index.
+    """
+    def __init__(self, archive_dir, dtype='float32', chunk_size=64):
+        assert dtype in ARCHIVE_DTYPES, f'unsupported archive dtype {dtype}'
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.archive_dir / 'index.jsonl'
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.run_id = uuid.uuid4().hex[:12]
+        self.chunk_id = 0
+        self.pending, self.records = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, images, paths, metadata=None):
+        """
+        Inputs:
+        -images: (tensor) [b, 3, h, w] perturbed model inputs, on any device
+        -paths: (list) source image paths, their stems are the image ids
+        -metadata: (dict) json-serialisable attack params shared by the batch
+        """
+        batch = images.detach().to('cpu', getattr(torch, self.dtype)).numpy()
+        for img, path in zip(batch, paths):
+            self.records.append({
+                'id': os.path.splitext(os.path.basename(path))[0],
+                'path': str(path),
+                'params': metadata or {}
+            })
+            self.pending.append(img)
+            if len(self.pending) == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        name = f'chunk_{self.run_id}_{self.chunk_id:05d}.npy'
+        np.save(self.archive_dir / name, np.stack(self.pending))
+        with open(self.index_path, 'a') as f:
+            for row, rec in enumerate(self.records):
+                f.write(json.dumps(dict(rec, chunk=name, row=row)) + '\n')
+        self.chunk_id += 1
+        self.pending, self.records = [], []
+
+    def close(self):
+        self.flush()
+
+
+def archive_params(archive_dir):
+    """
+    Distinct attack params recorded in an archive, one entry per attack run
+
+    Returns:
+    -params: (list) param dicts in the order they were first written, each selects its records in AdversarialArchive
+    """
+    params = []
+    with open(Path(archive_dir) / 'index.jsonl', 'r') as f:
+        for line in f:
+            rec_params = json.loads(line)['params']
+            if rec_params not in params:
+                params.append(rec_params)
+    return params
+
+
+class AdversarialArchive(object):
+    """
+    Read side of AdversarialArchiveWriter, chunks are memory-mapped on first access
+    """
+    def __init__(self, archive_dir, params=None):
+        """
+        Inputs:
+        -archive_dir: directory written by AdversarialArchiveWriter
+        -params: (dict) optional attack params, only records whose params contain them are kept
+        """
+        self.archive_dir = Path(archive_dir)
+        self.index = {}
+        with open(self.archive_dir / 'index.jsonl', 'r') as f:
+            for line in f:
+                rec = json.loads(line)
+                if params and any(rec['params'].get(k) != v for k, v in params.items()):
+                    continue
+                self.index[rec['id']] = rec  # the latest matching run wins
+        self._chunks = {}
+
+    def __getstate__(self):
+        # memory maps do not survive pickling into DataLoader workers; they are reopened lazily
+        state = self.__dict__.copy()
+        state['_chunks'] = {}
+        return state
+
+    def __contains__(self, image_id):
+        return image_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, image_id):
+        """
+        Returns:
+        -img: (tensor) [3, h, w] float32 model input, a view of the mapped chunk when stored as float32
+        -params: (dict) attack params of the image
+        """
+        rec = self.index[image_id]
+        chunk = self._chunks.get(rec['chunk'])
+        if chunk is None:
+            # copy-on-write mapping: zero-copy reads, and torch gets a writable buffer
+            chunk = self._chunks[rec['chunk']] = np.load(self.archive_dir / rec['chunk'], mmap_mode='c')
+        return torch.from_numpy(chunk[rec['row']]).float(), rec['params']
+
+
+class AdversarialDataset(Dataset):
+    """
+    Serve archived adversarial inputs with the targets of a validation dataset
+
+    Wraps an AutoDriveDataset and replaces the image of every sample found in the archive by its
+    stored perturbed tensor; samples missing from the archive are skipped. Targets come from
+    AutoDriveDataset.load_target, the clean image is never decoded.
+    """
+    def __init__(self, dataset, archive_dir, params=None):
+        self.dataset = dataset
+        self.archive = AdversarialArchive(archive_dir, params)
+        self.indices = [idx for idx, rec in enumerate(dataset.db)
+                        if os.path.splitext(os.path.basename(rec['image']))[0] in self.archive]
+        self.collate_fn = dataset.collate_fn
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        target, path, shapes = self.dataset.load_target(self.indices[idx])
+        img, _ = self.archive.get(os.path.splitext(os.path.basename(path))[0])
+        return img, target, path, shapes
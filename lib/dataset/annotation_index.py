@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+
+def fingerprint_tree(*roots, extra=None):
+    """
+    Fingerprint one or more annotation directories by the name, size and mtime of every entry.
+
+    Args:
+        roots (str or Path): Directories whose entries make up the fingerprint.
+        extra (dict, optional): Additional JSON-serialisable settings the database depends on.
+
+    Returns:
+        str: Hex digest that changes whenever a file is added, removed, resized or touched.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps(extra or {}, sort_keys=True).encode())
+    for root in roots:
+        h.update(str(root).encode())
+        entries = []
+        with os.scandir(root) as it:
+            for entry in it:
+                st = entry.stat()
+                entries.append((entry.name, st.st_size, st.st_mtime_ns))
+        entries.sort()
+        for name, size, mtime in entries:
+            h.update(f'{name}\0{size}\0{mtime}\n'.encode())
+    return h.hexdigest()
+
+
+def save_index(index_dir, fingerprint, gt_db):
+    """
+    Compile a database into an on-disk index of flat numpy arrays.
+
+    Args:
+        index_dir (str or Path): Directory the index is written to.
+        fingerprint (str): Fingerprint of the annotation tree the database was built from.
+        gt_db (list): Records with 'image', 'mask', 'lane' paths and an (n, 5) 'label' array.
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    counts = np.array([len(rec['label']) for rec in gt_db], dtype=np.int64)
+    offsets = np.zeros(len(gt_db) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    labels = [rec['label'] for rec in gt_db if len(rec['label'])]
+    boxes = np.concatenate(labels, 0) if labels else np.zeros((0, 5))
+
+    np.save(index_dir / 'boxes.npy', boxes.astype(np.float64))
+    np.save(index_dir / 'offsets.npy', offsets)
+    for key in ('image', 'mask', 'lane'):
+        np.save(index_dir / f'{key}.npy', np.array([rec[key] for rec in gt_db], dtype=str))
+
+    # The header is written last so a partially written index is never considered valid
+    header = {'version': INDEX_VERSION, 'fingerprint': fingerprint, 'size': len(gt_db)}
+    with open(index_dir / 'header.json', 'w') as f:
+        json.dump(header, f)
+
+
+def load_index(index_dir, fingerprint):
+    """
+    Load a compiled index if it exists and matches the current annotation tree.
+
+    Args:
+        index_dir (str or Path): Directory the index was written to.
+        fingerprint (str): Fingerprint of the current annotation tree.
+
+    Returns:
+        list or None: The database, with labels as views into the memory-mapped box array,
+        or None when the index is missing, stale or was written by another version.
+    """
+    index_dir = Path(index_dir)
+    try:
+        with open(index_dir / 'header.json', 'r') as f:
+            header = json.load(f)
+        if header.get('version') != INDEX_VERSION or header.get('fingerprint') != fingerprint:
+            return None
+        boxes = np.load(index_dir / 'boxes.npy', mmap_mode='r')
+        offsets = np.load(index_dir / 'offsets.npy')
+        paths = {key: np.load(index_dir / f'{key}.npy').tolist() for key in ('image', 'mask', 'lane')}
+    except (OSError, ValueError):
+        return None
+
+    if len(offsets) != header['size'] + 1:
+        return None
+
+    return [{
+        'image': paths['image'][i],
+        'label': boxes[offsets[i]:offsets[i + 1]],
+        'mask': paths['mask'][i],
+        'lane': paths['lane'][i]
+    } for i in range(header['size'])]
@@ -1,17 +1,20 @@
 import numpy as np
 import json
 import os
+from pathlib import Path
 
 from .AutoDriveDataset import AutoDriveDataset
+from .annotation_index import fingerprint_tree, load_index, save_index
 from .convert import convert, id_dict, id_dict_single
 from tqdm import tqdm
 
 single_cls = True       # just detect vehicle
 
 class BddDataset(AutoDriveDataset):
-    def __init__(self, cfg, is_train, inputsize, transform=None, validation_type = 'normal'):
-        super().__init__(cfg, is_train, inputsize, transform)
+    def __init__(self, cfg, is_train, inputsize, transform=None, validation_type = 'normal', use_index=True, cache_dir=None, compact_targets=False):
+        super().__init__(cfg, is_train, inputsize, transform, cache_dir=cache_dir, compact_targets=compact_targets)
         self.validation_type = validation_type  # Accomodates nomral validations, attack validations, and attack/defense validations
+        self.use_index = use_index  # Consult the compiled annotation index before parsing every JSON file
         self.db = self._get_db()
         self.cfg = cfg
         print(f"{self.validation_type}\n")
@@ -30,9 +33,24 @@ class BddDataset(AutoDriveDataset):
         mask: path of the segmetation label
         label: [cls_id, center_x//256, center_y//256, w//256, h//256] 256=IMAGE_SIZE
         """
+        height, width = self.shapes
+        if self.use_index:
+            indicator = os.path.relpath(self.label_root, self.cfg.DATASET.LABELROOT).replace(os.sep, '_')
+            index_dir = Path(self.cfg.DATASET.LABELROOT) / '.index' / f'{indicator}_{self.validation_type}'
+            fingerprint = fingerprint_tree(self.mask_root, self.label_root, extra={
+                'validation_type': self.validation_type,
+                'img_root': str(self.img_root),
+                'lane_root': str(self.lane_root),
+                'shapes': [int(height), int(width)],
+                'single_cls': single_cls
+            })
+            gt_db = load_index(index_dir, fingerprint)
+            if gt_db is not None:
+                print(f'loaded database index from {index_dir}')
+                return gt_db
+
         print('building database...')
         gt_db = []
-        height, width = self.shapes
         for mask in tqdm(list(self.mask_list)):
             mask_path = str(mask)
             label_path = mask_path.replace(str(self.mask_root), str(self.label_root)).replace(".png", ".json")
@@ -46,28 +64,7 @@ class BddDataset(AutoDriveDataset):
                 image_path = os.path.join(str(self.img_root), f"{base_name}.jpg")
                 
             lane_path = mask_path.replace(str(self.mask_root), str(self.lane_root))
-            with open(label_path, 'r') as f:
-                label = json.load(f)
-            data = label['frames'][0]['objects']
-            data = self.filter_data(data)
-            gt = np.zeros((len(data), 5))
-            for idx, obj in enumerate(data):
-                category = obj['category']
-                if category == "traffic light":
-                    color = obj['attributes']['trafficLightColor']
-                    category = "tl_" + color
-                if category in id_dict.keys():
-                    x1 = float(obj['box2d']['x1'])
-                    y1 = float(obj['box2d']['y1'])
-                    x2 = float(obj['box2d']['x2'])
-                    y2 = float(obj['box2d']['y2'])
-                    cls_id = id_dict[category]
-                    if single_cls:
-                         cls_id=0
-                    gt[idx][0] = cls_id
-                    box = convert((width, height), (x1, x2, y1, y2))
-                    gt[idx][1:] = list(box)
-                
+            gt = self.parse_label(label_path, width, height)
 
             rec = [{
                 'image': image_path,
@@ -78,8 +75,44 @@ class BddDataset(AutoDriveDataset):
 
             gt_db += rec
         print('database build finish')
+
+        if self.use_index:
+            try:
+                save_index(index_dir, fingerprint, gt_db)
+            except OSError as e:
+                print(f'WARNING: unable to save database index to {index_dir}: {e}')
         return gt_db
 
+    def parse_label(self, label_path, width, height):
+        """
+        Parse one det-annotation JSON file into normalized boxes
+
+        Returns:
+        gt: (np.ndarray) [n, 5] rows of [cls_id, center_x, center_y, w, h]
+        """
+        with open(label_path, 'r') as f:
+            label = json.load(f)
+        data = label['frames'][0]['objects']
+        data = self.filter_data(data)
+        gt = np.zeros((len(data), 5))
+        for idx, obj in enumerate(data):
+            category = obj['category']
+            if category == "traffic light":
+                color = obj['attributes']['trafficLightColor']
+                category = "tl_" + color
+            if category in id_dict.keys():
+                x1 = float(obj['box2d']['x1'])
+                y1 = float(obj['box2d']['y1'])
+                x2 = float(obj['box2d']['x2'])
+                y2 = float(obj['box2d']['y2'])
+                cls_id = id_dict[category]
+                if single_cls:
+                     cls_id=0
+                gt[idx][0] = cls_id
+                box = convert((width, height), (x1, x2, y1, y2))
+                gt[idx][1:] = list(box)
+        return gt
+
     def filter_data(self, data):
         remain = []
         for obj in data:
@@ -6,8 +6,8 @@ from .AutoDriveDataset import AutoDriveDataset
 
 
 class CarlaDataset(AutoDriveDataset):
-    def __init__(self, cfg, is_train, inputsize, transform=None):
-        super().__init__(cfg, is_train, inputsize, transform)
+    def __init__(self, cfg, is_train, inputsize, transform=None, cache_dir=None, compact_targets=False):
+        super().__init__(cfg, is_train, inputsize, transform, cache_dir=cache_dir, compact_targets=compact_targets)
         self.db = self._get_db()
         self.cfg = cfg
 
@@ -0,0 +1,129 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class SampleCache(object):
+    """
+    Append-only shard of pre-processed validation samples
+
+    Every record holds the letterboxed uint8 image, the bit-packed segmentation and lane
+    foreground masks and the letterbox geometry needed to rebuild `shapes` and the det labels.
+    Records live in one raw shard file that is memory-mapped for reads; a JSON-lines index maps
+    each key (image path and input size) to its offset. Records also carry the stamp (mtime and
+    size) of their source files, so a file replaced in place is decoded again instead of served
+    stale; the new record is appended and supersedes the old one. Populate it from a single process
+    (num_workers=0), which is how validation loaders are built in this repo.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_path = self.cache_dir / 'samples.bin'
+        self.index_path = self.cache_dir / 'index.jsonl'
+        self.index = {}
+        self._mm = None
+
+        shard_size = self.shard_path.stat().st_size if self.shard_path.exists() else 0
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # torn write from an interrupted run
+                    if rec['offset'] + sum(self._nbytes(rec)) <= shard_size:
+                        self.index[rec['key']] = rec
+
+    def __getstate__(self):
+        # memory maps do not survive pickling into DataLoader workers; they are reopened lazily
+        state = self.__dict__.copy()
+        state['_mm'] = None
+        return state
+
+    @staticmethod
+    def key(path, inputsize):
+        return f'{path}|{inputsize}'
+
+    @staticmethod
+    def stamp(*paths):
+        """
+        Returns:
+        -stamp: (list) [st_mtime_ns, st_size] of every path, None for a missing file
+        """
+        stamp = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamp.append(None)
+                continue
+            stamp.append([st.st_mtime_ns, st.st_size])
+        return stamp
+
+    @staticmethod
+    def _nbytes(rec):
+        n_img = int(np.prod(rec['img']))
+        n_seg = (int(np.prod(rec['seg'])) + 7) // 8
+        n_lane = (int(np.prod(rec['lane'])) + 7) // 8
+        return n_img, n_seg, n_lane
+
+    def _shard(self, end):
+        if self._mm is None or len(self._mm) < end:
+            self._mm = np.memmap(self.shard_path, dtype=np.uint8, mode='r')
+        return self._mm
+
+    def get(self, key, with_image=True, stamp=None):
+        """
+        Inputs:
+        -with_image(bool): False skips reading the image, img is then None
+        -stamp: (list) current SampleCache.stamp of the source files, a record with another stamp is a miss
+
+        Returns:
+        -None if the key is not cached or its sources changed, otherwise
+         (img, seg_fg, lane_fg, meta): uint8 HxWx3 image, bool CxHxW masks and the letterbox geometry
+        """
+        rec = self.index.get(key)
+        if rec is None or (stamp is not None and rec.get('stamp') != stamp):
+            return None
+        n_img, n_seg, n_lane = self._nbytes(rec)
+        start = rec['offset']
+        mm = self._shard(start + n_img + n_seg + n_lane)
+
+        img = np.array(mm[start:start + n_img]).reshape(rec['img']) if with_image else None
+        start += n_img
+        seg_fg = np.unpackbits(mm[start:start + n_seg], count=int(np.prod(rec['seg']))).reshape(rec['seg']).astype(bool)
+        start += n_seg
+        lane_fg = np.unpackbits(mm[start:start + n_lane], count=int(np.prod(rec['lane']))).reshape(rec['lane']).astype(bool)
+        return img, seg_fg, lane_fg, rec['meta']
+
+    def put(self, key, img, seg_fg, lane_fg, meta, stamp=None):
+        """
+        Append one sample to the shard
+
+        Inputs:
+        -img: letterboxed uint8 image (HxWx3)
+        -seg_fg, lane_fg: bool foreground masks (CxHxW)
+        -meta: (dict) json-serialisable letterbox geometry
+        -stamp: (list) SampleCache.stamp of the source files, taken before they were read
+        """
+        if key in self.index and self.index[key].get('stamp') == stamp:
+            return
+        with open(self.shard_path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+            f.write(np.packbits(seg_fg).tobytes())
+            f.write(np.packbits(lane_fg).tobytes())
+        rec = {
+            'key': key,
+            'offset': offset,
+            'img': list(img.shape),
+            'seg': list(seg_fg.shape),
+            'lane': list(lane_fg.shape),
+            'meta': meta,
+            'stamp': stamp
+        }
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+        self.index[key] = rec
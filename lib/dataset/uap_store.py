@@ -0,0 +1,76 @@
+import json
+from pathlib import Path
+
+import torch
+from torch.utils.data import Dataset
+
+
+class UAPStore(object):
+    """
+    Directory of named universal perturbations
+
+    Every UAP is saved as <name>.pt holding the [1, 3, h, w] perturbation and the attack params it
+    was trained with (eps, step_decay, ...), so one perturbation can be evaluated, defended or
+    compared across runs without training it again. index.jsonl lists the params of every name.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root / 'index.jsonl'
+
+    def __contains__(self, name):
+        return (self.root / f'{name}.pt').exists()
+
+    def names(self):
+        return sorted(p.stem for p in self.root.glob('*.pt'))
+
+    def save(self, name, uap, **metadata):
+        """
+        Inputs:
+        -name: (str) artifact name, the file stem
+        -uap: (tensor) [1, 3, h, w] or [3, h, w] perturbation, on any device
+        -metadata: json-serialisable attack params
+        """
+        uap = uap.detach().cpu().reshape(1, *uap.shape[-3:])
+        path = self.root / f'{name}.pt'
+        tmp_path = path.with_suffix('.pt.tmp')
+        torch.save({'uap': uap, 'metadata': metadata}, tmp_path)
+        tmp_path.replace(path)
+        with open(self.index_path, 'a') as f:
+            f.write(json.dumps({'name': name, 'shape': list(uap.shape), 'metadata': metadata}) + '\n')
+        return path
+
+    def load(self, name, device='cpu'):
+        """
+        Returns:
+        -uap: (tensor) [1, 3, h, w] perturbation
+        -metadata: (dict) attack params it was saved with
+        """
+        artifact = torch.load(self.root / f'{name}.pt', map_location=device)
+        return artifact['uap'], artifact['metadata']
+
+
+class UAPDataset(Dataset):
+    """
+    Apply a universal perturbation to the samples of a validation dataset as they are loaded
+
+    Wraps an AutoDriveDataset; every image is returned as clamp(img + uap, 0, 1), the same way
+    lib.core.Attacks.UAP trains the perturbation, while targets, paths and shapes are passed through.
+    Nothing but the perturbation itself is held in memory.
+    """
+    def __init__(self, dataset, uap):
+        """
+        Inputs:
+        -dataset: dataset yielding letterboxed (img, target, path, shapes) samples
+        -uap: (tensor) [1, 3, h, w] or [3, h, w] perturbation matching the letterboxed input size
+        """
+        self.dataset = dataset
+        self.uap = uap.detach().cpu().reshape(*uap.shape[-3:])
+        self.collate_fn = dataset.collate_fn
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img, target, path, shapes = self.dataset[idx]
+        return torch.clamp(img + self.uap, 0, 1), target, path, shapes
@@ -8,7 +8,7 @@ sys.path.append(os.getcwd())
 #sys.path.append("lib/models")
 #sys.path.append("lib/utils")
 #sys.path.append("/workspace/wh/projects/DaChuang")
-from lib.utils import initialize_weights
+from lib.utils import initialize_weights, fuse_conv_and_bn
 # from lib.models.common2 import DepthSeperabelConv2d as Conv
 # from lib.models.common2 import SPP, Bottleneck, BottleneckCSP, Focus, Concat, Detect
 from lib.models.common import Conv, SPP, Bottleneck, BottleneckCSP, Focus, Concat, Detect, SharpenConv
@@ -500,9 +500,11 @@ YOLOP = [
 [ -1, Conv, [8, 2, 3, 1]] #42 Lane line segmentation head
 ]
 
+TASKS = ('det', 'da', 'll')  # detection, drivable area and lane line heads, in output order
+
 
 class MCnet(nn.Module):
-    def __init__(self, block_cfg, **kwargs):
+    def __init__(self, block_cfg, tasks=None, **kwargs):
         super(MCnet, self).__init__()
         layers, save= [], []
         self.nc = 1
@@ -524,6 +526,8 @@ class MCnet(nn.Module):
 
         self.model, self.save = nn.Sequential(*layers), sorted(save)
         self.names = [str(i) for i in range(self.nc)]
+        self.tasks = TASKS if tasks is None else tuple(tasks)
+        self.plans = {}  # execution plan per requested task set, see _build_plan
 
         # set stride、anchor for detector
         Detector = self.model[self.detector_index]  # detector
@@ -532,7 +536,7 @@ class MCnet(nn.Module):
             # for x in self.forward(torch.zeros(1, 3, s, s)):
             #     print (x.shape)
             with torch.no_grad():
-                model_out = self.forward(torch.zeros(1, 3, s, s))
+                model_out = self.forward(torch.zeros(1, 3, s, s), tasks=('det',))
                 detects, _, _= model_out
                 Detector.stride = torch.tensor([s / x.shape[-2] for x in detects])  # forward
             # print("stride"+str(Detector.stride ))
@@ -543,26 +547,113 @@ class MCnet(nn.Module):
         
         initialize_weights(self)
 
-    def forward(self, x):
-        cache = []
-        out = []
-        det_out = None
-        Da_fmap = []
-        LL_fmap = []
+    def _build_plan(self, tasks=None):
+        """
+        Precompute the routing of forward() for a set of tasks
+
+        Inputs:
+        -tasks: subset of TASKS whose outputs are wanted, None for all of them
+
+        Returns:
+        -plan: one (i, src, keep, release, out_slot) tuple per block that has to run, where
+               src is None to feed the previous output, a cache index, or a tuple of cache indices
+               (None for the previous output) for multi-input blocks;
+               keep tells whether the output is cached for a later block;
+               release lists the cache indices whose last consumer is this block;
+               out_slot is the position of the output in the returned list (0 detection, then the
+               segmentation heads) or None
+        """
+        out_idx = [self.detector_index] + list(self.seg_out_idx)
+        tasks = TASKS if tasks is None else tasks
+        assert set(tasks) <= set(TASKS), f'unknown tasks {set(tasks) - set(TASKS)}, expected a subset of {TASKS}'
+        out_slots = {idx: k for k, (idx, task) in enumerate(zip(out_idx, TASKS)) if task in tasks}
+
+        srcs = []
         for i, block in enumerate(self.model):
-            if block.from_ != -1:
-                x = cache[block.from_] if isinstance(block.from_, int) else [x if j == -1 else cache[j] for j in block.from_]       #calculate concat detect
-            x = block(x)
-            if i in self.seg_out_idx:     #save driving area segment result
-                m=nn.Sigmoid()
-                out.append(m(x))
-            if i == self.detector_index:
-                det_out = x
-            cache.append(x if block.index in self.save else None)
-        out.insert(0,det_out)
+            from_ = block.from_
+            if isinstance(from_, int):
+                srcs.append(None if from_ == -1 else from_ % i)
+            else:
+                srcs.append(tuple(None if j == -1 else j % i for j in from_))
+
+        # walk back from the requested heads to the blocks they depend on
+        needed, stack = set(), list(out_slots)
+        while stack:
+            i = stack.pop()
+            if i in needed:
+                continue
+            needed.add(i)
+            src = srcs[i]
+            for j in (src if isinstance(src, tuple) else (src,)):
+                if j is not None or i > 0:  # the first block reads the input image
+                    stack.append(i - 1 if j is None else j)
+
+        last_use = {}
+        for i in sorted(needed):
+            src = srcs[i]
+            for j in (src if isinstance(src, tuple) else (src,)):
+                if j is not None:
+                    last_use[j] = i
+
+        plan = []
+        for i in sorted(needed):
+            release = tuple(j for j, last in last_use.items() if last == i)
+            plan.append((i, srcs[i], i in last_use, release, out_slots.get(i)))
+        return plan
+
+    def forward(self, x, tasks=None):
+        """
+        Inputs:
+        -x: input images
+        -tasks: subset of TASKS ('det', 'da', 'll') to compute, defaults to self.tasks (all heads);
+                only the encoder and the branches of the requested heads are run
+
+        Returns:
+        -[det_out, da_seg_out, ll_seg_out], None in place of every head that was not requested
+        """
+        tasks = self.tasks if tasks is None else tuple(tasks)
+        plan = self.plans.get(tasks)
+        if plan is None:
+            plan = self.plans[tasks] = self._build_plan(tasks)
+        blocks = list(self.model)
+        cache = {}
+        out = [None] * (len(self.seg_out_idx) + 1)
+        for i, src, keep, release, out_slot in plan:
+            if src is not None:
+                x = cache[src] if isinstance(src, int) else [x if j is None else cache[j] for j in src]       #calculate concat detect
+            x = blocks[i](x)
+            for j in release:     # last consumer ran, free the feature map
+                del cache[j]
+            if keep:
+                cache[i] = x
+            if out_slot is not None:
+                out[out_slot] = x if out_slot == 0 else torch.sigmoid(x)     #segment results go through a sigmoid
         return out
-            
-    
+
+    def fuse(self):
+        """
+        Fold every BatchNorm into its convolution for inference
+
+        Covers Conv and SharpenConv (also inside Focus, SPP and Bottleneck) and the BatchNorm that
+        BottleneckCSP applies to cat(cv3, cv2). The fused blocks switch to their fuseforward, the
+        model is put in eval mode and gradients w.r.t. the input still work for the attacks.
+        The fused model is for evaluation only, it cannot be trained further.
+        """
+        self.eval()
+        with torch.no_grad():
+            for m in self.model.modules():
+                if isinstance(m, (Conv, SharpenConv)) and hasattr(m, 'bn'):
+                    m.conv = fuse_conv_and_bn(m.conv, m.bn)
+                    delattr(m, 'bn')
+                    m.forward = m.fuseforward
+                elif isinstance(m, BottleneckCSP) and hasattr(m, 'bn'):
+                    c_ = m.cv3.out_channels
+                    m.cv3 = fuse_conv_and_bn(m.cv3, m.bn, slice(0, c_))
+                    m.cv2 = fuse_conv_and_bn(m.cv2, m.bn, slice(c_, 2 * c_))
+                    delattr(m, 'bn')
+                    m.forward = m.fuseforward
+        return self
+
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
         # cf = torch.bincount(torch.tensor(np.concatenate(dataset.labels, 0)[:, 0]).long(), minlength=nc) + 1.
@@ -574,12 +665,48 @@ class MCnet(nn.Module):
             b.data[:, 5:] += math.log(0.6 / (m.nc - 0.99)) if cf is None else torch.log(cf / cf.sum())  # cls
             mi.bias = torch.nn.Parameter(b.view(-1), requires_grad=True)
 
-def get_net(cfg, **kwargs): 
+def get_net(cfg, tasks=None, **kwargs): 
     m_block_cfg = YOLOP
-    model = MCnet(m_block_cfg, **kwargs)
+    model = MCnet(m_block_cfg, tasks=tasks, **kwargs)
     return model
 
 
+class _TupleOutputs(nn.Module):
+    # MCnet returns lists, torch.jit.trace only accepts (nested) tuples of tensors
+    def __init__(self, model):
+        super(_TupleOutputs, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        (inf_out, train_out), da_seg_out, ll_seg_out = self.model(x)
+        return (inf_out, tuple(train_out)), da_seg_out, ll_seg_out
+
+
+def compile_net(model, mode=None, example_input=None):
+    """
+    Optionally compile an (already fused) MCnet for inference
+
+    Inputs:
+    -model: MCnet, normally after load_state_dict and fuse()
+    -mode: None (return the model), 'jit' (torch.jit.trace on example_input, the detection grids are
+           fixed to its resolution) or 'compile' (torch.compile)
+    -example_input: input tensor traced by 'jit'
+
+    Returns:
+    -model: callable with the MCnet outputs. A traced model no longer exposes MCnet attributes such as
+            names or nc, so it only fits pure inference loops like tools/demo.py
+    """
+    if mode is None:
+        return model
+    if mode == 'jit':
+        assert example_input is not None, 'torch.jit.trace needs an example input'
+        with torch.no_grad():
+            return torch.jit.trace(_TupleOutputs(model).eval(), example_input)
+    if mode == 'compile':
+        return torch.compile(model)
+    raise ValueError(f'unknown compile mode {mode}')
+
+
 if __name__ == "__main__":
     from torch.utils.tensorboard import SummaryWriter
     model = get_net(False)
@@ -1 +1 @@
-from .YOLOP import get_net
+from .YOLOP import get_net, compile_net
@@ -131,6 +131,12 @@ class BottleneckCSP(nn.Module):
         y2 = self.cv2(x)
         return self.cv4(self.act(self.bn(torch.cat((y1, y2), dim=1))))
 
+    def fuseforward(self, x):
+        # self.bn folded into cv3 (first half of the channels) and cv2 (second half)
+        y1 = self.cv3(self.m(self.cv1(x)))
+        y2 = self.cv2(x)
+        return self.cv4(self.act(torch.cat((y1, y2), dim=1)))
+
 
 class SPP(nn.Module):
     # Spatial pyramid pooling layer used in YOLOv3-SPP
@@ -179,7 +185,8 @@ class Detect(nn.Module):
         self.no = nc + 5  # number of outputs per anchor 85
         self.nl = len(anchors)  # number of detection layers 3
         self.na = len(anchors[0]) // 2  # number of anchors 3
-        self.grid = [torch.zeros(1)] * self.nl  # init grid 
+        self.decode_cache = {}  # (layer, ny, nx, device, dtype) -> device-resident decode constants
+        self.cache_version = None  # anchor_grid version the cache was built for
         a = torch.tensor(anchors).float().view(self.nl, -1, 2)
         self.register_buffer('anchors', a)  # shape(nl,na,2)
         self.register_buffer('anchor_grid', a.clone().view(self.nl, 1, -1, 1, 1, 2))  # shape(nl,1,na,1,1,2)
@@ -196,24 +203,53 @@ class Detect(nn.Module):
             # print(str(i)+str(x[i].shape))
 
             if not self.training:  # inference
-                if self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i] = self._make_grid(nx, ny).to(x[i].device)
+                xy_offset, xy_gain, wh_gain = self._decode_constants(i, ny, nx, x[i].device, x[i].dtype)
                 y = x[i].sigmoid()
                 #print("**")
                 #print(y.shape) #[1, 3, w, h, 85]
-                #print(self.grid[i].shape) #[1, 3, w, h, 2]
-                y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i].to(x[i].device)) * self.stride[i]  # xy
-                y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
+                # (y * 2 - 0.5 + grid) * stride and (y * 2) ** 2 * anchor_grid, with the constants folded in
+                y[..., 0:2] = torch.addcmul(xy_offset, y[..., 0:2], xy_gain)  # xy
+                y[..., 2:4] = y[..., 2:4].square() * wh_gain  # wh
                 """print("**")
                 print(y.shape)  #[1, 3, w, h, 85]
                 print(y.view(bs, -1, self.no).shape) #[1, 3*w*h, 85]"""
                 z.append(y.view(bs, -1, self.no))
         return x if self.training else (torch.cat(z, 1), x)
 
+    def _decode_constants(self, i, ny, nx, device, dtype):
+        """
+        Inputs:
+        -i: detection layer
+        -ny, nx: feature map size of the layer
+        -device, dtype: of the layer output
+
+        Returns:
+        -xy_offset: (tensor) (grid - 0.5) * stride, shape (1, 1, ny, nx, 2)
+        -xy_gain: (tensor) 2 * stride, 0-dim
+        -wh_gain: (tensor) 4 * anchor_grid of the layer, shape (1, na, 1, 1, 2)
+
+        Built once per resolution, device and dtype and reused afterwards, so inputs of alternating
+        sizes don't rebuild grids or copy them to the device on every call. The cache is dropped
+        whenever the anchors change (load_state_dict, autoanchor).
+        """
+        if self.cache_version != self.anchor_grid._version:
+            self.decode_cache.clear()
+            self.cache_version = self.anchor_grid._version
+        key = (i, ny, nx, device, dtype)
+        constants = self.decode_cache.get(key)
+        if constants is None:
+            stride = float(self.stride[i])
+            grid = self._make_grid(nx, ny, device=device).to(dtype)
+            constants = ((grid - 0.5) * stride,
+                         torch.tensor(2 * stride, device=device, dtype=dtype),
+                         (self.anchor_grid[i] * 4).to(device, dtype))
+            self.decode_cache[key] = constants
+        return constants
+
     @staticmethod
-    def _make_grid(nx=20, ny=20):
+    def _make_grid(nx=20, ny=20, device=None):
         
-        yv, xv = torch.meshgrid([torch.arange(ny), torch.arange(nx)])
+        yv, xv = torch.meshgrid([torch.arange(ny, device=device), torch.arange(nx, device=device)])
         return torch.stack((xv, yv), 2).view((1, 1, ny, nx, 2)).float()
 
 
@@ -153,6 +153,22 @@ def initialize_weights(model):
             m.inplace = True
 
 
+def fuse_conv_and_bn(conv, bn, out_slice=slice(None)):
+    # Fold an eval-mode BatchNorm2d (or the out_slice channels of it) into the preceding Conv2d
+    # https://tehnokv.com/posts/fusing-batchnorm-and-conv/
+    fusedconv = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size, stride=conv.stride,
+                          padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True
+                          ).requires_grad_(False).to(conv.weight.device)
+
+    w_bn = bn.weight[out_slice] / torch.sqrt(bn.eps + bn.running_var[out_slice])
+    fusedconv.weight.copy_(conv.weight * w_bn.view(-1, 1, 1, 1))
+
+    b_conv = torch.zeros(conv.out_channels, device=conv.weight.device) if conv.bias is None else conv.bias
+    b_bn = bn.bias[out_slice] - w_bn * bn.running_mean[out_slice]
+    fusedconv.bias.copy_(w_bn * b_conv + b_bn)
+    return fusedconv
+
+
 def xyxy2xywh(x):
     # Convert nx4 boxes from [x1, y1, x2, y2] to [x, y, w, h] where xy1=top-left, xy2=bottom-right
     y = x.clone() if isinstance(x, torch.Tensor) else np.copy(x)
@@ -0,0 +1,99 @@
+import json
+import os
+import queue
+import threading
+
+import cv2
+import torch
+
+METADATA_JSONL = 'metadata.jsonl'
+
+
+class AsyncImageWriter(object):
+    """
+    Persist batches of images and their metadata from background threads
+
+    submit() converts the batch to uint8 HWC on its device, starts a non-blocking copy into a
+    pinned host tensor and hands it to a pool of writer threads, so the caller only waits when
+    max_pending batches are already queued (back-pressure). Every batch adds one record, with the
+    names of its images, to a JSON-lines metadata file instead of one JSON file per image.
+    """
+    def __init__(self, save_dir, num_workers=4, max_pending=4, metadata_name=METADATA_JSONL):
+        self.save_dir = save_dir
+        self.metadata_path = os.path.join(save_dir, metadata_name)
+        os.makedirs(save_dir, exist_ok=True)
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.error = None
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(num_workers)]
+        for t in self.threads:
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, images, paths, metadata=None):
+        """
+        Queue one batch for writing
+
+        Inputs:
+        -images: (tensor) [b, 3, h, w] images in [0, 1], on any device
+        -paths: (list) source image paths, their stems name the written files
+        -metadata: (dict) json-serialisable record shared by the whole batch
+        """
+        self._raise_error()
+        batch = (images.detach() * 255).to(torch.uint8).permute(0, 2, 3, 1)
+        done = None
+        if batch.is_cuda:
+            host = torch.empty(batch.shape, dtype=torch.uint8, pin_memory=True)
+            host.copy_(batch, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+        else:
+            host = batch.contiguous()
+        self.queue.put((host, done, list(paths), metadata))  # blocks while max_pending batches are in flight
+
+    def close(self):
+        """
+        Wait for every queued batch to be written and stop the workers
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = self.error or e
+
+    def _write(self, host, done, paths, metadata):
+        if done is not None:
+            done.synchronize()  # wait for the device->host copy of this batch only
+        names = []
+        for img_np, path in zip(host.numpy(), paths):
+            img_filename = os.path.splitext(os.path.basename(path))[0]
+            cv2.imwrite(os.path.join(self.save_dir, f'{img_filename}.jpg'), img_np)
+            names.append(img_filename)
+
+        if metadata is not None:
+            record = dict(metadata, images=names)
+            with self.lock:
+                with open(self.metadata_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
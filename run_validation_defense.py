@@ -1,6 +1,5 @@
 import argparse
 import os
-import json
 import pprint
 import torch
 import torch.nn.parallel
@@ -14,7 +13,9 @@ import lib.dataset as dataset
 from lib.config import cfg
 from lib.config import update_config
 from lib.core.loss import get_loss
-from lib.core.function import validate
+from lib.core.function import validate, validate_sweep
+from lib.core.Defenses.PreProcessing import build_defenses
+from lib.core.defended_manifest import build_manifest
 from lib.models import get_net
 from lib.utils.utils import create_logger, select_device
 import pandas as pd
@@ -52,10 +53,57 @@ def parse_args():
                         help='early stopping threshold for total loss',
                         type=float,
                         default= .65)  
+    parser.add_argument('--adversarial_archive',
+                        help='tensor archive written by validate(archive_dtype=...), e.g. the --archive_dir of tools/test.py; '
+                             'every attack run in it is evaluated under every --stream_defenses chain instead of reading DefendedImages',
+                        type=str,
+                        default=None)
     parser.add_argument('--batch_size',
                         help='number of combinations to process in each batch',
                         type=int,
                         default=10)
+    parser.add_argument('--no_fuse',
+                        help='keep BatchNorm layers separate from the convolutions',
+                        action='store_true')
+    parser.add_argument('--stream',
+                        help='evaluate the attack x defense matrix in memory on the clean split instead of reading DefendedImages',
+                        action='store_true')
+    parser.add_argument('--stream_attacks',
+                        help='attacks of the streamed matrix (default: FGSM, CCP, JSMA, plus UAP when --uap_store is given)',
+                        nargs='+',
+                        choices=['FGSM', 'CCP', 'JSMA', 'UAP'],
+                        default=None)
+    parser.add_argument('--stream_epsilons',
+                        help='FGSM/CCP epsilons of the streamed matrix',
+                        nargs='+',
+                        type=float,
+                        default=[0.01, 0.05, 0.1])
+    parser.add_argument('--stream_channels',
+                        help='CCP color channels of the streamed matrix',
+                        nargs='+',
+                        choices=['R', 'G', 'B'],
+                        default=['R', 'G', 'B'])
+    parser.add_argument('--stream_num_pixels',
+                        help='JSMA pixels per image of the streamed matrix',
+                        type=int,
+                        default=100)
+    parser.add_argument('--stream_perturb_value',
+                        help='JSMA perturbation value of the streamed matrix',
+                        type=float,
+                        default=0.5)
+    parser.add_argument('--stream_defenses',
+                        help='defenses of the streamed matrix (and of --adversarial_archive) as name:value, chained with "+", '
+                             'e.g. none resize:320x192 jpeg:75 gauss:5x5 noise:8 bit_depth:4 jpeg:75+gauss:3x3',
+                        nargs='+',
+                        default=['none', 'resize:320x192', 'jpeg:75', 'gauss:5x5', 'noise:8', 'bit_depth:4'])
+    parser.add_argument('--uap_store',
+                        help='directory of UAP artifacts (lib.dataset.UAPStore) evaluated by the streamed matrix',
+                        type=str,
+                        default=None)
+    parser.add_argument('--max_batches',
+                        help='stop the streamed matrix after this many batches',
+                        type=int,
+                        default=None)
     return parser.parse_args()
 
 def read_attacked_metrics(csv_paths):
@@ -75,7 +123,83 @@ def read_attacked_metrics(csv_paths):
         combined_df = pd.concat([combined_df, df], ignore_index=True)
     return combined_df
 
-def run_validation(cfg, args, attack_params, defense_params, baseline=False):
+class SweepEngine(object):
+    """
+    Resources shared by every combination of a validation sweep.
+
+    The model, checkpoint and criterion are loaded once and stay resident; datasets are built
+    once per (test set, validation type) and reused, so a combination only swaps the dataset view.
+    """
+    def __init__(self, cfg, args, logger=None):
+        """
+        Args:
+            cfg: Configuration object.
+            args: Parsed command line arguments.
+            logger: Optional logger for device and checkpoint messages.
+        """
+        self.args = args
+        self.device = select_device(logger, batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * len(cfg.GPUS)) if not cfg.DEBUG else select_device(logger, 'cpu')
+        self.model = self.load_model(cfg, args.weights[0], logger)
+        self.criterion = get_loss(cfg, device=self.device)
+        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        self.datasets = {}
+
+    def load_model(self, cfg, checkpoint_file, logger=None):
+        """
+        Build the network and load the checkpoint once for the whole sweep.
+
+        Returns:
+            model: Network on self.device with the checkpoint weights loaded.
+        """
+        model = get_net(cfg)
+        model_dict = model.state_dict()
+        if logger:
+            logger.info(f"=> loading checkpoint '{checkpoint_file}'")
+        checkpoint = torch.load(checkpoint_file, map_location=self.device)
+        checkpoint_dict = checkpoint['state_dict']
+        model_dict.update(checkpoint_dict)
+        model.load_state_dict(model_dict)
+        if logger:
+            logger.info(f"=> loaded checkpoint '{checkpoint_file}'")
+
+        model = model.to(self.device)
+        if not self.args.no_fuse:
+            model.fuse()  # BatchNorm folded into the convolutions for evaluation
+        model.gr = 1.0
+        model.nc = 1
+        return model
+
+    def dataset(self, cfg, validation_type, archive_params=None):
+        """
+        Return the dataset view for one combination, building it only on first use.
+
+        Args:
+            cfg: Configuration object with DATASET.TEST_SET set for the combination.
+            validation_type (str): 'normal', 'attack' or 'defense'.
+            archive_params (dict): Attack parameters selecting records of --adversarial_archive, whose
+                tensors then replace the images of the dataset.
+
+        Returns:
+            Dataset: The validation dataset for the combination.
+        """
+        key = (cfg.DATASET.TEST_SET, validation_type)
+        if key not in self.datasets:
+            self.datasets[key] = eval('dataset.' + cfg.DATASET.DATASET)(
+                cfg=cfg,
+                is_train=False,
+                inputsize=cfg.MODEL.IMAGE_SIZE,
+                transform=transforms.Compose([transforms.ToTensor(), self.normalize]),
+                validation_type = validation_type
+            )
+        valid_dataset = self.datasets[key]
+
+        if archive_params is not None and self.args.adversarial_archive:
+            # read the exact perturbed tensors instead of re-decoding 8-bit images
+            valid_dataset = dataset.AdversarialDataset(valid_dataset, self.args.adversarial_archive, params=archive_params)
+        return valid_dataset
+
+
+def run_validation(cfg, args, attack_params, defense_params, baseline=False, engine=None):
     """
     Run the validation process for a given configuration, attack, and defense.
 
@@ -83,12 +207,16 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
         cfg: Configuration object.
         args: Parsed command line arguments.
         attack_params (dict): Parameters of the attack.
-        defense_params (str): Parameters of the defense.
+        defense_params (str): Parameters of the defense; with --adversarial_archive a --stream_defenses
+            spec applied in-line to the archived attacked batches.
         baseline (bool): Whether to run baseline validation.
+        engine (SweepEngine): Resident model, criterion and datasets; built on the spot if None.
 
     Returns:
         dict: Results of the validation.
     """
+    archive_params = None
+    defenses = None
     if baseline:
         cfg.defrost()
         cfg.DATASET.TEST_SET = 'val'
@@ -96,6 +224,16 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
         validation_type = 'normal'
         attack_type = 'Baseline'
         defense_type = 'None'
+    elif args.adversarial_archive:
+        # attacked inputs of the clean split come from the archive, the defense chain runs in-line
+        cfg.defrost()
+        cfg.DATASET.TEST_SET = 'val'
+        cfg.freeze()
+        validation_type = 'normal'
+        attack_type = attack_params['attack_type']
+        defense_type = defense_params
+        archive_params = attack_params
+        defenses = parse_defense(defense_params)
     else:
         attack_type = attack_params['attack_type']
         defense_type = defense_params
@@ -123,32 +261,11 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
         'valid_global_steps': 0,
     }
 
-    device = select_device(logger, batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * len(cfg.GPUS)) if not cfg.DEBUG else select_device(logger, 'cpu')
-    model = get_net(cfg)
-    criterion = get_loss(cfg, device=device)
-
-    model_dict = model.state_dict()
-    checkpoint_file = args.weights[0]
-    logger.info(f"=> loading checkpoint '{checkpoint_file}'")
-    checkpoint = torch.load(checkpoint_file)
-    checkpoint_dict = checkpoint['state_dict']
-    model_dict.update(checkpoint_dict)
-    model.load_state_dict(model_dict)
-    logger.info(f"=> loaded checkpoint '{checkpoint_file}'")
-
-    model = model.to(device)
-    model.gr = 1.0
-    model.nc = 1
-
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-
-    valid_dataset = eval('dataset.' + cfg.DATASET.DATASET)(
-        cfg=cfg,
-        is_train=False,
-        inputsize=cfg.MODEL.IMAGE_SIZE,
-        transform=transforms.Compose([transforms.ToTensor(), normalize]),
-        validation_type = validation_type
-    )
+    if engine is None:
+        engine = SweepEngine(cfg, args, logger)
+    device, model, criterion = engine.device, engine.model, engine.criterion
+
+    valid_dataset = engine.dataset(cfg, validation_type, archive_params)
 
     valid_loader = DataLoaderX(
         valid_dataset,
@@ -156,7 +273,7 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
         shuffle=False,
         num_workers=0,
         pin_memory=False,
-        collate_fn=dataset.AutoDriveDataset.collate_fn
+        collate_fn=valid_dataset.collate_fn
     )
 
     epoch = 0
@@ -166,7 +283,8 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
     da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
         epoch, cfg, valid_loader, valid_dataset, model, criterion,
         output_dir=final_output_dir, tb_log_dir=tb_log_dir, writer_dict=writer_dict,
-        logger=logger, device=device, perturbed_images=perturbed_images if validation_type == 'attack' else None
+        logger=logger, device=device, perturbed_images=perturbed_images if validation_type == 'attack' else None,
+        defenses=defenses
     )
 
     msg = ('Test:    Loss({loss:.3f})\n'
@@ -180,6 +298,7 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
         t_inf=times[0], t_nms=times[1])
 
     logger.info(msg)
+    writer_dict['writer'].close()
     
     return {
         'attack_type': attack_type,
@@ -200,6 +319,160 @@ def run_validation(cfg, args, attack_params, defense_params, baseline=False):
         't_nms': times[1]
     }
 
+def parse_defense(spec):
+    """
+    Build the defense chain of one --stream_defenses entry.
+
+    Args:
+        spec (str): 'none' or name:value pairs chained with '+', names being resize, jpeg, gauss, noise and bit_depth.
+
+    Returns:
+        list: Chain from build_defenses, empty for 'none'.
+    """
+    kwargs = {}
+    for part in spec.split('+'):
+        if part.lower() == 'none':
+            continue
+        name, value = part.split(':')
+        if name == 'resize':
+            kwargs['resizer'] = value
+        elif name == 'jpeg':
+            kwargs['quality'] = int(value)
+        elif name == 'gauss':
+            kwargs['gauss'] = value
+        elif name == 'noise':
+            kwargs['noise_sigma'] = float(value)
+        elif name == 'bit_depth':
+            kwargs['bits'] = int(value)
+        else:
+            raise ValueError(f'unknown defense {name} in {spec}')
+    return build_defenses(**kwargs)
+
+def build_stream_matrix(args):
+    """
+    List the points of the streamed attack x defense matrix.
+
+    Args:
+        args: Parsed command line arguments.
+
+    Returns:
+        list: validate_sweep points, the clean and undefended baseline first.
+
+    Raises:
+        ValueError: If UAP is requested without a --uap_store holding at least one UAP.
+    """
+    stream_attacks = args.stream_attacks
+    if stream_attacks is None:
+        stream_attacks = ['FGSM', 'CCP', 'JSMA'] + (['UAP'] if args.uap_store else [])
+
+    attacks = []
+    for attack_type in stream_attacks:
+        if attack_type == 'FGSM':
+            attacks += [{'attack_type': 'FGSM', 'epsilon': epsilon} for epsilon in args.stream_epsilons]
+        elif attack_type == 'CCP':
+            attacks += [{'attack_type': 'CCP', 'epsilon': epsilon, 'channel': channel}
+                        for epsilon in args.stream_epsilons for channel in args.stream_channels]
+        elif attack_type == 'JSMA':
+            attacks.append({'attack_type': 'JSMA', 'epsilon': args.stream_perturb_value, 'num_pixels': args.stream_num_pixels,
+                            'perturb_value': args.stream_perturb_value, 'perturb_type': 'add'})
+        elif attack_type == 'UAP':
+            if not args.uap_store:
+                raise ValueError('UAP in --stream_attacks needs --uap_store')
+            store = dataset.UAPStore(args.uap_store)
+            if not store.names():
+                raise ValueError(f'no UAP found in {args.uap_store}')
+            for name in store.names():
+                uap, metadata = store.load(name)
+                attacks.append({'attack_type': 'UAP', 'epsilon': metadata.get('eps'), 'uap': uap, 'uap_name': name})
+
+    matrix = [{'attack_type': 'None', 'defense_spec': 'none', 'defenses': []}]
+    for spec in args.stream_defenses:
+        chain = parse_defense(spec)
+        matrix += [dict(attack, defense_spec=spec, defenses=chain) for attack in attacks]
+    return matrix
+
+def run_streaming(cfg, args, engine):
+    """
+    Evaluate the whole attack x defense matrix in one pass over the clean validation split.
+
+    Every batch is attacked and defended in memory for every point (see validate_sweep), so no
+    perturbed or defended image is written and nothing has to be reorganised on disk.
+
+    Args:
+        cfg: Configuration object.
+        args: Parsed command line arguments.
+        engine (SweepEngine): Resident model, criterion and datasets.
+
+    Returns:
+        list: Result dicts in the format of run_validation, the baseline labelled 'Baseline'.
+    """
+    cfg.defrost()
+    cfg.DATASET.TEST_SET = 'val'
+    cfg.freeze()
+    logger, final_output_dir, tb_log_dir = create_logger(cfg, cfg.LOG_DIR, 'test', attack_type='Matrix', defense_type='Matrix')
+
+    valid_dataset = engine.dataset(cfg, 'normal')
+    valid_loader = DataLoaderX(
+        valid_dataset,
+        batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * len(cfg.GPUS),
+        shuffle=False,
+        num_workers=0,
+        pin_memory=False,
+        collate_fn=valid_dataset.collate_fn
+    )
+
+    matrix = build_stream_matrix(args)
+    logger.info(f'Streaming {len(matrix)} attack x defense combinations')
+    sweep_results = validate_sweep(
+        0, cfg, valid_loader, valid_dataset, engine.model, engine.criterion, final_output_dir,
+        matrix, attack_type='None', logger=logger, device=engine.device, max_batches=args.max_batches
+    )
+
+    results = []
+    for params, (da_segment_results, ll_segment_results, detect_results, total_loss, maps, times) in zip(matrix, sweep_results):
+        baseline = params['attack_type'] == 'None'
+        results.append({
+            'attack_type': 'Baseline' if baseline else params['attack_type'],
+            'attack_params': {} if baseline else {k: params.get(k) for k in ('epsilon', 'channel', 'num_pixels', 'uap_name') if params.get(k) is not None},
+            'defense_type': params['defense_spec'],
+            'total_loss': total_loss,
+            'da_seg_acc': da_segment_results[0],
+            'da_seg_iou': da_segment_results[1],
+            'da_seg_miou': da_segment_results[2],
+            'll_seg_acc': ll_segment_results[0],
+            'll_seg_iou': ll_segment_results[1],
+            'll_seg_miou': ll_segment_results[2],
+            'p': detect_results[0],
+            'r': detect_results[1],
+            'map50': detect_results[2],
+            'map': detect_results[3],
+            't_inf': times[0],
+            't_nms': times[1]
+        })
+    return results
+
+def run_archived(cfg, args, engine):
+    """
+    Evaluate every attack run of --adversarial_archive under every --stream_defenses chain.
+
+    The attacked inputs are read back losslessly from the archive and defended in-line by validate,
+    so no perturbed or defended image is decoded from disk.
+
+    Args:
+        cfg: Configuration object.
+        args: Parsed command line arguments.
+        engine (SweepEngine): Resident model, criterion and datasets.
+
+    Returns:
+        list: Result dicts of run_validation, one per attack run and defense chain.
+    """
+    results = []
+    for attack_params in dataset.archive_params(args.adversarial_archive):
+        for spec in args.stream_defenses:
+            print(f"\nRunning validation for archived {attack_params} with {spec} defense\n")
+            results.append(run_validation(cfg, args, attack_params, spec, engine=engine))
+    return results
+
 def save_results(results, file_name, directory='.'):
     """
     Save results to a CSV file.
@@ -308,6 +581,19 @@ def plot_performance_by_attack(df, metric, title_template, y_label, filename_tem
         plt.show()
         plt.close()
 
+def plot_results(df_results, save_dir, timestamp):
+    """
+    Plot every metric by attack type.
+
+    Args:
+        df_results (pd.DataFrame): DataFrame containing the results.
+        save_dir (str): Directory the plots are saved to.
+        timestamp (str): Identifier of the run used in the file names.
+    """
+    metrics = ['da_seg_acc', 'da_seg_iou', 'da_seg_miou', 'll_seg_acc', 'll_seg_iou', 'll_seg_miou', 'p', 'r', 'map50', 'map']
+    for metric in metrics:
+        plot_performance_by_attack(df_results, metric, '{} - {}'.format(metric.upper(), metric.replace('_', ' ').title()), metric.replace('_', ' ').title(), os.path.join(save_dir, '{}_{}_performance_'.format(metric, '{}') + timestamp + '.png'))
+
 def main():
     """
     Main function to run the validation process.
@@ -324,12 +610,28 @@ def main():
     # Create a unique identifier for the current run
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
 
+    if args.stream:
+        # attack -> defense -> evaluate in memory, no DefendedImages round-trip
+        engine = SweepEngine(cfg, args)
+        results = run_streaming(cfg, args, engine)
+        save_results(results, f'validation_results_{timestamp}.csv', save_dir)
+        plot_results(pd.DataFrame(results), save_dir, timestamp)
+        return
+
+    if args.adversarial_archive:
+        # archived attacked tensors -> defense in-line -> evaluate, no DefendedImages round-trip
+        engine = SweepEngine(cfg, args)
+        results = [run_validation(cfg, args, attack_params={}, defense_params={}, baseline=True, engine=engine)]
+        results += run_archived(cfg, args, engine)
+        save_results(results, f'validation_results_{timestamp}.csv', save_dir)
+        plot_results(pd.DataFrame(results), save_dir, timestamp)
+        return
+
     if not os.path.exists(args.defended_images_dir):
         print(f"Directory does not exist: {args.defended_images_dir}")
         return
 
     task_list = []
-    file_list = []
     
     # Total number of tasks desired
     total_tasks = 100  # Set this to the desired total number of tasks
@@ -347,22 +649,18 @@ def main():
     
     attack_counts = {key: 0 for key in attack_quotas}
 
-    # Collect all metadata files
-    for root, dirs, files in os.walk(args.defended_images_dir):
-        for file in files:
-            if file.endswith('_metadata.json'):
-                file_list.append(os.path.realpath(os.path.join(root, file)))
+    # Collect the metadata of every defended image (per-image *_metadata.json or per-directory metadata.jsonl)
+    file_list = build_manifest(args.defended_images_dir)
 
     # Process metadata files with tqdm progress bar
     with tqdm(total=len(file_list), desc="Processing metadata files", unit="file") as pbar:
         while not all(count >= quota_per_attack for count in attack_counts.values()):
-            for metadata_path in tqdm(file_list, desc="Processing metadata files"):
-                with open(metadata_path, 'r') as f:
-                    metadata = json.load(f)
+            for entry in tqdm(file_list, desc="Processing metadata files"):
+                metadata = entry['metadata']
 
                 attack_type = metadata.get('attack_type', 'unknown')
                 if attack_type == 'unknown':
-                    print(f"Warning: 'attack_type' not found in {metadata_path}")
+                    print(f"Warning: 'attack_type' not found in the metadata of {entry['src']}")
                     pbar.update(1)
                     continue
 
@@ -409,7 +707,8 @@ def main():
     
     # Baseline validation
     print("\nRunning baseline validation")
-    baseline_result = run_validation(cfg, args, attack_params={}, defense_params={}, baseline=True)
+    engine = SweepEngine(cfg, args)  # model, checkpoint and criterion are loaded once for the whole sweep
+    baseline_result = run_validation(cfg, args, attack_params={}, defense_params={}, baseline=True, engine=engine)
     results.append(baseline_result)
     
     # Read attacked-only metrics from CSV files
@@ -443,7 +742,7 @@ def main():
             
             for attack_params, defense_params in batch:
                 print(f"\n{i} Running validation for {attack_params['attack_type']} attack with {defense_params} defense and parameters {attack_params}\n")
-                defense_result = run_validation(cfg, args, attack_params, defense_params)
+                defense_result = run_validation(cfg, args, attack_params, defense_params, engine=engine)
                 results.append(defense_result)
                 
                 if defense_result['total_loss'] > args.early_stop_threshold:
@@ -470,11 +769,7 @@ def main():
         print(df_results)
 
         # Visualize results
-        metrics = ['da_seg_acc', 'da_seg_iou', 'da_seg_miou', 'll_seg_acc', 'll_seg_iou', 'll_seg_miou', 'p', 'r', 'map50', 'map']
-        attack_types = df_results['attack_type'].unique()
-
-        for metric in metrics:
-            plot_performance_by_attack(df_results, metric, '{} - {}'.format(metric.upper(), metric.replace('_', ' ').title()), metric.replace('_', ' ').title(), os.path.join(save_dir, '{}_{}_performance_'.format(metric, '{}') + timestamp + '.png'))
+        plot_results(df_results, save_dir, timestamp)
     
     else:
         print(f"No results to show.")
@@ -52,6 +52,9 @@ def infer_yolop(weight="yolop-640-640.onnx",
 
     print("num outputs: ", len(outputs_info))
 
+    # graphs exported with --end2end return final boxes and uint8 masks
+    end2end = outputs_info[1].type == 'tensor(uint8)'
+
     save_det_path = f"./pictures/detect_onnx.jpg"
     save_da_path = f"./pictures/da_onnx.jpg"
     save_ll_path = f"./pictures/ll_onnx.jpg"
@@ -79,15 +82,18 @@ def infer_yolop(weight="yolop-640-640.onnx",
 
     img = np.expand_dims(img, 0)  # (1, 3,640,640)
 
-    # inference: (1,n,6) (1,2,640,640) (1,2,640,640)
+    # inference: (1,n,6) (1,2,640,640) (1,2,640,640), end2end: (n,6) (1,640,640) (1,640,640)
     det_out, da_seg_out, ll_seg_out = ort_session.run(
         ['det_out', 'drive_area_seg', 'lane_line_seg'],
         input_feed={"images": img}
     )
 
-    det_out = torch.from_numpy(det_out).float()
-    boxes = non_max_suppression(det_out)[0]  # [n,6] [x1,y1,x2,y2,conf,cls]
-    boxes = boxes.cpu().numpy().astype(np.float32)
+    if end2end:
+        boxes = det_out.astype(np.float32)  # [n,6] [x1,y1,x2,y2,conf,cls]
+    else:
+        det_out = torch.from_numpy(det_out).float()
+        boxes = non_max_suppression(det_out)[0]  # [n,6] [x1,y1,x2,y2,conf,cls]
+        boxes = boxes.cpu().numpy().astype(np.float32)
 
     if boxes.shape[0] == 0:
         print("no bounding boxes detected.")
@@ -111,11 +117,15 @@ def infer_yolop(weight="yolop-640-640.onnx",
     cv2.imwrite(save_det_path, img_det)
 
     # select da & ll segment area.
-    da_seg_out = da_seg_out[:, :, dh:dh + new_unpad_h, dw:dw + new_unpad_w]
-    ll_seg_out = ll_seg_out[:, :, dh:dh + new_unpad_h, dw:dw + new_unpad_w]
-
-    da_seg_mask = np.argmax(da_seg_out, axis=1)[0]  # (?,?) (0|1)
-    ll_seg_mask = np.argmax(ll_seg_out, axis=1)[0]  # (?,?) (0|1)
+    if end2end:
+        da_seg_mask = da_seg_out[0, dh:dh + new_unpad_h, dw:dw + new_unpad_w]  # (?,?) (0|1)
+        ll_seg_mask = ll_seg_out[0, dh:dh + new_unpad_h, dw:dw + new_unpad_w]  # (?,?) (0|1)
+    else:
+        da_seg_out = da_seg_out[:, :, dh:dh + new_unpad_h, dw:dw + new_unpad_w]
+        ll_seg_out = ll_seg_out[:, :, dh:dh + new_unpad_h, dw:dw + new_unpad_w]
+
+        da_seg_mask = np.argmax(da_seg_out, axis=1)[0]  # (?,?) (0|1)
+        ll_seg_mask = np.argmax(ll_seg_out, axis=1)[0]  # (?,?) (0|1)
     print(da_seg_mask.shape)
     print(ll_seg_mask.shape)
 
@@ -169,4 +179,5 @@ if __name__ == "__main__":
     infer_yolop(weight=args.weight, img_path=args.img)
     """
     PYTHONPATH=. python3 ./test_onnx.py --weight yolop-640-640.onnx --img test.jpg
+    PYTHONPATH=. python3 ./test_onnx.py --weight yolop-640-640-end2end.onnx --img test.jpg
     """
@@ -0,0 +1,80 @@
+import errno
+import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from lib.core import defended_manifest
+from lib.core.defended_manifest import dedupe_plan, execute_plan, link_or_copy, symlink
+
+
+def make_sources(tmp_path, n):
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    sources = []
+    for i in range(n):
+        path = src_dir / f"{i}.png"
+        path.write_bytes(f"image {i}".encode() * 100)
+        sources.append(str(path))
+    return sources
+
+
+def assert_clean(tmp_path, sources):
+    for i, src in enumerate(sources):
+        assert open(src, 'rb').read() == f"image {i}".encode() * 100, src
+    assert not [p for p in tmp_path.rglob("*") if p.name.endswith(".tmp")]
+
+
+def duplicate_plan(tmp_path, sources):
+    # every source goes to each of four destinations, several times over
+    dsts = [str(tmp_path / "out" / f"d{j}" / "img.png") for j in range(4)]
+    return [(src, dst) for _ in range(3) for src in sources for dst in dsts], dsts
+
+
+def test_dedupe_plan_keeps_last_source():
+    plan = [("a", "x"), ("b", "y"), ("c", "x"), ("b", "y")]
+    assert dedupe_plan(plan) == [("c", "x"), ("b", "y")]
+
+
+def test_execute_plan_duplicate_destinations_link(tmp_path):
+    sources = make_sources(tmp_path, 8)
+    plan, dsts = duplicate_plan(tmp_path, sources)
+    execute_plan(plan, link_or_copy, num_workers=16)
+    for dst in dsts:
+        assert os.path.samefile(dst, sources[-1])
+    assert_clean(tmp_path, sources)
+
+
+def test_execute_plan_duplicate_destinations_copy(tmp_path, monkeypatch):
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(defended_manifest.os, "link", cross_device)
+    sources = make_sources(tmp_path, 8)
+    plan, dsts = duplicate_plan(tmp_path, sources)
+    execute_plan(plan, link_or_copy, num_workers=16)
+    for dst in dsts:
+        assert not os.path.samefile(dst, sources[-1])
+        assert open(dst, 'rb').read() == open(sources[-1], 'rb').read()
+    assert_clean(tmp_path, sources)
+
+
+def test_execute_plan_duplicate_destinations_symlink(tmp_path):
+    sources = make_sources(tmp_path, 8)
+    plan, dsts = duplicate_plan(tmp_path, sources)
+    execute_plan(plan, symlink, num_workers=16)
+    for dst in dsts:
+        assert os.readlink(dst) == sources[-1]
+    assert_clean(tmp_path, sources)
+
+
+def test_link_or_copy_reraises_other_errors(tmp_path):
+    sources = make_sources(tmp_path, 1)
+    try:
+        link_or_copy(sources[0], str(tmp_path / "missing_dir" / "img.png"))
+    except FileNotFoundError:
+        pass
+    else:
+        raise AssertionError("expected FileNotFoundError")
+    assert_clean(tmp_path, sources)
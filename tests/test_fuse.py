@@ -0,0 +1,76 @@
+import copy
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from lib.models.YOLOP import MCnet, YOLOP
+from lib.models.common import BottleneckCSP, Conv, SharpenConv
+
+ATOL = 1e-4
+
+
+def randomize_bn(model):
+    # non-trivial BatchNorm statistics, the freshly initialized ones fold into an identity
+    g = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.running_mean.copy_(torch.randn(m.num_features, generator=g) * 0.1)
+                m.running_var.copy_(torch.rand(m.num_features, generator=g) * 0.5 + 0.75)
+                m.weight.copy_(torch.rand(m.num_features, generator=g) * 0.5 + 0.75)
+                m.bias.copy_(torch.randn(m.num_features, generator=g) * 0.1)
+    return model
+
+
+def outputs_and_input_grad(model, img):
+    img = img.clone().requires_grad_(True)
+    det_out, da_seg_out, ll_seg_out = model(img)
+    inf_out, train_out = det_out
+    # the attacks differentiate the raw head outputs, the decode of inf_out is in-place
+    loss = sum(x.sum() for x in train_out) + da_seg_out.sum() + ll_seg_out.sum()
+    grad, = torch.autograd.grad(loss, img)
+    return inf_out.detach(), da_seg_out.detach(), ll_seg_out.detach(), grad
+
+
+def assert_fuse_parity(block_cfg):
+    torch.manual_seed(0)
+    model = randomize_bn(MCnet(block_cfg)).eval()
+    fused = copy.deepcopy(model).fuse()
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in fused.modules())
+
+    img = torch.rand(2, 3, 128, 160)
+    for expected, actual in zip(outputs_and_input_grad(model, img), outputs_and_input_grad(fused, img)):
+        assert torch.allclose(expected, actual, atol=ATOL, rtol=1e-4), (expected - actual).abs().max()
+
+
+def test_fuse_yolop():
+    assert_fuse_parity(YOLOP)
+
+
+def test_fuse_sharpen_conv():
+    # swap the last Conv of the drivable area neck (block 30) for a SharpenConv
+    block_cfg = copy.deepcopy(YOLOP)
+    assert block_cfg[31][1] is Conv
+    block_cfg[31] = [-1, SharpenConv, [32, 16, 3, 1]]
+    assert_fuse_parity(block_cfg)
+
+
+def test_fuse_bottleneck_csp_split_bn():
+    # BottleneckCSP.bn is split across cv3 (first half of the channels) and cv2 (second half)
+    torch.manual_seed(0)
+    model = randomize_bn(MCnet(YOLOP)).eval()
+    fused = copy.deepcopy(model).fuse()
+    blocks = [i for i, m in enumerate(model.model) if isinstance(m, BottleneckCSP)]
+    assert blocks
+    with torch.no_grad():
+        for i in blocks:
+            block, fused_block = model.model[i], fused.model[i]
+            assert not hasattr(fused_block, 'bn')
+            assert fused_block.cv3.bias is not None and fused_block.cv2.bias is not None
+            x = torch.randn(2, block.cv1.conv.in_channels, 16, 20)
+            assert torch.allclose(block(x), fused_block(x), atol=ATOL, rtol=1e-4), i
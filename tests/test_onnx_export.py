@@ -0,0 +1,50 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+ort = pytest.importorskip('onnxruntime')
+pytest.importorskip('onnx')
+pytest.importorskip('onnxsim')  # imported by export_onnx
+
+from export_onnx import ONNX_EXPORT_KWARGS, End2End, MCnet, YOLOP
+
+HEIGHT, WIDTH = 128, 160
+
+
+def test_end2end_matches_eager(tmp_path):
+    torch.manual_seed(0)
+    # a low threshold so the randomly initialized head still yields detections for NMS to sort out
+    # max_det above the candidate count: nothing is truncated, so tied scores cannot select different boxes
+    model = End2End(MCnet(YOLOP).eval(), conf_thres=0.005, iou_thres=0.45, max_det=10000).eval()
+    img = torch.rand(1, 3, HEIGHT, WIDTH)
+    with torch.no_grad():
+        det, da_seg, ll_seg = model(img)
+    assert len(det), 'no detection to compare'
+
+    onnx_path = str(tmp_path / 'end2end.onnx')
+    torch.onnx.export(model, img, onnx_path, opset_version=12, input_names=['images'],
+                      output_names=['det_out', 'drive_area_seg', 'lane_line_seg'],
+                      dynamic_axes={'det_out': {0: 'num_det'}}, **ONNX_EXPORT_KWARGS)
+
+    sess = ort.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+    assert [o.type for o in sess.get_outputs()][1:] == ['tensor(uint8)', 'tensor(uint8)']
+    ort_det, ort_da_seg, ort_ll_seg = sess.run(None, {'images': img.numpy()})
+
+    # NMS keeps the same boxes; the order of tied scores is up to the runtime, so match rows one to one
+    det = det.numpy()
+    assert ort_det.shape == det.shape
+    dist = np.abs(det[:, None] - ort_det[None]).max(2)
+    match = dist.argmin(1)
+    assert len(set(match.tolist())) == len(det)
+    assert dist[np.arange(len(det)), match].max() < 1e-3
+
+    for expected, actual in ((da_seg.numpy(), ort_da_seg), (ll_seg.numpy(), ort_ll_seg)):
+        assert actual.dtype == np.uint8 and actual.shape == expected.shape == (1, HEIGHT, WIDTH)
+        # near-tied logits may flip a handful of argmax pixels between the two runtimes
+        assert (actual != expected).mean() < 1e-3
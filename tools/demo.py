@@ -23,7 +23,7 @@ import PIL.Image as image  # For image handling
 from lib.config import cfg  # Configuration settings
 from lib.config import update_config  # Function to update configuration
 from lib.utils.utils import create_logger, select_device, time_synchronized  # Utility functions
-from lib.models import get_net  # Function to get the neural network model
+from lib.models import get_net, compile_net  # Functions to get and compile the neural network model
 from lib.dataset import LoadImages, LoadStreams  # Functions to load images or video streams
 from lib.core.general import non_max_suppression, scale_coords  # General-purpose functions
 from lib.utils import plot_one_box, show_seg_result  # Utility functions for plotting and displaying results
@@ -71,8 +71,12 @@ def detect(cfg, opt):
     checkpoint = torch.load(opt.weights, map_location=device)
     model.load_state_dict(checkpoint['state_dict'])
     model = model.to(device)
+    if not opt.no_fuse:
+        model.fuse()  # Fold BatchNorm into the convolutions
     if half:
         model.half()  # Convert model to FP16
+    if opt.compile == 'compile':
+        model = compile_net(model, 'compile')
 
     # Set up data loader: is it coming from a directory with images or from  a camera?
     if opt.source.isnumeric():
@@ -106,6 +110,9 @@ def detect(cfg, opt):
         if img.ndimension() == 3:
             img = img.unsqueeze(0)
         
+        if opt.compile == 'jit' and i == 0:
+            model = compile_net(model, 'jit', img)  # traced at the resolution of the first frame
+
         # Inference
         t1 = time_synchronized()
         det_out, da_seg_out, ll_seg_out = model(img)
@@ -190,6 +197,9 @@ if __name__ == '__main__':
     parser.add_argument('--save-dir', type=str, default='inference/output', help='directory to save results')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--update', action='store_true', help='update all models')
+    parser.add_argument('--no-fuse', action='store_true', help='keep BatchNorm layers separate from the convolutions')
+    parser.add_argument('--compile', type=str, default=None, choices=['jit', 'compile'],
+                        help='torch.jit.trace (fixed input size) or torch.compile the model for inference')
     opt = parser.parse_args()
 
     # Run the detection function with no gradient calculation
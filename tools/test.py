@@ -23,13 +23,14 @@ import lib.dataset as dataset
 from lib.config import cfg
 from lib.config import update_config
 from lib.core.loss import get_loss
-from lib.core.function import validate
+from lib.core.function import validate, validate_sweep, VALIDATE_MAX_BATCHES
 
 from lib.models import get_net
 from lib.utils.utils import create_logger, select_device, create_experiment_logger
 
-from lib.core.Attacks.JSMA import calculate_saliency, find_and_perturb_highest_scoring_pixels
+from lib.core.Attacks.JSMA import jsma_perturbation
 from lib.core.Attacks.UAP import uap_sgd_yolop
+from lib.core.Defenses.PreProcessing import build_defenses, describe_defenses
 
 import datetime
 import matplotlib.pyplot as plt
@@ -146,6 +147,37 @@ def parse_args():
                         type=float,
                         default=0.6,
                         help ='IOU threshold for NMS')
+    parser.add_argument('--max_batches',
+                        type=int,
+                        default=VALIDATE_MAX_BATCHES,
+                        help ='batches evaluated by every validate() and --fused_sweep run')
+    parser.add_argument('--sample_cache',
+                        type=str,
+                        default=None,
+                        help ='directory for caching decoded validation samples across validate() calls')
+    parser.add_argument('--ll_iou',
+                        type=str,
+                        default='hard',
+                        choices=['hard', 'soft'],
+                        help ='lane line IoU loss term used by the attacks: argmax IoU or differentiable soft IoU')
+    parser.add_argument('--fused_sweep',
+                        action='store_true',
+                        help ='evaluate every FGSM epsilon / CCP setting from one gradient per batch (no perturbed images are saved)')
+    parser.add_argument('--no_fuse',
+                        action='store_true',
+                        help='keep BatchNorm layers separate from the convolutions')
+    parser.add_argument('--archive_dtype',
+                        type=str,
+                        default=None,
+                        choices=['float16', 'float32'],
+                        help ='also store the perturbed model inputs in a lossless tensor archive of this dtype')
+    parser.add_argument('--archive_dir',
+                        type=str,
+                        default='runs/adversarial_archive',
+                        help ='archive shared by every attack run, records are selected by their attack params')
+    parser.add_argument('--compact_targets',
+                        action='store_true',
+                        help ='ship segmentation targets as bit-packed uint8 maps, expanded on the device')
     
    # Adding new arguments for dataset and attack type
     parser.add_argument('--dataset',
@@ -178,6 +210,18 @@ def parse_args():
                         choices=['FGSM', 'FGSM_WITH_NOISE', 'ITERATIVE_FGSM'],
                         help ='Type of FGSM attack. Options include: FGSM, FGSM_WITH_NOISE, and ITERATIVE_FGSM',
                         default='FGSM')
+    parser.add_argument('--fgsm_alpha',
+                        type=float,
+                        help='Step size of each ITERATIVE_FGSM iteration',
+                        default=0.01)
+    parser.add_argument('--fgsm_num_iter',
+                        type=int,
+                        help='Maximum number of ITERATIVE_FGSM iterations',
+                        default=10)
+    parser.add_argument('--fgsm_loss_threshold',
+                        type=float,
+                        help='Stop attacking an image once its own loss reaches this value (ITERATIVE_FGSM)',
+                        default=None)
     
     # New arguments for JSMA
     parser.add_argument('--num_pixels',
@@ -194,6 +238,16 @@ def parse_args():
                         help = "Select the type of perturbation to be applied to the highest scoring pixels. Options include add, set, and noise.",
                         default = "noise"
                         )
+    parser.add_argument('--jsma_reduce',
+                        type = str,
+                        choices = ["max", "sum"],
+                        help = "Reduce saliency maps over color channels so the top pixels are (y, x) locations perturbed in every channel.",
+                        default = None
+                        )
+    parser.add_argument('--jsma_half',
+                        action = 'store_true',
+                        help = "Keep the saliency maps in float16."
+                        )
     
     # New arguments for UAP
     parser.add_argument('--uap_max_iterations',
@@ -220,6 +274,25 @@ def parse_args():
                         type=int,
                         help='Batch size for UAP attack',
                         default=6)
+    parser.add_argument('--uap_accum_steps',
+                        type=int,
+                        help='Number of batches whose gradients are accumulated per UAP update',
+                        default=1)
+    parser.add_argument('--uap_checkpoint_dir',
+                        type=str,
+                        help='Directory to checkpoint UAP training to and resume it from',
+                        default=None)
+    parser.add_argument('--uap_store',
+                        type=str,
+                        help='Directory of named UAP artifacts (default: <output dir>/uap_store)',
+                        default=None)
+    parser.add_argument('--uap_reuse',
+                        action='store_true',
+                        help='Evaluate UAPs already in the store instead of training them again')
+    parser.add_argument('--uap_checkpoint_every',
+                        type=int,
+                        help='Number of UAP updates between checkpoints',
+                        default=100)
     
     # New Args for CCP 
     parser.add_argument('--color_channel',
@@ -494,7 +567,7 @@ def main():
     print("Finish build model\n")
     
     # Define loss function and optimizer
-    criterion = get_loss(cfg, device=device)
+    criterion = get_loss(cfg, device=device, ll_iou=args.ll_iou)
 
     # Load checkpoint model
     model_dict = model.state_dict()
@@ -507,6 +580,8 @@ def main():
     base_logger.info("=> loaded checkpoint '{}' ".format(checkpoint_file))
 
     model = model.to(device)
+    if not args.no_fuse:
+        model.fuse()  # evaluation and attacks only, BatchNorm folded into the convolutions
     model.gr = 1.0
     model.nc = 1
     print("Build model finished")
@@ -524,7 +599,9 @@ def main():
         transform=transforms.Compose([
             transforms.ToTensor(),
             normalize,
-        ])
+        ]),
+        cache_dir=args.sample_cache,
+        compact_targets=args.compact_targets
     )
 
     valid_loader = DataLoaderX(
@@ -537,6 +614,11 @@ def main():
     )
     
     print('Load data finished')
+
+    # pre-processing defenses, applied in-line to every attacked batch
+    defenses = build_defenses(args.resizer, args.quality, args.gauss, args.border_type, args.noise, args.bit_depth)
+    if defenses:
+        base_logger.info(f'Defenses: {describe_defenses(defenses)}')
     
     epoch = 0
 
@@ -547,7 +629,7 @@ def main():
     da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
         epoch, cfg, valid_loader, valid_dataset, model, criterion,
         normal_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=normal_logger, device=device, rank=-1,
-        attack_type=None, experiment_number=0
+        attack_type=None, experiment_number=0, max_batches=args.max_batches
     )
     normal_metrics = create_normal_metrics(da_segment_results, ll_segment_results, detect_results, total_loss)
 
@@ -561,13 +643,24 @@ def main():
     if attack_type == "FGSM":
         epsilons = [0.0, 0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5] if args.experiment_mode == 1 else [args.epsilon] 
         '''.1, .3, .5, .75, 1, 3, 5, 7, 10'''
+        sweep_results = None
+        if args.fused_sweep and args.fgsm_attack_type == 'FGSM':
+            # one gradient per batch for every epsilon, evaluated on the batches validate() covers
+            sweep_results = validate_sweep(
+                epoch, cfg, valid_loader, valid_dataset, model, criterion, base_output_dir,
+                [{'epsilon': epsilon} for epsilon in epsilons], attack_type='FGSM', device=device, max_batches=args.max_batches, defenses=defenses
+            )
         for experiment_number, epsilon in enumerate(epsilons, start=1):
             exp_logger, exp_output_dir = create_experiment_logger(base_output_dir, experiment_number, attack_type, epsilon=epsilon)
-            da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
-                epoch, cfg, valid_loader, valid_dataset, model, criterion,
-                exp_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1,
-                attack_type=args.fgsm_attack_type, epsilon=epsilon, experiment_number=experiment_number
-            )
+            if sweep_results is not None:
+                da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = sweep_results[experiment_number - 1]
+            else:
+                da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
+                    epoch, cfg, valid_loader, valid_dataset, model, criterion,
+                    exp_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1, archive_dtype=args.archive_dtype, archive_dir=args.archive_dir, max_batches=args.max_batches,
+                    attack_type=args.fgsm_attack_type, epsilon=epsilon, experiment_number=experiment_number, defenses=defenses,
+                    alpha=args.fgsm_alpha, num_iter=args.fgsm_num_iter, loss_threshold=args.fgsm_loss_threshold
+                )
             msg = create_log_message(da_segment_results, ll_segment_results, detect_results, total_loss, times)
             exp_logger.info(msg)
             results.append({
@@ -606,23 +699,15 @@ def main():
             print(f"The number of pixels - {num_pixels}")
             print(f"The perturb value - {perturb_value}")
 
-            saliency_maps = calculate_saliency(model, valid_loader, device, cfg, criterion)
-            
-            images = []
-            for batch in valid_loader:
-                images.extend(batch[0].numpy())
-                if 0 == 0:
-                    print("Breaking...")
-                    break
-            
-            perturbed_images, _ = find_and_perturb_highest_scoring_pixels(images, saliency_maps, num_pixels, perturb_value, perturbation_type=perturb_type)
+            # saliency maps come from the input gradient validate() computes for each batch anyway
+            perturbed_images = jsma_perturbation(num_pixels, perturb_value, perturb_type, reduce=args.jsma_reduce, half=args.jsma_half)
             
             exp_logger, exp_output_dir = create_experiment_logger(base_output_dir, experiment_number, attack_type, epsilon=perturb_value, num_pixels=num_pixels)
             
             da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
                 epoch, cfg, valid_loader, valid_dataset, model, criterion,
-                exp_output_dir, base_tb_log_dir, perturbed_images=perturbed_images, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1,
-                attack_type=attack_type, num_pixels=num_pixels, experiment_number=experiment_number, epsilon=perturb_value
+                exp_output_dir, base_tb_log_dir, perturbed_images=perturbed_images, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1, archive_dtype=args.archive_dtype, archive_dir=args.archive_dir, max_batches=args.max_batches,
+                attack_type=attack_type, num_pixels=num_pixels, experiment_number=experiment_number, defenses=defenses, epsilon=perturb_value
             )
             
             msg = create_log_message(da_segment_results, ll_segment_results, detect_results, total_loss, times)
@@ -681,28 +766,35 @@ def main():
             # (10, 9.6, 1.15, None, None, 29) 
         ] if args.experiment_mode else [(args.uap_max_iterations, args.uap_eps, args.uap_delta, args.uap_num_classes, args.uap_targeted, args.uap_batch_size)]
         
+        uap_store = dataset.UAPStore(args.uap_store or os.path.join(base_output_dir, 'uap_store'))
         for experiment_number, (nb_epoch, eps, step_decay, y_target, layer_name, beta) in enumerate(uap_params, start=1):
-            uap, loss_history = uap_sgd_yolop(model, valid_loader, device, nb_epoch, eps, criterion, step_decay, beta, y_target, None, layer_name)
+            uap_name = f'uap_{experiment_number}_eps_{eps}_decay_{step_decay}'
+            if args.uap_reuse and uap_name in uap_store:
+                uap, uap_metadata = uap_store.load(uap_name)
+                loss_history = uap_metadata.get('losses', [])
+            else:
+                checkpoint_path = os.path.join(args.uap_checkpoint_dir, f'{uap_name}.pt') if args.uap_checkpoint_dir else None
+                uap, loss_history = uap_sgd_yolop(model, valid_loader, device, nb_epoch, eps, criterion, step_decay, beta, y_target, None, layer_name,
+                                                  accum_steps=args.uap_accum_steps, checkpoint_path=checkpoint_path, checkpoint_every=args.uap_checkpoint_every)
+                uap_store.save(uap_name, uap, eps=eps, step_decay=step_decay, nb_epoch=nb_epoch, losses=loss_history)
             
             exp_logger, exp_output_dir = create_experiment_logger(base_output_dir, experiment_number, attack_type, epsilon=eps, step_decay=step_decay)
             
-            images = []
-            count = 0
-            for batch in valid_loader:
-                images.extend(batch[0].numpy())
-
-                # if len(images) >= len(valid_loader.dataset):
-                if count == 0:
-                    break
-
-            perturbed_images = torch.clamp(torch.tensor(images, dtype=torch.float32) + uap.unsqueeze(0), 0, 1)
-            
-            perturbed_images = perturbed_images.squeeze(0)
+            # the perturbation is added per sample as the split is loaded
+            uap_dataset = dataset.UAPDataset(valid_dataset, uap)
+            uap_loader = DataLoaderX(
+                uap_dataset,
+                batch_size=cfg.TEST.BATCH_SIZE_PER_GPU * len(cfg.GPUS),
+                shuffle=False,
+                num_workers=0,
+                pin_memory=False,
+                collate_fn=dataset.AutoDriveDataset.collate_fn
+            )
             
             da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
-                epoch, cfg, valid_loader, valid_dataset, model, criterion,
-                exp_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1,
-                attack_type=attack_type, step_decay=step_decay, epsilon=eps, experiment_number=experiment_number, perturbed_images=perturbed_images
+                epoch, cfg, uap_loader, uap_dataset, model, criterion,
+                exp_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1, archive_dtype=args.archive_dtype, archive_dir=args.archive_dir, max_batches=args.max_batches,
+                attack_type=attack_type, step_decay=step_decay, epsilon=eps, experiment_number=experiment_number, defenses=defenses
             )
             msg = create_log_message(da_segment_results, ll_segment_results, detect_results, total_loss, times)
             exp_logger.info(msg)
@@ -740,14 +832,24 @@ def main():
         (0.01, 'B'), (0.05, 'B'), (0.10, 'B'), (0.20, 'B'), (0.50, 'B'), (1.00, 'B')
         ] if args.experiment_mode else [(args.epsilon, args.color_channel)]
         
+        sweep_results = None
+        if args.fused_sweep:
+            # one gradient per batch for every (epsilon, channel), evaluated on the batches validate() covers
+            sweep_results = validate_sweep(
+                epoch, cfg, valid_loader, valid_dataset, model, criterion, base_output_dir,
+                [{'epsilon': epsilon, 'channel': color_channel} for epsilon, color_channel in ccp_params], attack_type='CCP', device=device, max_batches=args.max_batches, defenses=defenses
+            )
         for experiment_number, (epsilon, color_channel) in enumerate(ccp_params, start=1):
             exp_logger, exp_output_dir = create_experiment_logger(base_output_dir, experiment_number, attack_type, epsilon=epsilon, channel=color_channel)
             
-            da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
-                epoch, cfg, valid_loader, valid_dataset, model, criterion,
-                exp_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1,
-                attack_type=attack_type, epsilon=epsilon, channel=color_channel, experiment_number=experiment_number
-            )
+            if sweep_results is not None:
+                da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = sweep_results[experiment_number - 1]
+            else:
+                da_segment_results, ll_segment_results, detect_results, total_loss, maps, times = validate(
+                    epoch, cfg, valid_loader, valid_dataset, model, criterion,
+                    exp_output_dir, base_tb_log_dir, writer_dict=writer_dict, logger=exp_logger, device=device, rank=-1, archive_dtype=args.archive_dtype, archive_dir=args.archive_dir, max_batches=args.max_batches,
+                    attack_type=attack_type, epsilon=epsilon, channel=color_channel, experiment_number=experiment_number, defenses=defenses
+                )
             msg = create_log_message(da_segment_results, ll_segment_results, detect_results, total_loss, times)
             exp_logger.info(msg)
             results.append({
@@ -65,6 +65,8 @@ def parse_args():
     parser.add_argument('--local_rank', type=int, default=-1, help='DDP parameter, do not modify')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.6, help='IOU threshold for NMS')
+    parser.add_argument('--ll-iou', type=str, default='hard', choices=['hard', 'soft'], help='lane line IoU loss term: argmax IoU or differentiable soft IoU')
+    parser.add_argument('--compact-targets', action='store_true', help='ship segmentation targets as bit-packed uint8 maps, expanded on the device')
     args = parser.parse_args()
 
     return args
@@ -125,7 +127,7 @@ def main():
     
 
     # define loss function (criterion) and optimizer
-    criterion = get_loss(cfg, device=device)
+    criterion = get_loss(cfg, device=device, ll_iou=args.ll_iou)
     optimizer = get_optimizer(cfg, model)
 
 
@@ -265,7 +267,8 @@ def main():
         transform=transforms.Compose([
             transforms.ToTensor(),
             normalize,
-        ])
+        ]),
+        compact_targets=args.compact_targets
     )
     train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset) if rank != -1 else None
 
@@ -288,7 +291,8 @@ def main():
             transform=transforms.Compose([
                 transforms.ToTensor(),
                 normalize,
-            ])
+            ]),
+            compact_targets=args.compact_targets
         )
 
         valid_loader = DataLoaderX(